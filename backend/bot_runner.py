@@ -0,0 +1,58 @@
+# backend/bot_runner.py (NEW FILE)
+
+import asyncio
+import logging
+import signal
+
+# Import the already configured services from main.py
+from main import (account_state_cache, bot_shard_coordinator, exchange_manager, exposure_book, load_ai_models,
+                  market_streamer, order_fill_watcher, paper_engine, settings, signal_multicaster,
+                  stop_engine, strategy_executor, telegram_outbox, websocket_relay)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    """
+    Entry point for a bot runner process. Start as many of these as needed; the active
+    streaming and grid bots are split between them by consistent hashing and DB leases.
+    """
+    if settings.BOT_RUNNER_MODE != "external":
+        logger.warning("BOT_RUNNER_MODE is not 'external'. The API will also run the bots started through it.")
+
+    logger.info(f"Starting bot runner {bot_shard_coordinator.runner_id}...")
+    load_ai_models()
+    # Bot logs are relayed through Redis to whichever API worker holds the user's WebSocket.
+    websocket_relay.enabled = True
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, bot_shard_coordinator.stop)
+        except NotImplementedError:
+            pass  # Windows: KeyboardInterrupt cancels the coordinator, which still releases its leases.
+
+    reconcile_task = asyncio.create_task(account_state_cache.run_reconciliation_loop())
+    exposure_task = asyncio.create_task(exposure_book.run_reconciliation_loop())
+    try:
+        await bot_shard_coordinator.run()
+    finally:
+        reconcile_task.cancel()
+        exposure_task.cancel()
+        await signal_multicaster.close()
+        strategy_executor.shutdown()
+        await market_streamer.close()
+        await order_fill_watcher.close()
+        await paper_engine.close()
+        stop_engine.close()
+        await telegram_outbox.close()
+        await exchange_manager.close_all_private()
+        await websocket_relay.close()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Bot runner stopped.")
@@ -11,6 +11,8 @@
 import abc
 import asyncio
 import base64
+import bisect
+import heapq
 import datetime
 import hashlib
 import hmac
@@ -21,16 +23,19 @@ import os
 import random
 import secrets
 import smtplib
+import socket
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import asynccontextmanager
 from decimal import Decimal, getcontext, InvalidOperation
-from collections import defaultdict
+from collections import defaultdict, deque
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from enum import Enum as PythonEnum
 from sqlite3 import IntegrityError
-from typing import Annotated, Any, AsyncGenerator, Dict, List, Literal, Optional
+from typing import Annotated, Any, AsyncGenerator, Callable, Dict, List, Literal, NamedTuple, Optional, Tuple
 from uuid import UUID as PythonUUID
 from uuid import uuid4
 
@@ -57,7 +62,9 @@ from pydantic import (BaseModel, ConfigDict, EmailStr, Field, field_validator,
 # 3. DATABASE (SQLALCHEMY)
 # ==============================================================================
 from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Integer,
-                        Numeric, String, Text, UUID, and_)
+                        Numeric, String, Text, UUID, and_, delete, event, insert, or_, update)
+from sqlalchemy import inspect as sa_inspect, text as sa_text
+from sqlalchemy.exc import IntegrityError as SQLAlchemyIntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.future import select
 from sqlalchemy.orm import (declarative_base, relationship, selectinload,
@@ -82,6 +89,7 @@ from pydantic_settings import BaseSettings
 # 5. TRADING, DATA ANALYSIS & AI/ML
 # ==============================================================================
 import ccxt.async_support as ccxt
+import ccxt.pro as ccxtpro
 import google.generativeai as genai
 import joblib
 import numpy as np
@@ -94,24 +102,33 @@ from asyncio import Lock
 # ==============================================================================
 import aiohttp
 import cloudinary
+import redis.asyncio as aioredis
 import cloudinary.uploader
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
 from sqlalchemy.sql.functions import user
 from telegram import Update, User as TelegramUser
-from telegram.error import InvalidToken
+from telegram.error import BadRequest, Forbidden, InvalidToken, RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
 from tradingview_ta import TA_Handler, Interval
-from celery_worker import celery_app
-from tasks import run_optimization_task, run_single_backtest_task, send_email_task, send_telegram_notification_task
+from celery_worker import REDIS_URL, celery_app
+from tasks import run_optimization_task, run_single_backtest_task, send_email_task
 from celery.result import AsyncResult
+from stream_simulator import ReplayKlineSource, SyntheticKlineSource
 try:
     import onnxruntime as ort
     ai_models_available = True
 except ImportError:
     ai_models_available = False
     ort = None
+try:
+    # orjson decodes websocket frames several times faster than the stdlib parser.
+    import orjson
+    fast_json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    fast_json_loads = json.loads
 
 # ==============================================================================
 # 1. CONFIGURATION
@@ -202,6 +219,47 @@ class Settings(BaseSettings):
     # --- Local Dev Fallback (Not needed in Render) ---
     FIREBASE_CREDENTIALS_PATH: Optional[str] = None
 
+    # --- Bot Runner Sharding ---
+    # "embedded": streaming/grid bots run inside the API process (single worker only).
+    # "external": they run in bot_runner.py processes that split the bots between them by lease.
+    BOT_RUNNER_MODE: str = "embedded"
+    BOT_RUNNER_ID: Optional[str] = None
+    BOT_RUNNER_LEASE_SECONDS: int = 30
+    BOT_RUNNER_SYNC_SECONDS: int = 5
+    # --- Market Data Streams ---
+    # Routes every exchange's live stream to one provider, e.g. "synthetic" or "replay" for offline load tests.
+    MARKET_STREAM_PROVIDER: Optional[str] = None
+    # Point at ws://localhost:8765/stream to benchmark against stream_simulator.py.
+    BINANCE_STREAM_URL: str = "wss://stream.binance.com:9443/stream"
+    LOCAL_STREAM_RATE: float = 100.0  # msgs/s from the synthetic/replay providers; 0 = unthrottled
+    REPLAY_STREAM_FILE: Optional[str] = None
+    # Worker processes for CPU-heavy strategy evaluation; 0 = one per CPU core, minus one for the event loop.
+    STRATEGY_POOL_WORKERS: int = 0
+    # Startup restart pacing, per exchange: concurrent restarts and restarts per second.
+    BOT_RESTART_CONCURRENCY: int = 4
+    BOT_RESTART_RATE: float = 2.0
+    # Paper trading simulation
+    PAPER_TAKER_FEE: float = 0.001
+    PAPER_MAKER_FEE: float = 0.001
+    PAPER_SLIPPAGE_BPS: float = 5.0
+    PAPER_LATENCY_MS: int = 250
+    PAPER_FLUSH_SECONDS: float = 2.0
+    # Telegram: set the webhook URL (…/api/integrations/telegram/webhook) to receive updates by webhook instead of long polling.
+    TELEGRAM_WEBHOOK_URL: Optional[str] = None
+    TELEGRAM_WEBHOOK_SECRET: Optional[str] = None
+    TELEGRAM_SEND_RATE: float = 25.0  # outgoing messages/s across all chats; Telegram caps bots at ~30
+    # Pre-trade exposure limits in USD notional (0 disables a limit); paper and live are limited separately.
+    RISK_MAX_ASSET_EXPOSURE_USD: float = 10_000.0
+    RISK_MAX_USER_EXPOSURE_USD: float = 50_000.0
+    # Market scanner: SCANNER_SYMBOLS is a comma-separated list; empty scans the exchange's active USDT spot pairs.
+    SCANNER_ENABLED: bool = False
+    SCANNER_EXCHANGE: str = "binance"
+    SCANNER_TIMEFRAME: str = "1m"
+    SCANNER_SYMBOLS: Optional[str] = None
+    SCANNER_MAX_SYMBOLS: int = 300
+    SCANNER_TOP_N: int = 25
+    SCANNER_PUBLISH_SECONDS: float = 5.0
+
 
     class Config:
         env_file = ".env"
@@ -310,7 +368,8 @@ class ConnectionManager:
     async def connect(self, user_id: str, websocket: WebSocket):
         await websocket.accept()
         # Initialize with no symbol being viewed.
-        self.active_connections[user_id] = {"websocket": websocket, "viewing_symbol": None}
+        self.active_connections[user_id] = {"websocket": websocket, "viewing_symbol": None, "viewing_bots": set(),
+                                           "viewing_scanner": False}
         logger.info(f"User {user_id} connected via WebSocket.")
 
     def disconnect(self, user_id: str):
@@ -330,6 +389,24 @@ class ConnectionManager:
             self.active_connections[user_id]["viewing_symbol"] = None
             logger.info(f"User {user_id} stopped viewing a symbol.")
 
+    # NEW METHOD: Bot logs are only delivered while the user has the bot open.
+    def subscribe_to_bot(self, user_id: str, bot_id: str):
+        if user_id in self.active_connections:
+            self.active_connections[user_id]["viewing_bots"].add(bot_id)
+
+    def unsubscribe_from_bot(self, user_id: str, bot_id: str):
+        if user_id in self.active_connections:
+            self.active_connections[user_id]["viewing_bots"].discard(bot_id)
+
+    def is_viewing_bot(self, user_id: str, bot_id: str) -> bool:
+        connection = self.active_connections.get(user_id)
+        return connection is not None and bot_id in connection["viewing_bots"]
+
+    # NEW METHOD: Market scanner updates are only pushed to users with the scanner open.
+    def set_viewing_scanner(self, user_id: str, viewing: bool):
+        if user_id in self.active_connections:
+            self.active_connections[user_id]["viewing_scanner"] = viewing
+
     async def send_personal_message(self, message: dict, user_id: str):
         if user_id in self.active_connections:
             websocket = self.active_connections[user_id]["websocket"]
@@ -339,6 +416,8 @@ class ConnectionManager:
                 self.disconnect(user_id)
             except Exception as e:
                 logger.error(f"Error sending message to user {user_id}: {e}")
+        elif websocket_relay.enabled:
+            await websocket_relay.publish(message, user_id)
 
     async def broadcast(self, message: dict):
         # This is for global announcements
@@ -363,10 +442,183 @@ class ConnectionManager:
             if connection_data["viewing_symbol"] == symbol.upper():
                 await self.send_personal_message(message, user_id)
 
+    async def broadcast_to_scanner_viewers(self, message: dict):
+        for user_id, connection_data in list(self.active_connections.items()):
+            if connection_data["viewing_scanner"]:
+                await self.send_personal_message(message, user_id)
+
 
 websocket_manager = ConnectionManager()
 
 
+# --- NEW: Cross-Process WebSocket Relay ---
+class WebSocketRelay:
+    """
+    Bot runner processes hold no browser connections. They publish user messages to Redis and
+    every API worker forwards the ones addressed to users connected to it.
+    """
+    CHANNEL = "quantumleap:websocket_relay"
+
+    def __init__(self):
+        self.enabled = False  # Switched on by bot_runner.py
+        self._redis = None
+
+    def _client(self):
+        if self._redis is None:
+            self._redis = aioredis.from_url(REDIS_URL)
+        return self._redis
+
+    async def publish(self, message: dict, user_id: str):
+        try:
+            payload = json.dumps({"user_id": user_id, "message": jsonable_encoder(message)})
+            await self._client().publish(self.CHANNEL, payload)
+        except Exception as e:
+            logger.error(f"WebSocket relay publish failed for user {user_id}: {e}")
+
+    async def run_subscriber(self):
+        """Long-running task in each API worker; delivers relayed messages to local connections."""
+        while True:
+            try:
+                pubsub = self._client().pubsub()
+                await pubsub.subscribe(self.CHANNEL)
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    payload = fast_json_loads(item["data"])
+                    if payload["user_id"] not in websocket_manager.active_connections:
+                        continue
+                    message = payload["message"]
+                    if message.get("type") in ("bot_log", "bot_log_batch"):
+                        # Runners can't see who is watching; drop log lines for bots nobody has open here.
+                        message = bot_log_bus.filter_for_viewer(payload["user_id"], message)
+                        if message is None:
+                            continue
+                    await websocket_manager.send_personal_message(message, payload["user_id"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"WebSocket relay subscriber error: {e}. Reconnecting in 5s...")
+                await asyncio.sleep(5)
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+websocket_relay = WebSocketRelay()
+
+
+# --- NEW: Bot Log Bus ---
+class BotLogBus:
+    """
+    Routes bots' live log lines to the users watching them (websocket action "subscribe_bot").
+    Lines for a user are buffered and flushed together every FLUSH_INTERVAL; heartbeats are
+    throttled per bot and coalesced to the latest one; debug lines are shed while the buffers
+    are backed up. In a bot runner, lines go out through the relay and the API worker holding
+    the user's connection does the viewer filtering.
+    """
+    FLUSH_INTERVAL = 0.25
+    HEARTBEAT_INTERVAL = 15.0
+    # An unchanged heartbeat is repeated at most this often.
+    HEARTBEAT_REPEAT_INTERVAL = 300.0
+    SHED_DEBUG_ABOVE = 1000
+    MAX_PENDING_PER_USER = 200
+
+    def __init__(self):
+        self._pending: Dict[str, deque] = {}
+        self._pending_count = 0
+        # bot_id -> (user_id, entry) held back until the bot's next heartbeat slot.
+        self._held_heartbeats: Dict[str, Tuple[str, Dict]] = {}
+        # bot_id -> (monotonic time, message) of the last heartbeat sent.
+        self._last_heartbeat: Dict[str, Tuple[float, str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.delivered = 0
+        self.coalesced = 0
+        self.shed = 0
+
+    def emit(self, user_id: str, bot_id: Any, message: str, level: str = "info"):
+        """Queues a log line for a bot. `level` is "info", "heartbeat" or "debug"."""
+        bot_id = str(bot_id)
+        if not websocket_relay.enabled and not websocket_manager.is_viewing_bot(user_id, bot_id):
+            return
+        if level == "debug" and self._pending_count >= self.SHED_DEBUG_ABOVE:
+            self.shed += 1
+            return
+
+        entry = {"type": "bot_log", "bot_id": bot_id, "message": message, "level": level}
+        if level == "heartbeat":
+            now = time.monotonic()
+            sent_at, sent_message = self._last_heartbeat.get(bot_id, (float('-inf'), None))
+            if message == sent_message and now - sent_at < self.HEARTBEAT_REPEAT_INTERVAL:
+                self.coalesced += 1
+                return
+            if now - sent_at < self.HEARTBEAT_INTERVAL:
+                if bot_id in self._held_heartbeats:
+                    self.coalesced += 1
+                self._held_heartbeats[bot_id] = (user_id, entry)
+                self._ensure_flusher()
+                return
+            self._last_heartbeat[bot_id] = (now, message)
+        self._enqueue(user_id, entry)
+
+    def _enqueue(self, user_id: str, entry: Dict):
+        pending = self._pending.setdefault(user_id, deque())
+        if len(pending) >= self.MAX_PENDING_PER_USER:
+            pending.popleft()
+            self._pending_count -= 1
+            self.shed += 1
+        pending.append(entry)
+        self._pending_count += 1
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while self._pending or self._held_heartbeats:
+                await asyncio.sleep(self.FLUSH_INTERVAL)
+                now = time.monotonic()
+                for bot_id, (user_id, entry) in list(self._held_heartbeats.items()):
+                    if now - self._last_heartbeat.get(bot_id, (float('-inf'),))[0] >= self.HEARTBEAT_INTERVAL:
+                        del self._held_heartbeats[bot_id]
+                        self._last_heartbeat[bot_id] = (now, entry["message"])
+                        self._enqueue(user_id, entry)
+
+                pending, self._pending, self._pending_count = self._pending, {}, 0
+                for user_id, entries in pending.items():
+                    message = entries[0] if len(entries) == 1 else {"type": "bot_log_batch", "entries": list(entries)}
+                    await websocket_manager.send_personal_message(message, user_id)
+                    self.delivered += len(entries)
+        except Exception as e:
+            logger.error(f"Bot log bus flush failed: {e}", exc_info=True)
+        finally:
+            self._flush_task = None
+
+    def filter_for_viewer(self, user_id: str, message: Dict) -> Optional[Dict]:
+        """Keeps only the lines of a relayed bot_log/bot_log_batch for bots the user is viewing."""
+        if message["type"] == "bot_log":
+            return message if websocket_manager.is_viewing_bot(user_id, message["bot_id"]) else None
+        entries = [e for e in message["entries"] if websocket_manager.is_viewing_bot(user_id, e["bot_id"])]
+        if not entries:
+            return None
+        return entries[0] if len(entries) == 1 else {"type": "bot_log_batch", "entries": entries}
+
+    def forget(self, bot_id: Any):
+        bot_id = str(bot_id)
+        self._held_heartbeats.pop(bot_id, None)
+        self._last_heartbeat.pop(bot_id, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"pending": self._pending_count, "held_heartbeats": len(self._held_heartbeats),
+                "delivered": self.delivered, "coalesced": self.coalesced, "shed": self.shed}
+
+
+bot_log_bus = BotLogBus()
+
+
 # ==============================================================================
 # 3. DATABASE MODELS (SQLAlchemy ORM) - V2 (Custodial Ledger Syst
 # ==============================================================================
@@ -486,6 +738,7 @@ class NotificationType(str, PythonEnum):
     PAYMENT_SUCCESS = "payment_success"
     PAYMENT_FAILURE = "payment_failure"
     INFO = "info"
+    PRICE_ALERT = "price_alert"
 
 class UserProfile(Base):
     __tablename__ = "user_profiles"
@@ -588,6 +841,8 @@ class TradingBot(Base):
     strategy_params = Column(Text, nullable=True)
     symbol = Column(String, nullable=False)
     exchange = Column(String, nullable=False)  # Will now store values from ExchangeName enum
+    # --- NEW: Candle timeframe the strategy runs on; higher timeframes are aggregated from the 1m stream ---
+    timeframe = Column(String, default='1m', server_default='1m', nullable=False)
     is_active = Column(Boolean, default=False)
     is_paper_trading = Column(Boolean, default=False)
     use_dynamic_sizing = Column(Boolean, default=False)  # NEW COLUMN
@@ -596,6 +851,7 @@ class TradingBot(Base):
     # --- NEW: Fields for Advanced Order Management ---
     take_profit_percentage = Column(Float, nullable=True)
     stop_loss_percentage = Column(Float, nullable=True)
+    trailing_stop_percentage = Column(Float, nullable=True)
     # --- NEW: Fields to track the state of an active position ---
     active_position_id = Column(String, nullable=True, unique=True)  # The ID of the entry trade/order
     active_position_entry_price = Column(Float, nullable=True)
@@ -743,6 +999,49 @@ class SerialNumber(Base):
 
     # Relationship to easily fetch the user who this key belongs to
     assigned_user = relationship("User")
+
+
+# --- NEW: Bot runner membership and bot ownership leases ---
+class BotRunnerNode(Base):
+    __tablename__ = "bot_runner_nodes"
+    runner_id = Column(String, primary_key=True)
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_heartbeat = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class BotLease(Base):
+    __tablename__ = "bot_leases"
+    bot_id = Column(UUID, ForeignKey("trading_bots.id", ondelete="CASCADE"), primary_key=True)
+    runner_id = Column(String, nullable=False, index=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# --- NEW: Durable Telegram outbox ---
+class TelegramOutboxMessage(Base):
+    __tablename__ = "telegram_outbox"
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(String, nullable=False, index=True)
+    text = Column(Text, nullable=False)
+    status = Column(String(10), default="pending", nullable=False)  # pending, sending or failed; sent rows are deleted
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    claimed_by = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# --- NEW: Price alerts ---
+class PriceAlert(Base):
+    __tablename__ = "price_alerts"
+    id = Column(UUID, primary_key=True, default=uuid4)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
+    exchange = Column(String, nullable=False)
+    symbol = Column(String, nullable=False)
+    direction = Column(String(5), nullable=False)  # 'above' or 'below' the price when the alert was set
+    price = Column(Float, nullable=False)
+    note = Column(String(200), nullable=True)
+    is_active = Column(Boolean, default=True, index=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    triggered_at = Column(DateTime(timezone=True), nullable=True)
 # ==============================================================================
 # 4. PYDANTIC SCHEMAS (Data Transfer Objects)
 # ==============================================================================
@@ -832,6 +1131,7 @@ class TradingBotCreate(BaseModel):
     name: str
     symbol: str
     exchange: ExchangeName = ExchangeName.BINANCE
+    timeframe: str = '1m'
     asset_class: AssetClass = AssetClass.CRYPTO
     strategy_type: StrategyType = StrategyType.PREBUILT
     market_type: MarketType = MarketType.SPOT
@@ -841,6 +1141,7 @@ class TradingBotCreate(BaseModel):
     visual_strategy_json: Optional[Dict[str, Any]] = None
     take_profit_percentage: Optional[float] = Field(None, gt=0)
     stop_loss_percentage: Optional[float] = Field(None, gt=0)
+    trailing_stop_percentage: Optional[float] = Field(None, gt=0, lt=100)
     leverage: int = Field(1, gt=0, le=125)
     market_regime_filter_enabled: bool = False
     optimus_enabled: bool = False
@@ -855,6 +1156,13 @@ class TradingBotCreate(BaseModel):
         if self.strategy_type == StrategyType.VISUAL and self.visual_strategy_json is None:
             raise ValueError('`visual_strategy_json` is required for visual strategies.')
         return self
+
+    @field_validator('timeframe')
+    @classmethod
+    def check_timeframe(cls, v: str) -> str:
+        if v not in TIMEFRAME_SECONDS:
+            raise ValueError(f"Unsupported timeframe '{v}'. Use one of: {', '.join(TIMEFRAME_SECONDS)}.")
+        return v
         
     # --- FIX: Validator to handle JSON strings if frontend sends them ---
     @field_validator('strategy_params', 'visual_strategy_json', 'backtest_results_cache', mode='before')
@@ -880,6 +1188,7 @@ class TradingBotSchema(BaseModel):
     strategy_params: Optional[Dict[str, Any]] = None
     symbol: str
     exchange: str
+    timeframe: str = '1m'
     is_active: bool
     is_paper_trading: bool
     market_regime_filter_enabled: bool
@@ -887,6 +1196,7 @@ class TradingBotSchema(BaseModel):
     asset_class: AssetClass
     take_profit_percentage: Optional[float] = None
     stop_loss_percentage: Optional[float] = None
+    trailing_stop_percentage: Optional[float] = None
     optimus_enabled: bool
     strategy_type: StrategyType
     visual_strategy_json: Optional[Dict[str, Any]] = None
@@ -1330,6 +1640,30 @@ class NotificationSchema(BaseModel):
     class Config:
         from_attributes = True
 
+
+class PriceAlertCreate(BaseModel):
+    exchange: ExchangeName = ExchangeName.BINANCE
+    symbol: str
+    price: float = Field(..., gt=0)
+    # Inferred from the current price when omitted.
+    direction: Optional[str] = Field(None, pattern="^(above|below)$")
+    note: Optional[str] = Field(None, max_length=200)
+
+
+class PriceAlertSchema(BaseModel):
+    id: PythonUUID
+    exchange: str
+    symbol: str
+    direction: str
+    price: float
+    note: Optional[str] = None
+    is_active: bool
+    created_at: datetime.datetime
+    triggered_at: Optional[datetime.datetime] = None
+
+    class Config:
+        from_attributes = True
+
 class MT5CredentialsCreate(BaseModel):
     account_number: int
     password: str
@@ -1424,6 +1758,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: As
                 bot.is_active = False
                 logger.info(f"Deactivating bot {bot.id} for user {user.id} due to expired subscription.")
             await db.commit()
+            bot_registry.deactivate_user(user.id)
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Your subscription has expired. Please renew to continue using the service."
@@ -1518,9 +1853,15 @@ class AbstractStrategy(abc.ABC):
         self.parameters = parameters;
         self.state = state
         self.ohlcv = None
+        self.features = None  # Optional live FeatureSet shared with other consumers of the stream
 
     def update_data(self, ohlcv: pd.DataFrame): self.ohlcv = ohlcv
 
+    def update_features(self, features: "FeatureSet"):
+        """Live mode: reuse the stream's cached indicators and take a private copy of its frame."""
+        self.features = features
+        self.ohlcv = features.frame()
+
     @abc.abstractmethod
     def generate_signal(self) -> TradingSignal: pass
 
@@ -1564,8 +1905,12 @@ class EmaCrossAtrStrategy(AbstractStrategy):
         short_win = p.get('short_window', 50)
         long_win = p.get('long_window', 200)
         
-        df['ema_fast'] = df['close'].ewm(span=short_win, adjust=False).mean()
-        df['ema_slow'] = df['close'].ewm(span=long_win, adjust=False).mean()
+        if self.features is not None:
+            df['ema_fast'] = self.features.ema(short_win).values
+            df['ema_slow'] = self.features.ema(long_win).values
+        else:
+            df['ema_fast'] = df['close'].ewm(span=short_win, adjust=False).mean()
+            df['ema_slow'] = df['close'].ewm(span=long_win, adjust=False).mean()
         
         if df['ema_fast'].iloc[-1] > df['ema_slow'].iloc[-1] and \
            df['ema_fast'].iloc[-2] <= df['ema_slow'].iloc[-2]:
@@ -1847,15 +2192,24 @@ class OptimizerPortfolioStrategy(AbstractStrategy):
             if not StrategyClass or StrategyClass == OptimizerPortfolioStrategy: continue
             sub_strategy_params = StrategyClass.get_parameter_schema()().model_dump()
             sub_strategy = StrategyClass(self.strategy_id, self.symbol, self.timeframe, sub_strategy_params, {})
-            sub_strategy.update_data(ohlcv_copy)
+            if self.features is not None:
+                sub_strategy.update_features(self.features)
+            else:
+                sub_strategy.update_data(ohlcv_copy)
             signal = sub_strategy.generate_signal()
             if signal.action in ["BUY", "SELL"]: all_signals.append(signal)
         if not all_signals: return TradingSignal("HOLD")
-        master_df = self.ohlcv.copy()
-        # --- MODIFIED LINE: Replaced pta.ema with pandas equivalent ---
-        master_df['long_ema'] = master_df['close'].ewm(span=p.get('trend_filter_period', 200), adjust=False).mean()
-        market_is_uptrend = master_df['close'].iloc[-1] > master_df['long_ema'].iloc[-1]
-        market_is_downtrend = master_df['close'].iloc[-1] < master_df['long_ema'].iloc[-1]
+        if self.features is not None:
+            last_close = self.features.latest.close
+            long_ema = self.features.ema(p.get('trend_filter_period', 200)).iloc[-1]
+        else:
+            master_df = self.ohlcv.copy()
+            # --- MODIFIED LINE: Replaced pta.ema with pandas equivalent ---
+            master_df['long_ema'] = master_df['close'].ewm(span=p.get('trend_filter_period', 200), adjust=False).mean()
+            last_close = master_df['close'].iloc[-1]
+            long_ema = master_df['long_ema'].iloc[-1]
+        market_is_uptrend = last_close > long_ema
+        market_is_downtrend = last_close < long_ema
         buy_signals = [s for s in all_signals if s.action == "BUY"]
         sell_signals = [s for s in all_signals if s.action == "SELL"]
         final_signal = "HOLD"
@@ -2400,8 +2754,17 @@ class BrokerClient(ABC):
 
 # --- 2. The CCXT Adapter ---
 class CcxtClient(BrokerClient):
-    def __init__(self, ccxt_instance: ccxt.Exchange):
+    def __init__(self, ccxt_instance: ccxt.Exchange, release: Optional[Callable[[], None]] = None):
         self._client = ccxt_instance
+        # Set for clients checked out of ExchangeManager's pool: close() hands the client back.
+        self._pooled = release is not None
+        self._release = release
+
+    def __getattr__(self, name):
+        # Anything not wrapped here (create_order, fetch_open_orders, ...) goes straight to ccxt.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._client, name)
 
     async def fetch_ohlcv(self, symbol: str, timeframe: str, limit: int) -> List[List]:
         return await self._client.fetch_ohlcv(symbol, timeframe, limit=limit)
@@ -2413,6 +2776,11 @@ class CcxtClient(BrokerClient):
         return await self._client.fetch_balance()
 
     async def close(self):
+        if self._pooled:
+            if self._release is not None:
+                release, self._release = self._release, None
+                release()
+            return
         await self._client.close()
 
 
@@ -2591,11 +2959,25 @@ class InsufficientFundsError(Exception):
 
 
 class ExchangeManager:
+    # Pooled private clients are closed after this long without a checkout.
+    PRIVATE_IDLE_SECONDS = 300
+    # How long a pooled client is trusted before its API key row is re-checked (other processes may rotate it).
+    KEY_CHECK_SECONDS = 30
+    MARKETS_TTL_SECONDS = 3600
+    SWEEP_INTERVAL_SECONDS = 60
+
     def __init__(self):
         self._public_clients: Dict[str, ccxt.Exchange] = {}
         self._public_lock = asyncio.Lock()
         self.public_data_providers = ['binance', 'kucoin', 'bybit', 'okx']
-        
+        # (user_id, exchange, asset_class, market_type) -> {"client", "version", "in_use", "last_used", "checked_at"}
+        self._private_clients: Dict[Tuple[str, str, str, str], Dict[str, Any]] = {}
+        self._private_locks: Dict[Tuple[str, str, str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+        # (exchange, market_type) -> (markets, currencies, loaded_at), shared by every private client.
+        self._markets: Dict[Tuple[str, str], Tuple[Dict, Dict, float]] = {}
+        self._markets_locks: Dict[Tuple[str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._last_sweep = time.monotonic()
+
         
     async def get_public_client(self, exchange_name: str) -> ccxt.Exchange:
         async with self._public_lock:
@@ -2646,61 +3028,129 @@ class ExchangeManager:
         return None
 
     async def get_private_client(self, user_id: str, exchange_name: str, asset_class: AssetClass,
-                                 market_type: MarketType) -> Optional[BrokerClient]:
+                                 market_type: MarketType = MarketType.SPOT) -> Optional[BrokerClient]:
         """
-        Securely creates a new, authenticated client instance for a specific user.
-        This is the corrected, robust version.
+        Checks an authenticated client for a user out of the pool, creating it on first use or
+        after the user's API key changed. Callers must close() it, which returns it to the pool.
         """
-        private_client_instance = None  # Initialize to None at the start
-        try:
-            async with async_session_maker() as db:
-                api_key_entry = await db.scalar(
-                    select(UserAPIKey).where(
-                        UserAPIKey.user_id == user_id,
-                        UserAPIKey.exchange == exchange_name,
-                        UserAPIKey.asset_class == asset_class.value
+        self._evict_idle()
+        pool_key = (user_id, exchange_name, asset_class.value, market_type.value)
+        async with self._private_locks[pool_key]:
+            entry = self._private_clients.get(pool_key)
+            if entry and time.monotonic() - entry["checked_at"] < self.KEY_CHECK_SECONDS:
+                return self._checkout(entry)
+
+            private_client_instance = None  # Initialize to None at the start
+            try:
+                async with async_session_maker() as db:
+                    api_key_entry = await db.scalar(
+                        select(UserAPIKey).where(
+                            UserAPIKey.user_id == user_id,
+                            UserAPIKey.exchange == exchange_name,
+                            UserAPIKey.asset_class == asset_class.value
+                        )
                     )
-                )
                 if not api_key_entry:
+                    self._retire(pool_key)
                     logger.warning(f"No {asset_class.value} API keys found for user {user_id} on {exchange_name}.")
                     return None
 
+                # The row id is the key version: keys are replaced by deleting and re-adding them.
+                if entry and entry["version"] == api_key_entry.id:
+                    entry["checked_at"] = time.monotonic()
+                    return self._checkout(entry)
+                self._retire(pool_key)
+
                 api_key = user_service.decrypt_data(api_key_entry.api_key_encrypted)
                 secret_key = user_service.decrypt_data(api_key_entry.secret_key_encrypted)
 
-            exchange_class = getattr(ccxt, exchange_name)
+                exchange_class = getattr(ccxt, exchange_name)
 
-            # --- THIS IS THE FIX ---
-            # The 'market_type' parameter is now correctly passed into the function
-            # and used to configure the client.
-            client_config = {
-                'apiKey': api_key,
-                'secret': secret_key,
-                'enableRateLimit': True,
-                'timeout': 20000,
-                'options': {
-                    'defaultType': market_type.value
+                # --- THIS IS THE FIX ---
+                # The 'market_type' parameter is now correctly passed into the function
+                # and used to configure the client.
+                client_config = {
+                    'apiKey': api_key,
+                    'secret': secret_key,
+                    'enableRateLimit': True,
+                    'timeout': 20000,
+                    'options': {
+                        'defaultType': market_type.value
+                    }
                 }
-            }
 
-            private_client_instance = exchange_class(client_config)
+                private_client_instance = exchange_class(client_config)
+                await self._attach_markets(private_client_instance, exchange_name, market_type.value)
 
-            # Load markets to verify the connection and keys are valid.
-            await private_client_instance.load_markets()
+                now = time.monotonic()
+                entry = {"client": private_client_instance, "version": api_key_entry.id, "in_use": 0,
+                         "last_used": now, "checked_at": now}
+                self._private_clients[pool_key] = entry
+                return self._checkout(entry)
 
-            return CcxtClient(private_client_instance)
+            except (ccxt.AuthenticationError, ccxt.InvalidNonce) as e:
+                logger.error(f"Authentication failed for user {user_id} on {exchange_name}: {e}")
+                if private_client_instance:
+                    await private_client_instance.close()
+                return None
+            except Exception as e:
+                # This block now safely handles the client instance
+                if private_client_instance:
+                    await private_client_instance.close()
+                logger.error(f"Failed to create private client for {exchange_name} for user {user_id}: {e}", exc_info=True)
+                return None
 
-        except (ccxt.AuthenticationError, ccxt.InvalidNonce) as e:
-            logger.error(f"Authentication failed for user {user_id} on {exchange_name}: {e}")
-            if private_client_instance:
-                await private_client_instance.close()
-            return None
-        except Exception as e:
-            # This block now safely handles the client instance
-            if private_client_instance:
-                await private_client_instance.close()
-            logger.error(f"Failed to create private client for {exchange_name} for user {user_id}: {e}", exc_info=True)
-            return None
+    async def _attach_markets(self, client: ccxt.Exchange, exchange_name: str, market_type: str):
+        """Gives the client the shared markets/precision table, loading it once per exchange and market type."""
+        cache_key = (exchange_name, market_type)
+        async with self._markets_locks[cache_key]:
+            cached = self._markets.get(cache_key)
+            if cached is None or time.monotonic() - cached[2] > self.MARKETS_TTL_SECONDS:
+                await client.load_markets()
+                self._markets[cache_key] = (client.markets, client.currencies, time.monotonic())
+                return
+        client.set_markets(cached[0], cached[1])
+
+    def _checkout(self, entry: Dict[str, Any]) -> CcxtClient:
+        entry["in_use"] += 1
+        entry["last_used"] = time.monotonic()
+        return CcxtClient(entry["client"], release=lambda: self._release(entry))
+
+    def _release(self, entry: Dict[str, Any]):
+        entry["in_use"] -= 1
+        entry["last_used"] = time.monotonic()
+        if entry.get("retired") and entry["in_use"] <= 0:
+            asyncio.create_task(entry["client"].close())
+
+    def _retire(self, pool_key: Tuple[str, str, str, str]):
+        """Drops a pooled client; it is closed now, or when its last borrower hands it back."""
+        entry = self._private_clients.pop(pool_key, None)
+        if entry is None:
+            return
+        entry["retired"] = True
+        if entry["in_use"] <= 0:
+            asyncio.create_task(entry["client"].close())
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.SWEEP_INTERVAL_SECONDS:
+            return
+        self._last_sweep = now
+        for pool_key, entry in list(self._private_clients.items()):
+            if entry["in_use"] <= 0 and now - entry["last_used"] > self.PRIVATE_IDLE_SECONDS:
+                self._retire(pool_key)
+                self._private_locks.pop(pool_key, None)
+
+    def invalidate_user_clients(self, user_id: str, exchange_name: Optional[str] = None):
+        """Called when a user's API keys change so the next checkout builds a fresh client."""
+        for pool_key in [k for k in self._private_clients if k[0] == user_id and exchange_name in (None, k[1])]:
+            self._retire(pool_key)
+
+    async def close_all_private(self):
+        entries = list(self._private_clients.values())
+        self._private_clients.clear()
+        await asyncio.gather(*(entry["client"].close() for entry in entries), return_exceptions=True)
+        logger.info(f"Closed {len(entries)} pooled private exchange clients.")
 
     async def close_all_public(self):
         logger.info("Public clients are now short-lived and closed individually.")
@@ -2708,6 +3158,410 @@ class ExchangeManager:
 exchange_manager = ExchangeManager()  # New global instance
 
 
+# --- NEW: Order fill tracking ---
+class OrderFillWatcher:
+    """
+    Resolves an order as soon as the exchange reports it filled. Waiters on the same account
+    share one ccxt.pro watch_orders stream, kept open for a minute after the last wait so
+    back-to-back trades reuse it. fetch_order polling with backoff runs alongside: it is the
+    only source on exchanges without an order stream, and a safety net on the others.
+    """
+    TERMINAL_STATUSES = ('closed', 'canceled', 'expired', 'rejected')
+    POLL_INITIAL_DELAY = 0.1
+    POLL_MAX_DELAY = 2.0
+    STREAM_POLL_INITIAL_DELAY = 1.0
+    STREAM_POLL_MAX_DELAY = 5.0
+    STREAM_IDLE_SECONDS = 60.0
+
+    def __init__(self):
+        # id(ccxt client) -> {"exchange", "client", "waiters", "last_used", "task"}
+        self._streams: Dict[int, Dict[str, Any]] = {}
+        self._unsupported: set = set()
+
+    @classmethod
+    def is_final(cls, order: Dict) -> bool:
+        return order.get('status') in cls.TERMINAL_STATUSES
+
+    async def wait_for_fill(self, client: BrokerClient, order: Dict, symbol: str, timeout: float = 30.0) -> Dict:
+        """
+        Returns the order once it reaches a final status. On timeout, returns its latest known
+        state, which callers must check (it may be open or only partly filled).
+        """
+        # Many exchanges answer a market order with its fills already in the response.
+        if self.is_final(order):
+            return order
+        exchange = getattr(client, '_client', client)
+        future = asyncio.get_running_loop().create_future()
+        stream = self._ensure_stream(exchange)
+        if stream is not None:
+            stream["waiters"][order['id']] = future
+        poller = asyncio.create_task(self._poll(exchange, order['id'], symbol, future, stream is not None))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Order {order['id']} on {exchange.id} not final after {timeout}s.")
+            try:
+                return await exchange.fetch_order(order['id'], symbol)
+            except Exception:
+                return order
+        finally:
+            poller.cancel()
+            if stream is not None:
+                stream["waiters"].pop(order['id'], None)
+                stream["last_used"] = time.monotonic()
+
+    async def _poll(self, exchange: ccxt.Exchange, order_id: str, symbol: str, future: asyncio.Future,
+                    streaming: bool):
+        # The first poll is always quick: the stream only starts watching once the order has been
+        # placed, so a fast fill's update has usually gone out already. Later polls on streaming
+        # exchanges are just a safety net and back off from STREAM_POLL_INITIAL_DELAY.
+        delay = self.POLL_INITIAL_DELAY
+        min_delay = self.STREAM_POLL_INITIAL_DELAY if streaming else self.POLL_INITIAL_DELAY
+        max_delay = self.STREAM_POLL_MAX_DELAY if streaming else self.POLL_MAX_DELAY
+        while not future.done():
+            await asyncio.sleep(delay)
+            try:
+                current = await exchange.fetch_order(order_id, symbol)
+                if self.is_final(current) and not future.done():
+                    future.set_result(current)
+            except Exception as e:
+                logger.debug(f"Polling order {order_id} on {exchange.id} failed: {e}")
+            delay = min(max(delay * 2, min_delay), max_delay)
+
+    def _ensure_stream(self, exchange: ccxt.Exchange) -> Optional[Dict[str, Any]]:
+        stream = self._streams.get(id(exchange))
+        if stream is not None and stream["exchange"] is exchange:
+            return stream
+        stream_class = getattr(ccxtpro, exchange.id, None)
+        if stream_class is None or exchange.id in self._unsupported:
+            return None
+        client = stream_class({
+            'apiKey': exchange.apiKey,
+            'secret': exchange.secret,
+            'password': exchange.password,
+            'enableRateLimit': True,
+            'options': {'defaultType': exchange.options.get('defaultType', 'spot')},
+        })
+        if not client.has.get('watchOrders'):
+            self._unsupported.add(exchange.id)
+            return None
+        client.set_markets(exchange.markets, exchange.currencies)
+        stream = {"exchange": exchange, "client": client, "waiters": {}, "last_used": time.monotonic()}
+        stream["task"] = asyncio.create_task(self._run_stream(id(exchange), stream))
+        self._streams[id(exchange)] = stream
+        return stream
+
+    async def _run_stream(self, key: int, stream: Dict[str, Any]):
+        client = stream["client"]
+        attempt = 0
+        try:
+            while stream["waiters"] or time.monotonic() - stream["last_used"] < self.STREAM_IDLE_SECONDS:
+                try:
+                    orders = await asyncio.wait_for(client.watch_orders(), self.STREAM_IDLE_SECONDS)
+                    attempt = 0
+                except asyncio.TimeoutError:
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # The pollers keep resolving fills while the stream is down.
+                    attempt += 1
+                    delay = random.uniform(0, min(StreamConnection.RECONNECT_MAX_DELAY,
+                                                  StreamConnection.RECONNECT_BASE_DELAY * 2 ** attempt))
+                    logger.warning(f"Order stream on {client.id} failed ({e}); retrying in {delay:.1f}s.")
+                    await asyncio.sleep(delay)
+                    continue
+                for order in orders:
+                    future = stream["waiters"].get(order.get('id'))
+                    if future is not None and not future.done() and self.is_final(order):
+                        future.set_result(order)
+        finally:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+            await client.close()
+
+    async def close(self):
+        tasks = [stream["task"] for stream in self._streams.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+order_fill_watcher = OrderFillWatcher()
+
+
+# --- NEW: Per-user account state cache ---
+class AccountStateCache:
+    """
+    In-memory balances and open positions per exchange account, and last prices per symbol.
+    Sizing and the portfolio read from here instead of calling the exchange on every trade or
+    page view. Fills update an account immediately; a background loop re-fetches the balances
+    of recently used accounts so reads stay in memory, and drops accounts nobody reads.
+    """
+    BALANCE_TTL_SECONDS = 60.0
+    POSITION_TTL_SECONDS = 15.0
+    PRICE_TTL_SECONDS = 10.0
+    RECONCILE_INTERVAL_SECONDS = 30.0
+    ACTIVE_WINDOW_SECONDS = 600.0
+
+    def __init__(self):
+        # (user_id, exchange, asset_class, market_type) -> {"balance", "balance_at", "positions", "read_at"}
+        self._accounts: Dict[Tuple[str, str, str, str], Dict[str, Any]] = {}
+        self._locks: Dict[Tuple[str, str, str, str], asyncio.Lock] = defaultdict(asyncio.Lock)
+        # "exchange:symbol" -> (price, monotonic time), for symbols without a live stream
+        self._prices: Dict[str, Tuple[Decimal, float]] = {}
+
+    @staticmethod
+    def account_key(user_id: str, exchange: str, asset_class: Any, market_type: Any) -> Tuple[str, str, str, str]:
+        return (user_id, exchange, getattr(asset_class, 'value', asset_class), getattr(market_type, 'value', market_type))
+
+    @classmethod
+    def bot_account_key(cls, bot: TradingBot) -> Tuple[str, str, str, str]:
+        return cls.account_key(bot.owner_id, bot.exchange, bot.asset_class, bot.market_type)
+
+    def _account(self, key: Tuple[str, str, str, str]) -> Dict[str, Any]:
+        account = self._accounts.get(key)
+        if account is None:
+            account = self._accounts[key] = {"balance": None, "balance_at": 0.0, "positions": {}, "read_at": 0.0}
+        account["read_at"] = time.monotonic()
+        return account
+
+    async def _with_client(self, key: Tuple[str, str, str, str], client: Optional[BrokerClient], fetch):
+        if client is not None:
+            return await fetch(client)
+        user_id, exchange, asset_class, market_type = key
+        client = await exchange_manager.get_private_client(user_id, exchange, AssetClass(asset_class), MarketType(market_type))
+        if not client:
+            raise ConnectionError(f"Could not connect to {exchange}. Check API keys.")
+        try:
+            return await fetch(client)
+        finally:
+            await client.close()
+
+    async def get_balance(self, key: Tuple[str, str, str, str], client: Optional[BrokerClient] = None) -> Dict[str, Dict]:
+        """ccxt-style {"free", "used", "total"} balances; only goes to the exchange when the cache is stale."""
+        account = self._account(key)
+        if account["balance"] is None or time.monotonic() - account["balance_at"] > self.BALANCE_TTL_SECONDS:
+            async with self._locks[key]:
+                # Another caller may have refreshed it while we waited.
+                if account["balance"] is None or time.monotonic() - account["balance_at"] > self.BALANCE_TTL_SECONDS:
+                    await self._refresh_balance(key, client)
+        return account["balance"]
+
+    async def _refresh_balance(self, key: Tuple[str, str, str, str], client: Optional[BrokerClient] = None):
+        balance = await self._with_client(key, client, lambda c: c.fetch_balance())
+        account = self._account(key)
+        account["balance"] = {part: dict(balance.get(part) or {}) for part in ('free', 'used', 'total')}
+        account["balance_at"] = time.monotonic()
+
+    async def get_positions(self, key: Tuple[str, str, str, str], symbol: str,
+                            client: Optional[BrokerClient] = None) -> List[Dict]:
+        account = self._account(key)
+        cached = account["positions"].get(symbol)
+        if cached is None or time.monotonic() - cached[1] > self.POSITION_TTL_SECONDS:
+            positions = await self._with_client(key, client, lambda c: c.fetch_positions([symbol]))
+            self.set_positions(key, symbol, positions)
+            return positions
+        return cached[0]
+
+    def set_positions(self, key: Tuple[str, str, str, str], symbol: str, positions: List[Dict]):
+        self._account(key)["positions"][symbol] = (positions, time.monotonic())
+
+    async def get_price(self, exchange: str, symbol: str, client: Optional[BrokerClient] = None) -> Decimal:
+        """The latest close from the live stream, else a ticker that is at most PRICE_TTL_SECONDS old."""
+        candle = market_streamer.get_last_candle(symbol, exchange)
+        if candle is not None and time.time() * 1000 - candle.timestamp < (60 + self.PRICE_TTL_SECONDS) * 1000:
+            return Decimal(str(candle.close))
+        price_key = f"{exchange}:{symbol}".lower()
+        cached = self._prices.get(price_key)
+        if cached is not None and time.monotonic() - cached[1] < self.PRICE_TTL_SECONDS:
+            return cached[0]
+        source = client if client is not None else await exchange_manager.get_public_client(exchange)
+        ticker = await source.fetch_ticker(symbol)
+        price = Decimal(str(ticker['last']))
+        self._prices[price_key] = (price, time.monotonic())
+        return price
+
+    def on_fill(self, key: Tuple[str, str, str, str], symbol: str, order: Dict):
+        """Applies a spot fill to the cached balances; anything else just marks them for a refresh."""
+        account = self._account(key)
+        balance = account["balance"]
+        filled = float(order.get('filled') or 0)
+        if balance is None or key[3] != MarketType.SPOT.value or filled <= 0:
+            account["balance_at"] = 0.0
+            return
+        base, quote = symbol.split(':')[0].split('/')
+        cost = float(order.get('cost') or filled * float(order.get('average') or order.get('price') or 0))
+        sign = 1 if order.get('side') == 'buy' else -1
+        for part in ('free', 'total'):
+            balance[part][base] = (balance[part].get(base) or 0) + sign * filled
+            balance[part][quote] = (balance[part].get(quote) or 0) - sign * cost
+            fee = order.get('fee') or {}
+            if fee.get('cost') and fee.get('currency'):
+                balance[part][fee['currency']] = (balance[part].get(fee['currency']) or 0) - float(fee['cost'])
+
+    async def run_reconciliation_loop(self):
+        """Keeps recently read accounts fresh in the background and forgets idle ones."""
+        while True:
+            await asyncio.sleep(self.RECONCILE_INTERVAL_SECONDS)
+            now = time.monotonic()
+            for key, account in list(self._accounts.items()):
+                if now - account["read_at"] > self.ACTIVE_WINDOW_SECONDS:
+                    del self._accounts[key]
+                    self._locks.pop(key, None)
+                    continue
+                if account["balance"] is None or now - account["balance_at"] < self.RECONCILE_INTERVAL_SECONDS:
+                    continue
+                try:
+                    async with self._locks[key]:
+                        await self._refresh_balance(key)
+                except Exception as e:
+                    logger.warning(f"Balance reconciliation failed for {key[0]} on {key[1]}: {e}")
+            for price_key, (_, fetched_at) in list(self._prices.items()):
+                if now - fetched_at > self.ACTIVE_WINDOW_SECONDS:
+                    del self._prices[price_key]
+
+
+account_state_cache = AccountStateCache()
+
+
+# --- NEW: Real-time Exposure Book ---
+class ExposureBook:
+    """
+    Net position per bot, rolled up per user and asset, updated in-process by every fill
+    (paper, custodial, non-custodial and MT5). `check` answers pre-trade limit questions from
+    these in-memory totals, so ten bots stacking the same asset are caught without a REST call.
+    Positions stored on the bots are reloaded every RECONCILE_INTERVAL_SECONDS, which also picks
+    up fills booked by other processes. Paper and live exposure are kept apart.
+    """
+    RECONCILE_INTERVAL_SECONDS = 30
+    MT5_LOT_SIZE = 100_000  # Units per standard lot; MT5 volumes are booked in units
+    EPSILON = 1e-12
+
+    def __init__(self):
+        self.max_asset_usd = settings.RISK_MAX_ASSET_EXPOSURE_USD
+        self.max_user_usd = settings.RISK_MAX_USER_EXPOSURE_USD
+        # bot_id -> (user_id, paper, asset, signed quantity)
+        self._bots: Dict[str, Tuple[str, bool, str, float]] = {}
+        # (user_id, paper) -> {asset: net signed quantity}
+        self._assets: Dict[Tuple[str, bool], Dict[str, float]] = defaultdict(dict)
+        self._prices: Dict[str, float] = {}  # asset -> last known USD price
+        # Bots whose fills may not be in the database yet, and bots that never store a position there
+        self._filled_at: Dict[str, float] = {}
+        self._unpersisted: set = set()
+        self.rejections = 0
+
+    @staticmethod
+    def asset_of(symbol: str) -> str:
+        return symbol.split('/')[0].upper()
+
+    def _set(self, bot_id: str, user_id: str, paper: bool, asset: str, quantity: float):
+        previous = self._bots.pop(bot_id, None)
+        if previous is not None:
+            prev_user, prev_paper, prev_asset, prev_quantity = previous
+            book = self._assets[(prev_user, prev_paper)]
+            net = book.get(prev_asset, 0.0) - prev_quantity
+            if abs(net) > self.EPSILON:
+                book[prev_asset] = net
+            else:
+                book.pop(prev_asset, None)
+        if abs(quantity) > self.EPSILON:
+            self._bots[bot_id] = (user_id, paper, asset, quantity)
+            book = self._assets[(user_id, paper)]
+            book[asset] = book.get(asset, 0.0) + quantity
+
+    def on_fill(self, user_id: str, bot_id: Any, symbol: str, side: str, amount: float, price: Optional[float],
+                paper: bool = False, persisted: bool = True):
+        """Books a fill. `persisted=False` for venues whose positions aren't stored on the bot (MT5)."""
+        bot_id, asset = str(bot_id), self.asset_of(symbol)
+        if price:
+            self._prices[asset] = float(price)
+        current = self._bots.get(bot_id)
+        quantity = current[3] if current else 0.0
+        delta = float(amount) if side == 'buy' else -float(amount)
+        self._set(bot_id, user_id, paper, asset, quantity + delta)
+        self._filled_at[bot_id] = time.monotonic()
+        if not persisted:
+            self._unpersisted.add(bot_id)
+
+    def check(self, user_id: str, symbol: str, side: str, amount: float, price: Any,
+              paper: bool = False) -> Optional[str]:
+        """None if the order fits the limits, else why it doesn't. Orders that shrink exposure always pass."""
+        asset, price = self.asset_of(symbol), float(price)
+        if price > 0:
+            self._prices[asset] = price
+        book = self._assets.get((user_id, paper), {})
+        net = book.get(asset, 0.0)
+        new_net = net + (float(amount) if side == 'buy' else -float(amount))
+        if abs(new_net) <= abs(net):
+            return None
+        asset_usd = abs(new_net) * price
+        if self.max_asset_usd and asset_usd > self.max_asset_usd:
+            self.rejections += 1
+            return f"{asset} exposure would reach ${asset_usd:,.0f} (limit ${self.max_asset_usd:,.0f})."
+        if self.max_user_usd:
+            total_usd = asset_usd + sum(abs(q) * self._prices.get(a, 0.0) for a, q in book.items() if a != asset)
+            if total_usd > self.max_user_usd:
+                self.rejections += 1
+                return f"total exposure would reach ${total_usd:,.0f} (limit ${self.max_user_usd:,.0f})."
+        return None
+
+    async def load(self):
+        """Replaces the book's view of every bot with the position stored on it."""
+        started = time.monotonic()
+        async with async_session_maker() as db:
+            rows = (await db.execute(select(
+                TradingBot.id, TradingBot.owner_id, TradingBot.symbol, TradingBot.is_paper_trading,
+                TradingBot.active_position_amount, TradingBot.active_position_entry_price
+            ).where(TradingBot.active_position_amount.is_not(None)))).all()
+        # Fills newer than the last reconcile may not be flushed to the database yet.
+        fresh = {bot_id for bot_id, at in self._filled_at.items() if started - at < self.RECONCILE_INTERVAL_SECONDS}
+        stored = set()
+        for bot_id, user_id, symbol, paper, amount, entry_price in rows:
+            bot_id, asset = str(bot_id), self.asset_of(symbol)
+            stored.add(bot_id)
+            if entry_price:
+                self._prices.setdefault(asset, float(entry_price))
+            if bot_id not in fresh:
+                self._set(bot_id, user_id, bool(paper), asset, float(amount))
+        for bot_id in [b for b in self._bots if b not in stored and b not in fresh and b not in self._unpersisted]:
+            user_id, paper, asset, _ = self._bots[bot_id]
+            self._set(bot_id, user_id, paper, asset, 0.0)
+        for bot_id in [b for b, at in self._filled_at.items() if b not in fresh]:
+            del self._filled_at[bot_id]
+
+    async def run_reconciliation_loop(self):
+        while True:
+            try:
+                await self.load()
+            except Exception as e:
+                logger.warning(f"Exposure book reconciliation failed: {e}")
+            await asyncio.sleep(self.RECONCILE_INTERVAL_SECONDS)
+
+    def get_user_exposure(self, user_id: str) -> Dict[str, Any]:
+        summary: Dict[str, Any] = {}
+        for paper in (False, True):
+            assets = {asset: {"net_quantity": quantity, "price_usd": self._prices.get(asset),
+                              "exposure_usd": abs(quantity) * self._prices.get(asset, 0.0)}
+                      for asset, quantity in self._assets.get((user_id, paper), {}).items()}
+            summary["paper" if paper else "live"] = {
+                "assets": assets, "total_exposure_usd": sum(a["exposure_usd"] for a in assets.values())}
+        summary["bots"] = [{"bot_id": bot_id, "paper": paper, "asset": asset, "net_quantity": quantity}
+                           for bot_id, (owner, paper, asset, quantity) in self._bots.items() if owner == user_id]
+        summary["limits"] = {"max_asset_exposure_usd": self.max_asset_usd, "max_user_exposure_usd": self.max_user_usd}
+        return summary
+
+    def get_stats(self, top: int = 20) -> Dict[str, Any]:
+        totals = [(user_id, sum(abs(q) * self._prices.get(a, 0.0) for a, q in book.items()))
+                  for (user_id, paper), book in self._assets.items() if not paper and book]
+        totals.sort(key=lambda item: item[1], reverse=True)
+        return {"bots_with_positions": len(self._bots), "rejections": self.rejections,
+                "top_live_exposure": [{"user_id": user_id, "exposure_usd": usd} for user_id, usd in totals[:top]]}
+
+
+exposure_book = ExposureBook()
+
+
 class WalletService:
     async def get_or_create_wallet(self, db: AsyncSession, user_id: str, asset: str) -> Wallet:
         """Retrieves a user's wallet for a specific asset, creating it if it doesn't exist."""
@@ -3031,6 +3885,29 @@ class PaystackService:
 paystack_service = PaystackService(settings)
 
 
+# --- NEW: Shared rate limiter (Telegram outbox, bot restarts) ---
+class TokenBucket:
+    """`acquire` waits for a token; tokens refill at `rate` per second up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
 # --- NEW: Telegram Service ---
 class TelegramService:
     def __init__(self, token: str):
@@ -3089,6 +3966,7 @@ class TelegramService:
                         user.telegram_chat_id = str(update.effective_chat.id)
                         await db.commit()
                         del self.linking_codes[code]
+                        telegram_outbox.forget_chat_id(user_id)
                         await update.message.reply_text(
                             "✅ Success! Your Telegram account is now linked. You will receive trading notifications here.")
                         return
@@ -3133,10 +4011,8 @@ class TelegramService:
             logger.error(f"Failed to send Telegram message to {chat_id}: {e}")
 
     async def notify_user(self, user_id: str, message: str):
-        async with async_session_maker() as db:
-            user = await db.get(User, user_id)
-            if user and user.telegram_chat_id:
-                await self.send_message(user.telegram_chat_id, message)
+        """Queues the message in the outbox; it is sent in the background, rate limited and retried."""
+        telegram_outbox.enqueue(user_id, message)
 
     async def run_polling(self):
         """
@@ -3169,6 +4045,36 @@ class TelegramService:
                 await self.application.shutdown()
             logger.info("Telegram bot polling has stopped.")
 
+    async def run_webhook(self):
+        """
+        Webhook alternative to `run_polling`: registers TELEGRAM_WEBHOOK_URL with Telegram and
+        processes the updates posted to /api/integrations/telegram/webhook until cancelled.
+        """
+        if not self.application:
+            return
+
+        logger.info("Telegram bot webhook is starting...")
+        try:
+            await self.application.initialize()
+            await self.application.start()
+            await self.application.bot.set_webhook(url=settings.TELEGRAM_WEBHOOK_URL,
+                                                   secret_token=settings.TELEGRAM_WEBHOOK_SECRET,
+                                                   allowed_updates=Update.ALL_TYPES)
+            while True:
+                await asyncio.sleep(3600)
+        except asyncio.CancelledError:
+            logger.info("Telegram webhook task is being cancelled.")
+        finally:
+            if self.application and self.application.running:
+                await self.application.stop()
+                await self.application.shutdown()
+            logger.info("Telegram bot webhook has stopped.")
+
+    async def process_webhook_update(self, data: Dict[str, Any]):
+        if not self.application or not self.application.running:
+            return
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+
     async def stop_polling(self):
         if self.application.updater and self.application.updater.is_running:
             await self.application.updater.stop()
@@ -3180,6 +4086,224 @@ class TelegramService:
 telegram_service = TelegramService(settings.TELEGRAM_BOT_TOKEN)
 
 
+class TelegramOutbox:
+    """
+    Delivers Telegram notifications without blocking the caller. Messages are buffered, resolved
+    to chat ids through a short-lived cache and written to telegram_outbox in bulk. The dispatcher
+    claims due rows, joins those bound for the same chat into one message and sends under a global
+    token bucket, retrying failures with exponential backoff. Every process may enqueue and
+    dispatch; rows are claimed with a conditional update, so nothing is sent twice.
+    """
+    FLUSH_INTERVAL = 1.0
+    POLL_INTERVAL = 1.0
+    CHAT_ID_TTL_SECONDS = 120
+    CLAIM_SECONDS = 60
+    BATCH_SIZE = 200
+    MAX_ATTEMPTS = 6
+    MAX_MESSAGE_LENGTH = 4096
+    PER_CHAT_INTERVAL = 1.0  # Telegram allows about one message per second to a single chat
+
+    def __init__(self, service: TelegramService):
+        self.service = service
+        self.bucket = TokenBucket(settings.TELEGRAM_SEND_RATE, settings.TELEGRAM_SEND_RATE)
+        self.worker_id = uuid4().hex
+        self._buffer: List[Tuple[str, str]] = []  # (user_id, text)
+        self._chat_ids: Dict[str, Tuple[Optional[str], float]] = {}  # user_id -> (chat_id, cached at)
+        self._chat_sent_at: Dict[str, float] = {}
+        self._paused_until = 0.0
+        self._flush_task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, user_id: str, text: str):
+        self._buffer.append((user_id, text))
+        self._ensure_flusher()
+
+    def forget_chat_id(self, user_id: str):
+        self._chat_ids.pop(user_id, None)
+
+    def _ensure_flusher(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        try:
+            while self._buffer:
+                await asyncio.sleep(self.FLUSH_INTERVAL)
+                await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def _resolve_chat_ids(self, user_ids: set) -> Dict[str, Optional[str]]:
+        now = time.monotonic()
+        resolved: Dict[str, Optional[str]] = {}
+        missing = []
+        for user_id in user_ids:
+            cached = self._chat_ids.get(user_id)
+            if cached and now - cached[1] < self.CHAT_ID_TTL_SECONDS:
+                resolved[user_id] = cached[0]
+            else:
+                missing.append(user_id)
+        if missing:
+            async with async_session_maker() as db:
+                found = dict((await db.execute(select(User.id, User.telegram_chat_id)
+                                               .where(User.id.in_(missing)))).all())
+            for user_id in missing:
+                resolved[user_id] = found.get(user_id)
+                self._chat_ids[user_id] = (resolved[user_id], now)
+        return resolved
+
+    async def flush(self):
+        buffer, self._buffer = self._buffer, []
+        if not buffer:
+            return
+        try:
+            chat_ids = await self._resolve_chat_ids({user_id for user_id, _ in buffer})
+            now = datetime.datetime.now(datetime.timezone.utc)
+            rows = [{"chat_id": chat_ids[user_id], "text": text, "status": "pending", "attempts": 0,
+                     "next_attempt_at": now} for user_id, text in buffer if chat_ids.get(user_id)]
+            if rows:
+                async with async_session_maker() as db:
+                    await db.execute(insert(TelegramOutboxMessage), rows)
+                    await db.commit()
+        except Exception as e:
+            logger.error(f"Telegram outbox flush failed ({len(buffer)} messages); retrying next interval: {e}")
+            self._buffer[:0] = buffer
+            self._ensure_flusher()
+
+    async def run_dispatcher(self):
+        if not self.service.application:
+            return
+        logger.info(f"Telegram outbox dispatcher {self.worker_id} started.")
+        while True:
+            try:
+                dispatched = await self._dispatch_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Telegram outbox dispatch failed: {e}")
+                dispatched = 0
+            if not dispatched:
+                await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _claim_due(self) -> List[TelegramOutboxMessage]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        due = (TelegramOutboxMessage.status.in_(("pending", "sending")), TelegramOutboxMessage.next_attempt_at <= now)
+        async with async_session_maker() as db:
+            ids = (await db.scalars(select(TelegramOutboxMessage.id).where(*due)
+                                    .order_by(TelegramOutboxMessage.id).limit(self.BATCH_SIZE))).all()
+            if not ids:
+                return []
+            # A row another dispatcher claimed first no longer matches `due`; "sending" rows whose
+            # claim expired (their dispatcher died) are due again.
+            await db.execute(update(TelegramOutboxMessage).where(TelegramOutboxMessage.id.in_(ids), *due).values(
+                status="sending", claimed_by=self.worker_id,
+                next_attempt_at=now + datetime.timedelta(seconds=self.CLAIM_SECONDS)))
+            await db.commit()
+            return (await db.scalars(select(TelegramOutboxMessage).where(
+                TelegramOutboxMessage.id.in_(ids), TelegramOutboxMessage.status == "sending",
+                TelegramOutboxMessage.claimed_by == self.worker_id).order_by(TelegramOutboxMessage.id))).all()
+
+    async def _dispatch_due(self) -> int:
+        if time.monotonic() < self._paused_until:
+            return 0
+        rows = await self._claim_due()
+        if not rows:
+            return 0
+
+        by_chat: Dict[str, List[TelegramOutboxMessage]] = defaultdict(list)
+        for row in rows:
+            by_chat[row.chat_id].append(row)
+
+        # One message per chat per pass: as many queued messages as fit, the rest wait their turn.
+        batches, deferred = [], {}
+        now = time.monotonic()
+        for chat_id, chat_rows in by_chat.items():
+            wait = self._chat_sent_at.get(chat_id, float('-inf')) + self.PER_CHAT_INTERVAL - now
+            if wait > 0:
+                deferred[wait] = deferred.get(wait, []) + chat_rows
+                continue
+            batch, length = [], 0
+            for row in chat_rows:
+                if batch and length + len(row.text) + 2 > self.MAX_MESSAGE_LENGTH:
+                    break
+                batch.append(row)
+                length += len(row.text) + 2
+            batches.append((chat_id, batch))
+            if len(batch) < len(chat_rows):
+                deferred.setdefault(self.PER_CHAT_INTERVAL, []).extend(chat_rows[len(batch):])
+
+        outcomes = await asyncio.gather(*(self._send(chat_id, batch) for chat_id, batch in batches))
+
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        async with async_session_maker() as db:
+            for (chat_id, batch), (outcome, delay) in zip(batches, outcomes):
+                ids = [row.id for row in batch]
+                if outcome == "sent":
+                    await db.execute(delete(TelegramOutboxMessage).where(TelegramOutboxMessage.id.in_(ids)))
+                    continue
+                attempts = max(row.attempts for row in batch) + (outcome == "retry")
+                failed = outcome == "failed" or attempts >= self.MAX_ATTEMPTS
+                if failed:
+                    self.failed += len(batch)
+                    logger.warning(f"Dropping {len(batch)} Telegram message(s) to chat {chat_id} after {attempts} attempts.")
+                await db.execute(update(TelegramOutboxMessage).where(TelegramOutboxMessage.id.in_(ids)).values(
+                    status="failed" if failed else "pending", attempts=attempts,
+                    next_attempt_at=now_utc + datetime.timedelta(seconds=delay)))
+            for delay, chat_rows in deferred.items():
+                await db.execute(update(TelegramOutboxMessage).where(
+                    TelegramOutboxMessage.id.in_([row.id for row in chat_rows])).values(
+                    status="pending", next_attempt_at=now_utc + datetime.timedelta(seconds=delay)))
+            await db.commit()
+        return len(batches)
+
+    async def _send(self, chat_id: str, batch: List[TelegramOutboxMessage]) -> Tuple[str, float]:
+        """Returns ("sent" | "retry" | "failed" | "throttled", seconds until the next attempt)."""
+        text = "\n\n".join(row.text for row in batch)
+        bot = self.service.application.bot
+        try:
+            await self.bucket.acquire()
+            self._chat_sent_at[chat_id] = time.monotonic()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+            except BadRequest as e:
+                if "parse entities" not in str(e).lower():
+                    raise
+                # Unbalanced markup in one of the joined messages; plain text still gets through.
+                await bot.send_message(chat_id=chat_id, text=text)
+            self.sent += len(batch)
+            return "sent", 0
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            delay = retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else float(retry_after)
+            logger.warning(f"Telegram flood control: pausing the outbox for {delay:.0f}s.")
+            self._paused_until = time.monotonic() + delay
+            return "throttled", delay
+        except Forbidden:
+            # The user blocked the bot or deleted the chat.
+            for user_id, (cached_chat_id, _) in list(self._chat_ids.items()):
+                if cached_chat_id == chat_id:
+                    self.forget_chat_id(user_id)
+            return "failed", 0
+        except BadRequest as e:
+            logger.error(f"Telegram rejected a message to chat {chat_id}: {e}")
+            return "failed", 0
+        except Exception as e:
+            attempts = max(row.attempts for row in batch) + 1
+            delay = min(2 ** attempts, 300)
+            logger.warning(f"Telegram send to chat {chat_id} failed (attempt {attempts}); retrying in {delay}s: {e}")
+            return "retry", delay
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+
+telegram_outbox = TelegramOutbox(telegram_service)
+
+
 
 
 
@@ -3264,8 +4388,7 @@ class TradingService:
         investment_usd = Decimal(
             str(params.get("amount_usd"))) if "amount_usd" in params else self.get_dynamic_investment_usd(user)
         try:
-            ticker = await exchange.fetch_ticker(bot.symbol)
-            price = Decimal(str(ticker['last']))
+            price = await account_state_cache.get_price(bot.exchange, bot.symbol, exchange)
             return investment_usd / price if price > 0 else Decimal(0)
         except Exception as e:
             logger.error(f"Failed to fetch price for fixed amount sizing: {e}")
@@ -3280,14 +4403,13 @@ class TradingService:
             return Decimal(0)
 
         try:
-            balance = await exchange.fetch_balance()
+            balance = await account_state_cache.get_balance(account_state_cache.bot_account_key(bot), exchange)
             quote_currency = bot.symbol.split('/')[1]
             total_value_quote = Decimal(str(balance['total'][quote_currency]))
 
             risk_amount_quote = total_value_quote * risk_percentage
 
-            ticker = await exchange.fetch_ticker(bot.symbol)
-            price = Decimal(str(ticker['last']))
+            price = await account_state_cache.get_price(bot.exchange, bot.symbol, exchange)
 
             # How much do we lose per unit of the base asset if SL is hit?
             stop_loss_decimal = Decimal(str(bot.stop_loss_percentage)) / 100
@@ -3308,19 +4430,15 @@ class TradingService:
         risk_percentage = Decimal(str(params.get("risk_percentage", 1.0))) / 100
 
         try:
-            # Fetch recent candles to calculate ATR
-            ohlcv = await exchange.fetch_ohlcv(bot.symbol, '1h', limit=20)
-            df = pd.DataFrame(ohlcv, columns=['timestamp', 'open', 'high', 'low', 'close', 'volume'])
-            df['tr'] = np.maximum(df['high'] - df['low'],
-                                  np.maximum(abs(df['high'] - df['close'].shift()),
-                                             abs(df['low'] - df['close'].shift())))
-            atr = df['tr'].rolling(window=14).mean().iloc[-1]
+            # ATR comes from the shared feature store; it only hits REST once per new 1h candle.
+            features = await feature_store.get_fresh(bot.exchange, bot.symbol, '1h', min_candles=20)
+            atr = features.atr(14).iloc[-1]
 
-            if atr <= 0:
+            if pd.isna(atr) or atr <= 0:
                 logger.warning(f"ATR is zero for {bot.symbol}, cannot calculate size.")
                 return Decimal(0)
 
-            balance = await exchange.fetch_balance()
+            balance = await account_state_cache.get_balance(account_state_cache.bot_account_key(bot), exchange)
             quote_currency = bot.symbol.split('/')[1]
             total_value_quote = Decimal(str(balance['total'][quote_currency]))
 
@@ -3386,8 +4504,21 @@ class TradingService:
                                                              TransactionType.TRADE,
                                                              notes=f"Bot Trade SELL {bot.symbol}")
                         # Notify user of successful trade
+                    position_bot = await db.get(TradingBot, bot.id)
+                    if position_bot:
+                        if side == 'buy':
+                            position_bot.active_position_entry_price = float(price)
+                            position_bot.active_position_amount = float(amount_to_trade_base)
+                        else:
+                            position_bot.active_position_entry_price = None
+                            position_bot.active_position_amount = None
+                    exposure_book.on_fill(user.id, bot.id, bot.symbol, side, float(amount_to_trade_base), float(price))
+                    if side == 'buy':
+                        stop_engine.arm(user, bot, float(price))
+                    else:
+                        stop_engine.disarm(bot.id)
                     msg = f"✅ *Internal Trade Executed*\nBot: `{bot.name}`\n{side.upper()} `{amount_to_trade_base:.6f}` `{base_asset}` at `~${price:.2f}`"
-                    send_telegram_notification_task.delay(user_id=user.id, message=msg)
+                    await telegram_service.notify_user(user.id, msg)
                     # In production, the platform must now hedge this exposure on its omnibus account.
                     # This would be a call to a separate hedging service.
                 except InsufficientFundsError as e:
@@ -3454,9 +4585,7 @@ class TradingService:
             db.add(bot);
             await db.commit()
         except ccxt.NetworkError as e:
-            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id),
-                                                           "message": "A temporary network error occurred. Will retry."},
-                                                          user.id)
+            bot_log_bus.emit(user.id, str(bot.id), "A temporary network error occurred. Will retry.")
         except Exception as e:
             logger.error(f"Unexpected external trading error for bot {bot.id}: {e}", exc_info=True)
             bot.is_active = False;
@@ -3492,309 +4621,1099 @@ class TradingService:
 trading_service = TradingService()
 
 
+# --- NEW: MT5 Gateway request scheduling ---
+class MT5Job(NamedTuple):
+    login: int
+    fn: Callable[[], Any]
+    future: asyncio.Future
+
+
 class MT5GatewayService:
+    """
+    All terminal work runs on one dedicated thread (the MetaTrader5 package isn't thread-safe)
+    and is scheduled from priority lanes: trades, then account queries, then history. Within a
+    lane, requests for the account the terminal is logged into go first, so an account switch is
+    paid once per group instead of once per call; MAX_STREAK_PER_LOGIN keeps other accounts from
+    starving. Identical history requests in flight share one fetch, and terminal health is
+    re-checked at most every HEALTH_CHECK_SECONDS rather than before every call.
+    """
+    TRADE, ACCOUNT, HISTORY = 0, 1, 2
+    HEALTH_CHECK_SECONDS = 15
+    MAX_STREAK_PER_LOGIN = 20
+
     def __init__(self):
-        self._is_connected = False
-        self._lock = asyncio.Lock()
-        # --- THIS IS THE KEY CHANGE ---
-        # This will store the last successful credentials.
-        self._connection_info: Dict[str, Any] = {}
+        # login -> credentials of every account connected through the gateway
+        self._accounts: Dict[int, Dict[str, Any]] = {}
+        self._default_login: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mt5")
+        self._lanes: List[deque] = [deque(), deque(), deque()]
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._worker_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Touched only on the MT5 thread
+        self._initialized = False
+        self._current_login: Optional[int] = None
+        self._checked_at = 0.0
+        # Scheduler position
+        self._scheduled_login: Optional[int] = None
+        self._streak = 0
         logger.info("MT5 Gateway Service initialized.")
 
-    async def _run_in_thread(self, func, *args, **kwargs):
-        return await asyncio.to_thread(func, *args, **kwargs)
-
-    async def connect_and_login(self, login: int, password: str, server: str) -> bool:
-        """
-        Establishes a connection. This is now the ONLY public method to change the connection state.
-        """
-        async with self._lock:
-            # If already connected, disconnect first to ensure a fresh login
-            if self._is_connected:
-                await self._run_in_thread(mt5.shutdown)
-                self._is_connected = False
-
-            def _connect():
-                if not mt5.initialize():
-                    logger.error(f"MT5 initialize() failed: {mt5.last_error()}")
-                    mt5.shutdown()
-                    return False
-                if not mt5.login(login=login, password=password, server=server):
-                    logger.error(f"MT5 login failed for account {login}: {mt5.last_error()}")
-                    mt5.shutdown()
-                    return False
-                return True
-
-            success = await self._run_in_thread(_connect)
+    @property
+    def _is_connected(self) -> bool:
+        return self._current_login is not None
+
+    # --- Scheduling ---
+    def _submit(self, lane: int, login: int, fn: Callable[[], Any], key: Optional[tuple] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(MT5Job(login, fn, future))
+        if key is not None:
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        if self._worker_task is None or self._worker_task.done():
+            self._wakeup = asyncio.Event()
+            self._worker_task = asyncio.create_task(self._run_worker())
+        self._wakeup.set()
+        return future
+
+    def _next_job(self) -> Optional[MT5Job]:
+        for lane in self._lanes:
+            if not lane:
+                continue
+            job = None
+            if self._streak < self.MAX_STREAK_PER_LOGIN:
+                job = next((j for j in lane if j.login == self._scheduled_login), None)
+            if job is not None:
+                lane.remove(job)
+            else:
+                job = lane.popleft()
+            self._streak = self._streak + 1 if job.login == self._scheduled_login else 1
+            self._scheduled_login = job.login
+            return job
+        return None
 
-            if success:
-                self._is_connected = True
-                # Persist the successful credentials for automatic reconnection
-                self._connection_info = {"login": login, "password": password, "server": server}
-                logger.info(f"MT5 Gateway successfully connected and logged into account {login}.")
+    async def _run_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if job.future.done():  # Caller gave up
+                continue
+            try:
+                result = await loop.run_in_executor(self._executor, self._run_job, job)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
             else:
-                self._is_connected = False
-                self._connection_info = {}  # Clear credentials on failure
+                if not job.future.done():
+                    job.future.set_result(result)
 
-            return success
+    # --- MT5 thread ---
+    def _run_job(self, job: MT5Job):
+        self._ensure_session(job.login)
+        try:
+            return job.fn()
+        except Exception:
+            self._checked_at = 0.0  # Re-verify the terminal before the next request
+            raise
 
-    async def shutdown(self):
-        async with self._lock:
-            if self._is_connected:
-                await self._run_in_thread(mt5.shutdown)
-                self._is_connected = False
-                # We keep _connection_info so it can reconnect later if needed
-                logger.info("MT5 Gateway connection has been shut down.")
+    def _ensure_session(self, login: int, force: bool = False):
+        now = time.monotonic()
+        if not force and self._current_login == login:
+            if now - self._checked_at < self.HEALTH_CHECK_SECONDS:
+                return
+            account = mt5.account_info() if mt5.terminal_info() else None
+            if account is not None and account.login == login:
+                self._checked_at = now
+                return
+            logger.warning(f"MT5 connection for account {login} is down or unresponsive. Reconnecting...")
+
+        creds = self._accounts.get(login)
+        if not creds:
+            raise ConnectionError(
+                f"MT5 Gateway has no credentials for account {login}. Please connect on the Integrations page.")
+        if not self._initialized or not mt5.terminal_info():
+            if not mt5.initialize():
+                self._current_login = None
+                raise ConnectionError(f"MT5 initialize() failed: {mt5.last_error()}")
+            self._initialized = True
+        # Logging into another account switches the terminal over; no shutdown needed.
+        if not mt5.login(login=login, password=creds["password"], server=creds["server"]):
+            self._current_login = None
+            raise ConnectionError(f"MT5 login failed for account {login}: {mt5.last_error()}")
+        self._current_login = login
+        self._checked_at = now
+        logger.info(f"MT5 Gateway logged into account {login}.")
+
+    def _shutdown_terminal(self):
+        if self._initialized:
+            mt5.shutdown()
+        self._initialized = False
+        self._current_login = None
 
-    async def _ensure_connection(self):
+    def _resolve_login(self, login: Optional[int]) -> int:
+        login = login or self._default_login
+        if login is None:
+            raise ConnectionError(
+                "MT5 Gateway has no credentials to use for reconnection. Please connect on the Integrations page.")
+        return int(login)
+
+    # --- Public API ---
+    async def connect_and_login(self, login: int, password: str, server: str) -> bool:
         """
-        A robust internal method to check and silently re-establish a connection if lost.
-        This is the core of the stability fix.
+        Registers an account and verifies its credentials with a fresh login. Later requests
+        for this account log back in on their own whenever the terminal is elsewhere.
         """
-        # First, do a quick, non-blocking check
-        if self._is_connected and await self._run_in_thread(mt5.terminal_info):
-            return  # Connection is healthy
-
-        # If the check fails or we are not connected, acquire the lock and perform a full reconnect.
-        async with self._lock:
-            # Double-check inside the lock to prevent race conditions
-            if self._is_connected and await self._run_in_thread(mt5.terminal_info):
-                return
-
-            logger.warning("MT5 connection is down or unresponsive. Attempting to reconnect...")
-            if not self._connection_info:
-                raise ConnectionError(
-                    "MT5 Gateway has no credentials to use for reconnection. Please connect on the Integrations page.")
+        login = int(login)
+        previous = self._accounts.get(login)
+        self._accounts[login] = {"password": password, "server": server}
+        try:
+            await self._submit(self.ACCOUNT, login, lambda: self._ensure_session(login, force=True))
+        except Exception as e:
+            logger.error(f"MT5 connection failed for account {login}: {e}")
+            if previous:
+                self._accounts[login] = previous
+            else:
+                self._accounts.pop(login, None)
+            return False
+        self._default_login = login
+        logger.info(f"MT5 Gateway successfully connected and logged into account {login}.")
+        return True
 
-            # Attempt to reconnect using the stored credentials
-            reconnect_success = await self.connect_and_login(
-                login=self._connection_info["login"],
-                password=self._connection_info["password"],
-                server=self._connection_info["server"]
-            )
+    async def disconnect(self, login: int):
+        """Forgets an account; the terminal shuts down once no accounts are left."""
+        self._accounts.pop(int(login), None)
+        if self._default_login == int(login):
+            self._default_login = next(iter(self._accounts), None)
+        if not self._accounts:
+            await self.shutdown()
 
-            if not reconnect_success:
-                raise ConnectionError("Failed to re-establish connection with the MT5 terminal.")
+    async def shutdown(self):
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            await asyncio.gather(self._worker_task, return_exceptions=True)
+            self._worker_task = None
+        for lane in self._lanes:
+            while lane:
+                job = lane.popleft()
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError("MT5 Gateway was shut down."))
+        was_connected = self._is_connected
+        # Queued behind any call still running on the MT5 thread.
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._shutdown_terminal)
+        if was_connected:
+            # Credentials are kept so the next request can reconnect.
+            logger.info("MT5 Gateway connection has been shut down.")
 
     async def execute_trade(self, symbol: str, action: str, volume: float, price: float, sl_pips: int,
-                            tp_pips: int) -> Dict:
+                            tp_pips: int, login: int) -> Dict:
         """
-        A high-level function to execute a trade. It handles connection checks
-        and translates the trade request into a native MT5 order.
+        A high-level function to execute a trade on `login`. Unlike reads, trades never fall back to
+        the last connected account: the caller must name the account that owns the trade.
+        Trades are scheduled ahead of every other kind of request.
         """
-        async with self._lock:
-            await self._ensure_connection()
-
-            def _execute():
-                # 1. Get the correct symbol name for the broker
-                symbol_info = mt5.symbol_info(symbol)
-                if symbol_info is None:
-                    return {"status": "error", "message": f"Symbol {symbol} not found on MT5 server."}
-
-                point = symbol_info.point
-                ask_price = symbol_info.ask
-                bid_price = symbol_info.bid
-
-                # 2. Determine order type and price
-                trade_type = mt5.ORDER_TYPE_BUY if action.lower() == 'buy' else mt5.ORDER_TYPE_SELL
-                trade_price = ask_price if action.lower() == 'buy' else bid_price
-
-                # 3. Calculate Stop Loss and Take Profit levels
-                sl_price = trade_price - (sl_pips * point) if action.lower() == 'buy' else trade_price + (
-                            sl_pips * point)
-                tp_price = trade_price + (tp_pips * point) if action.lower() == 'buy' else trade_price - (
-                            tp_pips * point)
-
-                # 4. Construct the order request dictionary
-                request = {
-                    "action": mt5.TRADE_ACTION_DEAL,
-                    "symbol": symbol_info.name,
-                    "volume": volume,
-                    "type": trade_type,
-                    "price": trade_price,
-                    "sl": sl_price,
-                    "tp": tp_price,
-                    "deviation": 10,  # Slippage tolerance in points
-                    "magic": 234001,  # Magic number to identify trades from our bot
-                    "comment": "QuantumLeap AI",
-                    "type_time": mt5.ORDER_TIME_GTC,
-                    "type_filling": mt5.ORDER_FILLING_FOK,  # Or FILLING_IOC
-                }
+        login = int(login)
+
+        def _execute():
+            # 1. Get the correct symbol name for the broker
+            symbol_info = mt5.symbol_info(symbol)
+            if symbol_info is None:
+                return {"status": "error", "message": f"Symbol {symbol} not found on MT5 server."}
+
+            point = symbol_info.point
+            ask_price = symbol_info.ask
+            bid_price = symbol_info.bid
+
+            # 2. Determine order type and price
+            trade_type = mt5.ORDER_TYPE_BUY if action.lower() == 'buy' else mt5.ORDER_TYPE_SELL
+            trade_price = ask_price if action.lower() == 'buy' else bid_price
+
+            # 3. Calculate Stop Loss and Take Profit levels
+            sl_price = trade_price - (sl_pips * point) if action.lower() == 'buy' else trade_price + (
+                        sl_pips * point)
+            tp_price = trade_price + (tp_pips * point) if action.lower() == 'buy' else trade_price - (
+                        tp_pips * point)
+
+            # 4. Construct the order request dictionary
+            request = {
+                "action": mt5.TRADE_ACTION_DEAL,
+                "symbol": symbol_info.name,
+                "volume": volume,
+                "type": trade_type,
+                "price": trade_price,
+                "sl": sl_price,
+                "tp": tp_price,
+                "deviation": 10,  # Slippage tolerance in points
+                "magic": 234001,  # Magic number to identify trades from our bot
+                "comment": "QuantumLeap AI",
+                "type_time": mt5.ORDER_TIME_GTC,
+                "type_filling": mt5.ORDER_FILLING_FOK,  # Or FILLING_IOC
+            }
 
-                # 5. Send the order and process the result
-                result = mt5.order_send(request)
-                if result is None:
-                    return {"status": "error", "message": "order_send() failed, no result returned."}
-
-                if result.retcode == mt5.TRADE_RETCODE_DONE:
-                    return {
-                        "status": "success",
-                        "message": "Trade executed successfully.",
-                        "order_id": result.order,
-                        "deal_id": result.deal
-                    }
-                else:
-                    return {
-                        "status": "error",
-                        "message": f"Order failed: {result.comment}",
-                        "retcode": result.retcode
-                    }
+            # 5. Send the order and process the result
+            result = mt5.order_send(request)
+            if result is None:
+                return {"status": "error", "message": "order_send() failed, no result returned."}
+
+            if result.retcode == mt5.TRADE_RETCODE_DONE:
+                return {
+                    "status": "success",
+                    "message": "Trade executed successfully.",
+                    "order_id": result.order,
+                    "deal_id": result.deal
+                }
+            else:
+                return {
+                    "status": "error",
+                    "message": f"Order failed: {result.comment}",
+                    "retcode": result.retcode
+                }
 
-            # Run the blocking trade execution in a thread
-            return await self._run_in_thread(_execute)
+        return await self._submit(self.TRADE, login, _execute)
 
     async def fetch_historical_data(self, symbol: str, timeframe: str, start_date: datetime.datetime,
-                                    end_date: datetime.datetime) -> Optional[pd.DataFrame]:
+                                    end_date: datetime.datetime, login: Optional[int] = None) -> Optional[pd.DataFrame]:
         """
         A robust method to fetch a large chunk of historical OHLCV data directly
-        from the connected MT5 terminal.
+        from the connected MT5 terminal. Runs behind trades, and concurrent identical
+        requests share a single fetch.
         """
-        async with self._lock:
-            await self._ensure_connection()
-
-            def _fetch():
-                # 1. Map our standard timeframe string to the MT5 TIMEFRAME enum
-                timeframe_map = {
-                    '1m': mt5.TIMEFRAME_M1, '5m': mt5.TIMEFRAME_M5, '15m': mt5.TIMEFRAME_M15,
-                    '1h': mt5.TIMEFRAME_H1, '4h': mt5.TIMEFRAME_H4, '1d': mt5.TIMEFRAME_D1,
-                }
-                mt5_timeframe = timeframe_map.get(timeframe)
-                if mt5_timeframe is None:
-                    raise ValueError(f"Timeframe '{timeframe}' is not supported by the MT5 Gateway.")
+        login = self._resolve_login(login)
+        key = (login, symbol, timeframe, start_date, end_date)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            df = await asyncio.shield(inflight)
+            return None if df is None else df.copy()
+
+        def _fetch():
+            # 1. Map our standard timeframe string to the MT5 TIMEFRAME enum
+            timeframe_map = {
+                '1m': mt5.TIMEFRAME_M1, '5m': mt5.TIMEFRAME_M5, '15m': mt5.TIMEFRAME_M15,
+                '1h': mt5.TIMEFRAME_H1, '4h': mt5.TIMEFRAME_H4, '1d': mt5.TIMEFRAME_D1,
+            }
+            mt5_timeframe = timeframe_map.get(timeframe)
+            if mt5_timeframe is None:
+                raise ValueError(f"Timeframe '{timeframe}' is not supported by the MT5 Gateway.")
 
-                # 2. Fetch the rates (OHLCV data)
-                rates = mt5.copy_rates_range(symbol, mt5_timeframe, start_date, end_date)
+            # 2. Fetch the rates (OHLCV data)
+            rates = mt5.copy_rates_range(symbol, mt5_timeframe, start_date, end_date)
 
-                if rates is None or len(rates) == 0:
-                    logger.warning(f"MT5 returned no historical data for {symbol} in the given range.")
-                    return None
+            if rates is None or len(rates) == 0:
+                logger.warning(f"MT5 returned no historical data for {symbol} in the given range.")
+                return None
 
-                # 3. Convert the numpy array of rates into a pandas DataFrame
-                df = pd.DataFrame(rates)
-                # Convert the 'time' column from seconds to a datetime object
-                df['timestamp'] = pd.to_datetime(df['time'], unit='s')
-                df.drop('time', axis=1, inplace=True)
+            # 3. Convert the numpy array of rates into a pandas DataFrame
+            df = pd.DataFrame(rates)
+            # Convert the 'time' column from seconds to a datetime object
+            df['timestamp'] = pd.to_datetime(df['time'], unit='s')
+            df.drop('time', axis=1, inplace=True)
 
-                # Rename columns to match the CCXT standard for seamless integration
-                df.rename(columns={
-                    'open': 'open', 'high': 'high', 'low': 'low',
-                    'close': 'close', 'tick_volume': 'volume'
-                }, inplace=True)
+            # Rename columns to match the CCXT standard for seamless integration
+            df.rename(columns={
+                'open': 'open', 'high': 'high', 'low': 'low',
+                'close': 'close', 'tick_volume': 'volume'
+            }, inplace=True)
 
-                return df[['timestamp', 'open', 'high', 'low', 'close', 'volume']]
+            return df[['timestamp', 'open', 'high', 'low', 'close', 'volume']]
 
-            return await self._run_in_thread(_fetch)
+        return await asyncio.shield(self._submit(self.HISTORY, login, _fetch, key=key))
 
-    async def get_account_summary(self) -> Optional[Dict[str, Any]]:
+    async def get_account_summary(self, login: Optional[int] = None) -> Optional[Dict[str, Any]]:
         """
         Fetches key account metrics like balance, equity, and currency
         from the connected MT5 terminal.
         Returns None if not connected or if the fetch fails.
         """
-        # Do a quick, non-locking check first. If not connected, don't even try.
-        if not self._is_connected:
+        login = login or self._default_login
+        if login is None or int(login) not in self._accounts:
             return None
 
-        async with self._lock:
-            # We don't need a full _ensure_connection here, as we can fail gracefully.
-            # Just check the current state.
-            if not self._is_connected:
-                return None
-
-            def _fetch_summary():
-                account_info = mt5.account_info()
-                if account_info:
-                    return {
-                        "balance": Decimal(str(account_info.balance)),
-                        "equity": Decimal(str(account_info.equity)),
-                        "currency": account_info.currency,  # e.g., "JPY", "USD"
-                        "profit": Decimal(str(account_info.profit)),
-                    }
-                return None
+        def _fetch_summary():
+            account_info = mt5.account_info()
+            if account_info:
+                return {
+                    "balance": Decimal(str(account_info.balance)),
+                    "equity": Decimal(str(account_info.equity)),
+                    "currency": account_info.currency,  # e.g., "JPY", "USD"
+                    "profit": Decimal(str(account_info.profit)),
+                }
+            return None
 
-            return await self._run_in_thread(_fetch_summary)
+        try:
+            return await self._submit(self.ACCOUNT, int(login), _fetch_summary)
+        except ConnectionError as e:
+            logger.warning(f"MT5 account summary unavailable for {login}: {e}")
+            return None
 # Instantiate the gateway service globally
 mt5_gateway_service = MT5GatewayService()
 
+# --- NEW: Typed Candle Events ---
+class Candle(NamedTuple):
+    """
+    An immutable, fully parsed kline. The streamer decodes each websocket message once and
+    shares the same instance with every subscriber. Field order matches a ccxt OHLCV row.
+    """
+    timestamp: int  # Candle open time in ms
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+    close_time: int = 0
+    is_closed: bool = True
+
+    @classmethod
+    def from_binance_kline(cls, kline: Dict[str, Any]) -> "Candle":
+        return cls(int(kline['t']), float(kline['o']), float(kline['h']), float(kline['l']),
+                   float(kline['c']), float(kline['v']), int(kline['T']), bool(kline['x']))
+
+    def as_dict(self) -> Dict[str, float]:
+        """The row format used to build strategy DataFrames."""
+        return {'timestamp': self.timestamp, 'open': self.open, 'high': self.high,
+                'low': self.low, 'close': self.close, 'volume': self.volume}
+
+
+def merge_candle_history(existing, incoming: List[Candle], maxlen: int) -> deque:
+    """Merges backfilled candles into a history, keeping it ordered and de-duplicated."""
+    merged = {c.timestamp: c for c in incoming}
+    merged.update({c.timestamp: c for c in existing})  # Live candles win over REST copies
+    return deque((merged[t] for t in sorted(merged)), maxlen=maxlen)
+
+
+TIMEFRAME_SECONDS = {
+    '1m': 60, '3m': 180, '5m': 300, '15m': 900, '30m': 1800,
+    '1h': 3600, '2h': 7200, '4h': 14400, '1d': 86400,
+}
+
+
+# --- NEW: Multi-Timeframe Aggregation ---
+class CandleAggregator:
+    """
+    Rolls closed 1m candles up into one higher timeframe. A candle is emitted as soon as the
+    last minute of its bucket arrives, or when the feed skips ahead to a later bucket.
+    """
+
+    def __init__(self, timeframe: str):
+        self.timeframe = timeframe
+        self.timeframe_ms = TIMEFRAME_SECONDS[timeframe] * 1000
+        self._bucket: Optional[Candle] = None
+        self._last_minute = -1
+
+    def add(self, candle: Candle) -> List[Candle]:
+        """Feeds one closed 1m candle; returns the higher-timeframe candles it closed."""
+        if candle.timestamp <= self._last_minute:
+            return []  # Duplicate or out-of-order
+        self._last_minute = candle.timestamp
+        start = candle.timestamp - candle.timestamp % self.timeframe_ms
+        closed = []
+        bucket = self._bucket
+        if bucket is not None and bucket.timestamp != start:
+            closed.append(bucket)  # The feed skipped the end of this bucket; close it as it is
+            bucket = None
+        if bucket is None:
+            bucket = Candle(start, candle.open, candle.high, candle.low, candle.close, candle.volume,
+                            start + self.timeframe_ms - 1, True)
+        else:
+            bucket = bucket._replace(high=max(bucket.high, candle.high), low=min(bucket.low, candle.low),
+                                     close=candle.close, volume=bucket.volume + candle.volume)
+        if candle.timestamp + 60_000 >= start + self.timeframe_ms:
+            closed.append(bucket)
+            bucket = None
+        self._bucket = bucket
+        return closed
+
+    def seed(self, candles) -> List[Candle]:
+        """Replays 1m history, starting at the first bucket boundary so no partial candle is produced."""
+        aligned = itertools.dropwhile(lambda c: c.timestamp % self.timeframe_ms != 0, candles)
+        return [closed for candle in aligned for closed in self.add(candle)]
+
+
+def aggregate_candles(candles, timeframe: str) -> List[Candle]:
+    """Complete `timeframe` candles built from a run of 1m candles."""
+    return CandleAggregator(timeframe).seed(candles)
+
+
+# --- NEW: Bounded Subscriber Queues ---
+class SubscriberDisconnected(Exception):
+    """Raised from get() on a 'disconnect' policy queue that fell too far behind."""
+
+
+class SubscriberQueue(asyncio.Queue):
+    """
+    A bounded fan-out queue that never blocks the publisher. When it is full, `policy` decides:
+      - "conflate":    drop everything queued and keep only the newest item
+      - "drop_oldest": drop the oldest item to make room
+      - "disconnect":  drop the subscriber; its next get() raises SubscriberDisconnected
+    Dropped items are counted per subscriber.
+    """
+    POLICIES = ("conflate", "drop_oldest", "disconnect")
+    DEFAULT_SIZES = {"conflate": 1, "drop_oldest": 64, "disconnect": 64}
+
+    def __init__(self, policy: str = "conflate", maxsize: Optional[int] = None, name: Optional[str] = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown subscriber queue policy '{policy}'.")
+        super().__init__(maxsize=maxsize or self.DEFAULT_SIZES[policy])
+        self.policy = policy
+        self.name = name
+        self.dropped = 0
+        self.disconnected = False
+
+    def offer(self, item) -> bool:
+        """Non-blocking put. Returns False once the subscriber has been disconnected."""
+        if self.disconnected:
+            return False
+        if self.full():
+            if self.policy == "disconnect":
+                self.dropped += self.qsize() + 1
+                while not self.empty():
+                    self.get_nowait()
+                self.disconnected = True
+                self.put_nowait(None)  # Wakes a waiting consumer so it sees the disconnect
+                return False
+            if self.policy == "conflate":
+                while not self.empty():
+                    self.get_nowait()
+                    self.dropped += 1
+            else:
+                self.get_nowait()
+                self.dropped += 1
+        self.put_nowait(item)
+        return True
+
+    async def get(self):
+        item = await super().get()
+        if self.disconnected and item is None:
+            raise SubscriberDisconnected(f"Subscriber {self.name or id(self)} fell behind and was disconnected.")
+        return item
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": self.name, "policy": self.policy, "depth": self.qsize(), "maxsize": self.maxsize,
+                "dropped": self.dropped, "disconnected": self.disconnected}
+
+
+# --- NEW: Pluggable Stream Providers ---
+# A provider knows one source's websocket protocol: how to name a symbol's 1m kline stream,
+# where to connect, how to (un)subscribe and how to turn messages into closed Candles.
+# StreamConnection multiplexes up to `max_streams` of a provider's streams over one socket.
+class StreamProvider(ABC):
+    name: str = ""
+    max_streams: int = 200  # Streams per connection
+    url_streams: int = 0  # Streams that can be put in the connect URL
+    frame_batch: int = 10  # Streams per subscribe/unsubscribe frame
+    frame_interval: float = 0.25  # Seconds between control frames
+    ping_interval: Optional[float] = None  # Application-level keepalive, if the exchange needs one
+    is_local: bool = False  # Offline source: no REST backfill either
+
+    @abstractmethod
+    def stream_name(self, symbol: str) -> str:
+        pass
+
+    @abstractmethod
+    async def get_url(self, session: aiohttp.ClientSession, initial: List[str]) -> str:
+        """The websocket URL to connect to, carrying up to `url_streams` of `initial`."""
+        pass
+
+    @asynccontextmanager
+    async def connect(self, session: aiohttp.ClientSession, initial: List[str]):
+        async with session.ws_connect(await self.get_url(session, initial)) as ws:
+            yield ws
+
+    @abstractmethod
+    def control_frame(self, method: str, names: List[str], request_id: int):
+        """The frame that subscribes/unsubscribes `names`; method is 'subscribe' or 'unsubscribe'."""
+        pass
+
+    def ping_frame(self):
+        return None
+
+    @abstractmethod
+    def parse(self, raw: str) -> List[Tuple[str, Candle]]:
+        """(stream name, closed Candle) pairs carried by one message."""
+        pass
+
+    @staticmethod
+    def _base_quote(symbol: str) -> Tuple[str, str]:
+        base, _, quote = symbol.split(':')[0].upper().partition('/')
+        return base, quote
+
+
+class BinanceStreamProvider(StreamProvider):
+    name = "binance"
+    max_streams = 1024  # Binance limit per connection
+    url_streams = 100
+    frame_batch = 200
+    frame_interval = 0.25  # Binance accepts at most 5 incoming messages per second
+
+    def stream_name(self, symbol):
+        return f"{symbol.split(':')[0].replace('/', '').lower()}@kline_1m"
+
+    async def get_url(self, session, initial):
+        base_url = settings.BINANCE_STREAM_URL
+        return f"{base_url}?streams={'/'.join(initial)}" if initial else base_url
+
+    def control_frame(self, method, names, request_id):
+        return {"method": method.upper(), "params": names, "id": request_id}
+
+    def parse(self, raw):
+        payload = fast_json_loads(raw)
+        if "stream" not in payload:
+            if payload.get("error"):
+                logger.error(f"Binance stream rejected a request: {payload['error']}")
+            return []
+        kline = payload["data"].get("k")
+        if kline and kline['x']:
+            return [(payload["stream"], Candle.from_binance_kline(kline))]
+        return []
+
+
+class BybitStreamProvider(StreamProvider):
+    name = "bybit"
+    frame_batch = 10  # Bybit spot accepts at most 10 args per request
+    ping_interval = 20
+
+    def stream_name(self, symbol):
+        base, quote = self._base_quote(symbol)
+        return f"kline.1.{base}{quote}"
+
+    async def get_url(self, session, initial):
+        return "wss://stream.bybit.com/v5/public/spot"
+
+    def control_frame(self, method, names, request_id):
+        return {"op": method, "args": names, "req_id": str(request_id)}
+
+    def ping_frame(self):
+        return {"op": "ping"}
+
+    def parse(self, raw):
+        payload = fast_json_loads(raw)
+        topic = payload.get("topic")
+        if not topic:
+            if payload.get("success") is False:
+                logger.error(f"Bybit stream rejected a request: {payload.get('ret_msg')}")
+            return []
+        return [(topic, Candle(int(k['start']), float(k['open']), float(k['high']), float(k['low']),
+                               float(k['close']), float(k['volume']), int(k['end']), True))
+                for k in payload.get("data", []) if k.get("confirm")]
+
+
+class OkxStreamProvider(StreamProvider):
+    name = "okx"
+    ping_interval = 25  # OKX drops connections that are silent for 30s
+
+    def stream_name(self, symbol):
+        base, quote = self._base_quote(symbol)
+        return f"candle1m:{base}-{quote}"
+
+    async def get_url(self, session, initial):
+        return "wss://ws.okx.com:8443/ws/v5/business"
+
+    def control_frame(self, method, names, request_id):
+        args = [dict(zip(("channel", "instId"), name.split(':', 1))) for name in names]
+        return {"id": str(request_id), "op": method, "args": args}
+
+    def ping_frame(self):
+        return "ping"
+
+    def parse(self, raw):
+        if raw == "pong":
+            return []
+        payload = fast_json_loads(raw)
+        if payload.get("event") == "error":
+            logger.error(f"OKX stream rejected a request: {payload.get('msg')}")
+            return []
+        arg = payload.get("arg")
+        if not arg or "data" not in payload:
+            return []
+        name = f"{arg['channel']}:{arg['instId']}"
+        # Rows: [ts, o, h, l, c, vol, volCcy, volCcyQuote, confirm]
+        return [(name, Candle(int(r[0]), float(r[1]), float(r[2]), float(r[3]), float(r[4]), float(r[5]),
+                              int(r[0]) + 59_999, True))
+                for r in payload["data"] if r[8] == "1"]
+
+
+class KucoinStreamProvider(StreamProvider):
+    name = "kucoin"
+    max_streams = 300
+    frame_batch = 100  # Topics per subscribe frame
+    ping_interval = 15  # Replaced by the server's pingInterval on connect
+
+    def __init__(self):
+        # KuCoin pushes the open candle without a "closed" flag; a candle is closed once the next one starts.
+        self._open_candles: Dict[str, Candle] = {}
+
+    def stream_name(self, symbol):
+        base, quote = self._base_quote(symbol)
+        return f"{base}-{quote}_1min"
+
+    async def get_url(self, session, initial):
+        async with session.post("https://api.kucoin.com/api/v1/bullet-public") as response:
+            info = (await response.json())["data"]
+        server = info["instanceServers"][0]
+        self.ping_interval = server["pingInterval"] / 1000 * 0.8
+        return f"{server['endpoint']}?token={info['token']}&connectId={uuid4().hex}"
+
+    def control_frame(self, method, names, request_id):
+        return {"id": str(request_id), "type": method, "topic": f"/market/candles:{','.join(names)}",
+                "privateChannel": False, "response": True}
+
+    def ping_frame(self):
+        return {"id": str(int(time.time() * 1000)), "type": "ping"}
+
+    def parse(self, raw):
+        payload = fast_json_loads(raw)
+        if payload.get("type") != "message":
+            if payload.get("type") == "error":
+                logger.error(f"KuCoin stream rejected a request: {payload.get('data')}")
+            return []
+        name = payload["topic"].split(':', 1)[1]
+        # [start (s), open, close, high, low, volume, turnover]
+        c = payload["data"]["candles"]
+        start_ms = int(c[0]) * 1000
+        candle = Candle(start_ms, float(c[1]), float(c[3]), float(c[4]), float(c[2]), float(c[5]),
+                        start_ms + 59_999, False)
+        previous = self._open_candles.get(name)
+        self._open_candles[name] = candle
+        if previous and candle.timestamp > previous.timestamp:
+            return [(name, previous._replace(is_closed=True))]
+        return []
+
+
+class LocalStreamFeed:
+    """Stands in for a websocket: takes Binance-style control frames, yields messages from a local source."""
+
+    def __init__(self, source):
+        self.source = source
+        self.streams: set = set()
+
+    async def send_json(self, frame: Dict[str, Any]):
+        if frame.get("method") == "SUBSCRIBE":
+            self.streams.update(frame["params"])
+        elif frame.get("method") == "UNSUBSCRIBE":
+            self.streams.difference_update(frame["params"])
+
+    async def send_str(self, frame: str):
+        pass
+
+    async def __aiter__(self):
+        async for text in self.source.messages(self.streams):
+            yield aiohttp.WSMessage(aiohttp.WSMsgType.TEXT, text, None)
+
+
+class SyntheticStreamProvider(BinanceStreamProvider):
+    """Random-walk klines generated in-process, for offline load tests (see stream_simulator.py)."""
+    name = "synthetic"
+    max_streams = 100_000
+    url_streams = 0
+    frame_batch = 100_000
+    frame_interval = 0
+    is_local = True
+
+    def make_source(self):
+        return SyntheticKlineSource(settings.LOCAL_STREAM_RATE)
+
+    @asynccontextmanager
+    async def connect(self, session, initial):
+        yield LocalStreamFeed(self.make_source())
+
+
+class ReplayStreamProvider(SyntheticStreamProvider):
+    """Replays REPLAY_STREAM_FILE (CSV: symbol,timestamp,open,high,low,close,volume)."""
+    name = "replay"
+
+    def make_source(self):
+        if not settings.REPLAY_STREAM_FILE:
+            raise ValueError("REPLAY_STREAM_FILE must be set to use the replay stream provider.")
+        return ReplayKlineSource(settings.REPLAY_STREAM_FILE, settings.LOCAL_STREAM_RATE)
+
+
+STREAM_PROVIDERS: Dict[str, StreamProvider] = {
+    provider.name: provider for provider in (
+        BinanceStreamProvider(), BybitStreamProvider(), OkxStreamProvider(), KucoinStreamProvider(),
+        SyntheticStreamProvider(), ReplayStreamProvider(),
+    )
+}
+
+
+class StreamConnection:
+    """
+    One websocket carrying many of a provider's kline streams. Streams are added and removed
+    with batched subscribe/unsubscribe frames, throttled to the provider's control-message limit.
+    """
+    RECONNECT_BASE_DELAY = 1.0
+    RECONNECT_MAX_DELAY = 60.0
+
+    def __init__(self, streamer: "MarketDataStreamer", provider: StreamProvider, conn_id: int):
+        self.streamer = streamer
+        self.provider = provider
+        self.conn_id = conn_id
+        self.streams: set = set()
+        self.connected = False
+        self._pending: Dict[str, set] = {"subscribe": set(), "unsubscribe": set()}
+        self._wakeup = asyncio.Event()
+        self._request_ids = itertools.count(1)
+        self.task = asyncio.create_task(self._run())
+
+    @property
+    def has_capacity(self) -> bool:
+        return len(self.streams) < self.provider.max_streams
+
+    def add(self, ws_name: str):
+        self.streams.add(ws_name)
+        self._queue_control("subscribe", "unsubscribe", ws_name)
+
+    def remove(self, ws_name: str):
+        self.streams.discard(ws_name)
+        self._queue_control("unsubscribe", "subscribe", ws_name)
+
+    def _queue_control(self, method: str, opposite: str, ws_name: str):
+        if ws_name in self._pending[opposite]:
+            self._pending[opposite].discard(ws_name)  # Cancels a frame that hasn't been sent yet
+        else:
+            self._pending[method].add(ws_name)
+        self._wakeup.set()
+
+    async def _run(self):
+        provider = self.provider
+        attempt = 0
+        while True:
+            try:
+                initial = sorted(self.streams)[:provider.url_streams]
+                async with provider.connect(self.streamer._session, initial) as ws:
+                    # Anything not in the URL is subscribed once connected; older control frames are moot.
+                    self._pending["subscribe"] = self.streams - set(initial)
+                    self._pending["unsubscribe"] = set()
+                    self._wakeup.set()
+                    self.connected = True
+                    control_task = asyncio.create_task(self._send_control_frames(ws))
+                    logger.info(f"{provider.name} stream connection #{self.conn_id} connected "
+                                f"with {len(self.streams)} streams.")
+                    try:
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                attempt = 0  # Data is flowing; the next outage starts from the base delay
+                                for ws_name, candle in provider.parse(msg.data):
+                                    await self.streamer._dispatch_route((provider.name, ws_name), candle)
+                    finally:
+                        self.connected = False
+                        control_task.cancel()
+                logger.warning(f"{provider.name} stream connection #{self.conn_id} closed by the server.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{provider.name} stream connection #{self.conn_id} error: {e}")
+
+            # Full-jitter exponential backoff, so a network blip doesn't reconnect every socket at once.
+            delay = random.uniform(0, min(self.RECONNECT_MAX_DELAY, self.RECONNECT_BASE_DELAY * 2 ** attempt))
+            attempt += 1
+            logger.info(f"Reconnecting {provider.name} stream connection #{self.conn_id} in {delay:.1f}s "
+                        f"(attempt {attempt}).")
+            await asyncio.sleep(delay)
+
+    async def _send(self, ws, frame):
+        if isinstance(frame, str):
+            await ws.send_str(frame)
+        else:
+            await ws.send_json(frame)
+
+    async def _send_control_frames(self, ws):
+        provider = self.provider
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=provider.ping_interval)
+            except asyncio.TimeoutError:
+                await self._send(ws, provider.ping_frame())
+                continue
+            self._wakeup.clear()
+            for method in ("unsubscribe", "subscribe"):
+                while self._pending[method]:
+                    batch = sorted(self._pending[method])[:provider.frame_batch]
+                    self._pending[method].difference_update(batch)
+                    await self._send(ws, provider.control_frame(method, batch, next(self._request_ids)))
+                    await asyncio.sleep(provider.frame_interval)
+
+    def close(self):
+        self.task.cancel()
+
+
 # --- NEW CLASS: MarketDataStreamer ---
 # This service manages live data streams from exchanges.
 class MarketDataStreamer:
+    HISTORY_CAPACITY = 300  # Warm 1m candles kept per stream
+
     def __init__(self):
-        self._streams: Dict[str, asyncio.Task] = {}
+        # stream_key ("exchange:symbol") -> (provider name, provider stream name) for every stream with subscribers.
+        self._streams: Dict[str, Tuple[str, str]] = {}
+        # --- NEW: Multiplexed provider connections ---
+        self._connections: List[StreamConnection] = []
+        self._stream_connections: Dict[Tuple[str, str], StreamConnection] = {}
+        self._stream_keys: Dict[Tuple[str, str], set] = defaultdict(set)
+        self._connection_ids = itertools.count(1)
         # A pub/sub system: subscribers is a dictionary where keys are symbols
         # and values are lists of asyncio.Queues for each bot listening to that symbol.
-        self._subscribers: Dict[str, List[asyncio.Queue]] = defaultdict(list)
+        # Keys are channels: the stream_key for 1m candles, "stream_key@timeframe" for aggregated ones.
+        self._subscribers: Dict[str, List[SubscriberQueue]] = defaultdict(list)
+        # --- NEW: stream_key -> timeframe -> aggregator, for every higher timeframe with subscribers ---
+        self._aggregators: Dict[str, Dict[str, CandleAggregator]] = defaultdict(dict)
         self._session = aiohttp.ClientSession()
+        # --- NEW: Warm history per stream, shared by every new subscriber ---
+        self._history: Dict[str, deque] = {}
+        self._backfills: Dict[str, asyncio.Future] = {}
+        # --- NEW: Gap recovery. Open time of the last candle published per stream, and live
+        # candles held back while a stream's missing candles are fetched and replayed. ---
+        self._last_published: Dict[str, int] = {}
+        self._recovering: Dict[str, List[Candle]] = {}
+        self._recovery_tasks: Dict[str, asyncio.Task] = {}
+
+    async def get_history(self, symbol: str, exchange: str, min_candles: int = 0) -> List[Candle]:
+        """
+        Returns a snapshot of the stream's warm candle buffer. If the buffer is short or stale
+        it is backfilled over the public REST API; concurrent callers for the same stream share
+        a single request, so a mass restart costs one backfill per stream, not per bot.
+        """
+        stream_key = f"{exchange}:{symbol}".lower()
+        history = self._history.get(stream_key)
+        if history is None or history.maxlen < min_candles:
+            history = deque(history or (), maxlen=max(min_candles, self.HISTORY_CAPACITY))
+            self._history[stream_key] = history
+
+        is_stale = not history or history[-1].timestamp + 120_000 <= int(time.time() * 1000)
+        if (len(history) < min_candles or is_stale) and not self.get_provider(exchange).is_local:
+            backfill = self._backfills.get(stream_key)
+            if backfill is None:
+                backfill = asyncio.ensure_future(self._backfill_history(stream_key, symbol, exchange))
+                self._backfills[stream_key] = backfill
+                backfill.add_done_callback(lambda _: self._backfills.pop(stream_key, None))
+            try:
+                await asyncio.shield(backfill)
+            except Exception as e:
+                logger.error(f"History backfill failed for {stream_key}: {e}")
+
+        return list(self._history[stream_key])
+
+    async def _backfill_history(self, stream_key: str, symbol: str, exchange: str):
+        client = await exchange_manager.get_public_client(exchange)
+        limit = self._history[stream_key].maxlen
+        ohlcv = await client.fetch_ohlcv(symbol, '1m', limit=limit + 1)
+        # The last REST row is usually the still-open candle; keep closed candles only.
+        now_ms = int(time.time() * 1000)
+        closed = [Candle(int(t), float(o), float(h), float(l), float(c), float(v or 0))
+                  for t, o, h, l, c, v in ohlcv if t + 60_000 <= now_ms]
+        self._history[stream_key] = merge_candle_history(self._history[stream_key], closed, limit)
+        logger.info(f"Backfilled {len(closed)} candles for {stream_key}.")
+
+    def get_cached_history(self, symbol: str, exchange: str) -> List[Candle]:
+        """The warm 1m buffer as it is, without triggering a backfill."""
+        return list(self._history.get(f"{exchange}:{symbol}".lower(), ()))
+
+    def get_last_candle(self, symbol: str, exchange: str) -> Optional[Candle]:
+        history = self._history.get(f"{exchange}:{symbol}".lower())
+        return history[-1] if history else None
+
+    @staticmethod
+    def _channel_key(stream_key: str, timeframe: str) -> str:
+        return stream_key if timeframe == '1m' else f"{stream_key}@{timeframe}"
 
-    async def subscribe(self, symbol: str, exchange: str) -> asyncio.Queue:
-        """A bot calls this to subscribe to a symbol's live data feed."""
-        queue = asyncio.Queue()
+    async def subscribe(self, symbol: str, exchange: str, policy: str = "conflate",
+                        maxsize: Optional[int] = None, name: Optional[str] = None,
+                        timeframe: str = '1m') -> SubscriberQueue:
+        """
+        A bot calls this to subscribe to a symbol's live data feed. The queue is bounded;
+        `policy` decides what happens when the subscriber falls behind (see SubscriberQueue).
+        Higher timeframes are aggregated from the same 1m stream: no extra sockets or REST calls.
+        """
+        if timeframe not in TIMEFRAME_SECONDS:
+            raise ValueError(f"Unsupported timeframe '{timeframe}'.")
+        self.get_provider(exchange)  # Fail fast for exchanges without a live stream
+        queue = SubscriberQueue(policy, maxsize, name)
         stream_key = f"{exchange}:{symbol}".lower()
-        self._subscribers[stream_key].append(queue)
+        self._subscribers[self._channel_key(stream_key, timeframe)].append(queue)
 
-        # If this is the first subscriber for this stream, start the WebSocket connection.
+        if timeframe != '1m' and timeframe not in self._aggregators[stream_key]:
+            aggregator = CandleAggregator(timeframe)
+            aggregator.seed(self._history.get(stream_key, ()))  # Resume the current bucket mid-way
+            self._aggregators[stream_key][timeframe] = aggregator
+
+        # If this is the first subscriber for this stream, add it to a combined connection.
         if stream_key not in self._streams:
             logger.info(f"Starting new market stream for {stream_key}")
-            self._streams[stream_key] = asyncio.create_task(self._stream_market_data(stream_key))
+            self._open_stream(stream_key)
 
         return queue
 
-    async def unsubscribe(self, queue: asyncio.Queue, symbol: str, exchange: str):
+    async def unsubscribe(self, queue: asyncio.Queue, symbol: str, exchange: str, timeframe: str = '1m'):
         """A bot calls this when it stops."""
         stream_key = f"{exchange}:{symbol}".lower()
-        if queue in self._subscribers[stream_key]:
-            self._subscribers[stream_key].remove(queue)
-
-        # If there are no more subscribers, close the WebSocket connection.
-        if not self._subscribers[stream_key]:
+        channel = self._channel_key(stream_key, timeframe)
+        if queue in self._subscribers[channel]:
+            self._subscribers[channel].remove(queue)
+        if timeframe != '1m' and not self._subscribers[channel]:
+            self._aggregators[stream_key].pop(timeframe, None)
+            if not self._aggregators[stream_key]:
+                del self._aggregators[stream_key]
+
+        # If there are no more subscribers on any timeframe, unsubscribe the stream from its connection.
+        if not self._subscribers[stream_key] and stream_key not in self._aggregators:
             logger.info(f"Closing market stream for {stream_key} due to no subscribers.")
             if stream_key in self._streams:
-                self._streams[stream_key].cancel()
-                del self._streams[stream_key]
+                self._close_stream(stream_key)
+            recovery = self._recovery_tasks.pop(stream_key, None)
+            if recovery is not None:
+                recovery.cancel()
 
-    async def _stream_market_data(self, stream_key: str):
-        """The core coroutine that connects to an exchange's WebSocket and pushes data."""
-        exchange_name, symbol = stream_key.split(':')
-        ws_symbol = symbol.replace('/', '').lower()
-        url = f"wss://stream.binance.com:9443/ws/{ws_symbol}@kline_1m"
+    @staticmethod
+    def get_provider(exchange: str) -> StreamProvider:
+        """The stream provider for an exchange, unless MARKET_STREAM_PROVIDER routes every stream to one source."""
+        name = (settings.MARKET_STREAM_PROVIDER or exchange).lower()
+        provider = STREAM_PROVIDERS.get(name)
+        if provider is None:
+            raise ValueError(f"No live market data stream is available for exchange '{exchange}'.")
+        return provider
+
+    def _open_stream(self, stream_key: str):
+        exchange_name, symbol = stream_key.split(':', 1)
+        provider = self.get_provider(exchange_name)
+        route = (provider.name, provider.stream_name(symbol))
+        self._streams[stream_key] = route
+        self._stream_keys[route].add(stream_key)
+        if route in self._stream_connections:
+            return  # Already carried by a connection (e.g. the same symbol under another exchange key)
+        connection = next((c for c in self._connections if c.provider is provider and c.has_capacity), None)
+        if connection is None:
+            connection = StreamConnection(self, provider, next(self._connection_ids))
+            self._connections.append(connection)
+        connection.add(route[1])
+        self._stream_connections[route] = connection
+
+    def _close_stream(self, stream_key: str):
+        self._last_published.pop(stream_key, None)
+        route = self._streams.pop(stream_key)
+        self._stream_keys[route].discard(stream_key)
+        if self._stream_keys[route]:
+            return
+        del self._stream_keys[route]
+        connection = self._stream_connections.pop(route, None)
+        if connection:
+            connection.remove(route[1])
+            if not connection.streams:
+                connection.close()
+                self._connections.remove(connection)
+
+    async def _dispatch_route(self, route: Tuple[str, str], candle: Candle):
+        for stream_key in list(self._stream_keys.get(route, ())):
+            await self._dispatch_candle(stream_key, candle)
+
+    async def _dispatch_candle(self, stream_key: str, candle: Candle):
+        """
+        Publishes a live candle, unless it reveals missing open times (typically after a reconnect).
+        Then it is held back while the stream's gap is backfilled and replayed in order.
+        """
+        if stream_key in self._recovering:
+            self._recovering[stream_key].append(candle)
+            return
+        last = self._last_published.get(stream_key)
+        if last is not None and candle.timestamp <= last:
+            return  # Already published, e.g. re-sent after a reconnect
+        if last is not None and candle.timestamp > last + 60_000:
+            self._recovering[stream_key] = [candle]
+            # Recover off the read loop so the connection's other streams keep flowing.
+            self._recovery_tasks[stream_key] = asyncio.create_task(self._recover_gap(stream_key, last))
+            return
+        await self._publish_candle(stream_key, candle)
+
+    async def _recover_gap(self, stream_key: str, last: int):
+        """One REST backfill per stream, however many bots use it, then an ordered replay."""
+        exchange_name, symbol = stream_key.split(':', 1)
+        first_live = self._recovering[stream_key][0]
+        missing = (first_live.timestamp - last) // 60_000 - 1
+        logger.warning(f"Gap of {missing} candles detected on {stream_key}. Backfilling before resuming.")
+        backfilled: List[Candle] = []
+        try:
+            if not self.get_provider(exchange_name).is_local:
+                client = await exchange_manager.get_public_client(exchange_name)
+                ohlcv = await client.fetch_ohlcv(symbol, '1m', since=last + 60_000, limit=min(missing, 1000))
+                backfilled = [Candle(int(t), float(o), float(h), float(l), float(c), float(v or 0))
+                              for t, o, h, l, c, v in ohlcv if last < t < first_live.timestamp]
+        except Exception as e:
+            logger.error(f"Gap backfill failed for {stream_key}: {e}. Resuming with {missing} candles missing.")
 
-        while True:
-            try:
-                async with self._session.ws_connect(url) as ws:
-                    logger.info(f"Successfully connected to WebSocket for {stream_key}")
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            data = json.loads(msg.data)
-                            if 'k' in data:
-                                kline = data['k']
-                                if kline['x']:
-                                    # Publish to bot queues
-                                    for queue in self._subscribers[stream_key]:
-                                        await queue.put(kline)
-
-                                    # --- ROBUST UI STREAMING ---
-                                    # Create the payload for the UI.
-                                    chart_update_payload = {
-                                        "type": "market_data_update",
-                                        "symbol": symbol.upper(),
-                                        "kline": {
-                                            "time": kline['t'] // 1000,
-                                            "open": float(kline['o']),
-                                            "high": float(kline['h']),
-                                            "low": float(kline['l']),
-                                            "close": float(kline['c'])
-                                        }
-                                    }
-                                    # Broadcast ONLY to users viewing this specific symbol.
-                                    await websocket_manager.broadcast_to_symbol_viewers(symbol, chart_update_payload)
-            except Exception as e:
-                logger.error(f"WebSocket error for {stream_key}: {e}. Reconnecting in 10 seconds...")
-                await asyncio.sleep(10)
+        pending = backfilled
+        try:
+            while True:
+                for candle in sorted({c.timestamp: c for c in pending}.values(), key=lambda c: c.timestamp):
+                    if candle.timestamp > self._last_published.get(stream_key, -1):
+                        await self._publish_candle(stream_key, candle)
+                # Live candles that arrived during the replay go out next, still in order.
+                pending = self._recovering.get(stream_key, [])
+                if not pending:
+                    break
+                self._recovering[stream_key] = []
+        finally:
+            self._recovering.pop(stream_key, None)
+            if self._recovery_tasks.get(stream_key) is asyncio.current_task():
+                del self._recovery_tasks[stream_key]
+        logger.info(f"Recovered {len(backfilled)}/{missing} missing candles on {stream_key}.")
+
+    async def _publish_candle(self, stream_key: str, candle: Candle):
+        """Records a closed candle and fans it out to the stream's subscribers and chart viewers."""
+        self._last_published[stream_key] = candle.timestamp
+        exchange_name, symbol = stream_key.split(':', 1)
+        history = self._history.get(stream_key)
+        if history is None:
+            history = self._history[stream_key] = deque(maxlen=self.HISTORY_CAPACITY)
+        if not history or candle.timestamp > history[-1].timestamp:
+            history.append(candle)
+        # Update shared features first so every subscriber sees them current.
+        feature_store.on_candle(exchange_name, symbol, '1m', candle)
+        self._fan_out(stream_key, candle)
+
+        for timeframe, aggregator in list(self._aggregators.get(stream_key, {}).items()):
+            for tf_candle in aggregator.add(candle):
+                feature_store.on_candle(exchange_name, symbol, timeframe, tf_candle)
+                self._fan_out(self._channel_key(stream_key, timeframe), tf_candle)
+
+        # --- ROBUST UI STREAMING ---
+        # Create the payload for the UI.
+        chart_update_payload = {
+            "type": "market_data_update",
+            "symbol": symbol.upper(),
+            "kline": {
+                "time": candle.timestamp // 1000,
+                "open": candle.open,
+                "high": candle.high,
+                "low": candle.low,
+                "close": candle.close
+            }
+        }
+        # Broadcast ONLY to users viewing this specific symbol.
+        await websocket_manager.broadcast_to_symbol_viewers(symbol, chart_update_payload)
+
+    def _fan_out(self, channel: str, candle: Candle):
+        # Bounded, non-blocking fan-out: a stuck subscriber can't delay the others.
+        for queue in list(self._subscribers[channel]):
+            if not queue.offer(candle):
+                logger.warning(f"Disconnected slow subscriber {queue.name} from {channel} "
+                               f"after {queue.dropped} dropped candles.")
+                self._subscribers[channel].remove(queue)
+
+    def get_subscriber_stats(self) -> Dict[str, List[Dict[str, Any]]]:
+        return {key: [queue.stats() for queue in queues] for key, queues in self._subscribers.items() if queues}
+
+    def get_connection_stats(self) -> List[Dict[str, Any]]:
+        return [{"connection": c.conn_id, "provider": c.provider.name, "streams": len(c.streams),
+                 "connected": c.connected} for c in self._connections]
 
     async def close(self):
         """Gracefully close all connections on shutdown."""
-        for task in self._streams.values():
+        recoveries = list(self._recovery_tasks.values())
+        for task in recoveries:
             task.cancel()
+        await asyncio.gather(*recoveries, return_exceptions=True)
+        for connection in self._connections:
+            connection.close()
+        self._connections.clear()
         await self._session.close()
 
 
@@ -3802,6 +5721,189 @@ class MarketDataStreamer:
 market_streamer = MarketDataStreamer()
 
 
+# --- NEW: Per-Stream Feature Store ---
+
+
+class FeatureSet:
+    """
+    Candle history and live indicators for one (exchange, symbol, timeframe).
+    Each indicator is computed at most once per candle, on first request, and the same
+    result is served to every consumer. Returned Series are shared and must not be mutated;
+    use frame() when a private, writable DataFrame is needed.
+    """
+    DEFAULT_CAPACITY = 300
+
+    def __init__(self, exchange: str, symbol: str, timeframe: str, capacity: int = DEFAULT_CAPACITY):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.candles: deque = deque(maxlen=capacity)
+        self._cache: Dict[tuple, Any] = {}
+        self._backfill_lock = asyncio.Lock()
+
+    @property
+    def timeframe_ms(self) -> int:
+        return TIMEFRAME_SECONDS.get(self.timeframe, 60) * 1000
+
+    @property
+    def latest(self) -> Optional[Candle]:
+        return self.candles[-1] if self.candles else None
+
+    def ensure_capacity(self, size: int):
+        if size > self.candles.maxlen:
+            self.candles = deque(self.candles, maxlen=size)
+
+    def append(self, candle: Candle):
+        if self.candles and candle.timestamp <= self.candles[-1].timestamp:
+            if candle.timestamp != self.candles[-1].timestamp:
+                return  # Out-of-order candle, history is already ahead
+            self.candles[-1] = candle
+        else:
+            self.candles.append(candle)
+        self._cache.clear()
+
+    def load(self, candles: List[Candle]):
+        """Merges backfilled candles into the history, keeping it ordered and de-duplicated."""
+        self.candles = merge_candle_history(self.candles, candles, self.candles.maxlen)
+        self._cache.clear()
+
+    def is_stale(self) -> bool:
+        """True when a newer candle should have closed than the latest one held."""
+        if not self.candles:
+            return True
+        now_ms = int(time.time() * 1000)
+        return self.candles[-1].timestamp + 2 * self.timeframe_ms <= now_ms
+
+    def _memo(self, key: tuple, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    # --- Shared Data Views ---
+    def frame(self) -> pd.DataFrame:
+        """A private copy of the OHLCV DataFrame; the underlying frame is built once per candle."""
+        return self._memo(('frame',), lambda: pd.DataFrame([c.as_dict() for c in self.candles])).copy()
+
+    def closes(self) -> pd.Series:
+        return self._memo(('close',), lambda: pd.Series([c.close for c in self.candles], dtype=float))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Picklable OHLCV arrays of the current history, for evaluation in another process."""
+        return self._memo(('snapshot',), lambda: {
+            "exchange": self.exchange,
+            "symbol": self.symbol,
+            "timeframe": self.timeframe,
+            "ohlcv": np.array([(c.timestamp, c.open, c.high, c.low, c.close, c.volume) for c in self.candles],
+                              dtype=float),
+        })
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict[str, Any]) -> "FeatureSet":
+        ohlcv = snapshot["ohlcv"]
+        feature_set = cls(snapshot["exchange"], snapshot["symbol"], snapshot["timeframe"], max(len(ohlcv), 1))
+        feature_set.candles.extend(Candle(int(row[0]), *map(float, row[1:])) for row in ohlcv)
+        return feature_set
+
+    # --- Indicators ---
+    def sma(self, period: int) -> pd.Series:
+        return self._memo(('sma', period), lambda: self.closes().rolling(window=period).mean())
+
+    def std(self, period: int) -> pd.Series:
+        return self._memo(('std', period), lambda: self.closes().rolling(window=period).std())
+
+    def ema(self, period: int) -> pd.Series:
+        return self._memo(('ema', period), lambda: self.closes().ewm(span=period, adjust=False).mean())
+
+    def rsi(self, period: int) -> pd.Series:
+        def compute():
+            delta = self.closes().diff()
+            gain = delta.where(delta > 0, 0).rolling(window=period).mean()
+            loss = (-delta.where(delta < 0, 0)).rolling(window=period).mean()
+            return 100 - (100 / (1 + gain / loss))
+        return self._memo(('rsi', period), compute)
+
+    def macd(self, fast: int, slow: int, signal: int) -> Tuple[pd.Series, pd.Series]:
+        def compute():
+            macd_line = self.ema(fast) - self.ema(slow)
+            return macd_line, macd_line.ewm(span=signal, adjust=False).mean()
+        return self._memo(('macd', fast, slow, signal), compute)
+
+    def atr(self, period: int) -> pd.Series:
+        def compute():
+            high = pd.Series([c.high for c in self.candles], dtype=float)
+            low = pd.Series([c.low for c in self.candles], dtype=float)
+            prev_close = self.closes().shift()
+            tr = np.maximum(high - low, np.maximum(abs(high - prev_close), abs(low - prev_close)))
+            return tr.rolling(window=period).mean()
+        return self._memo(('atr', period), compute)
+
+
+class FeatureStore:
+    """
+    Owns one FeatureSet per (exchange, symbol, timeframe). Live 1m sets are fed by the
+    MarketDataStreamer before candles are fanned out, so consumers always see current
+    features, and hydrate from the streamer's warm buffer. Sets without a live feed are
+    refreshed over REST at most once per candle.
+    """
+
+    def __init__(self):
+        self._sets: Dict[str, FeatureSet] = {}
+
+    @staticmethod
+    def _key(exchange: str, symbol: str, timeframe: str) -> str:
+        return f"{exchange}:{symbol}:{timeframe}".lower()
+
+    def get(self, exchange: str, symbol: str, timeframe: str = '1m', capacity: int = 0) -> FeatureSet:
+        key = self._key(exchange, symbol, timeframe)
+        feature_set = self._sets.get(key)
+        if feature_set is None:
+            feature_set = FeatureSet(exchange, symbol, timeframe, max(capacity, FeatureSet.DEFAULT_CAPACITY))
+            self._sets[key] = feature_set
+        else:
+            feature_set.ensure_capacity(capacity)
+        return feature_set
+
+    def on_candle(self, exchange: str, symbol: str, timeframe: str, candle: Candle):
+        feature_set = self._sets.get(self._key(exchange, symbol, timeframe))
+        if feature_set is not None:
+            feature_set.append(candle)
+
+    async def backfill(self, feature_set: FeatureSet, min_candles: int = 0):
+        """Fills the set's history unless it is already present and current."""
+        async with feature_set._backfill_lock:
+            if len(feature_set.candles) >= min_candles and not feature_set.is_stale():
+                return
+            if feature_set.timeframe == '1m':
+                # 1m history is shared with the live stream; the streamer backfills once per stream.
+                feature_set.load(await market_streamer.get_history(
+                    feature_set.symbol, feature_set.exchange, feature_set.candles.maxlen))
+                return
+            # Higher timeframes: roll up the warm 1m buffer when it reaches back far enough,
+            # otherwise fetch once over REST. The live aggregator keeps the set current afterwards.
+            rolled = aggregate_candles(market_streamer.get_cached_history(feature_set.symbol, feature_set.exchange),
+                                       feature_set.timeframe)
+            if len(rolled) >= min_candles:
+                feature_set.load(rolled)
+                if not feature_set.is_stale():
+                    return
+            client = await exchange_manager.get_public_client(feature_set.exchange)
+            ohlcv = await client.fetch_ohlcv(feature_set.symbol, feature_set.timeframe,
+                                             limit=feature_set.candles.maxlen + 1)
+            # The last REST row is usually the still-open candle; keep closed candles only.
+            now_ms = int(time.time() * 1000)
+            closed = [Candle(int(t), float(o), float(h), float(l), float(c), float(v or 0))
+                      for t, o, h, l, c, v in ohlcv if t + feature_set.timeframe_ms <= now_ms]
+            feature_set.load(closed)
+
+    async def get_fresh(self, exchange: str, symbol: str, timeframe: str, min_candles: int) -> FeatureSet:
+        feature_set = self.get(exchange, symbol, timeframe, min_candles)
+        await self.backfill(feature_set, min_candles)
+        return feature_set
+
+
+feature_store = FeatureStore()
+
+
 class SMCAnalyzer:
     def find_swing_highs_lows(self, df: pd.DataFrame, window: int = 5) -> pd.DataFrame:
         """Identifies swing highs and lows, a prerequisite for BOS/CHoCH."""
@@ -4755,49 +6857,1887 @@ class VisualStrategyInterpreter:
         return self._evaluate_node(edge['source'])
 
 
-class StrategyService:
-    def __init__(self):
-        """
-        The constructor that initializes the service. It's crucial that this
-        method exists and defines the 'strategies' dictionary.
-        """
-        # This dictionary maps the strategy names (from the DB/frontend)
-        # to the actual Python methods that run them.
-        self.strategies = {
-            # --- Standard Indicator-Based Strategies ---
-            "RSI_MACD_Crossover": self.run_rsi_macd_crossover_strategy,
-            "MA_Cross": self.run_ma_cross_strategy,
-            "Bollinger_Bands": self.run_bollinger_bands_strategy,
+# ==============================================================================
+# --- NEW: Signal Multicasting ---
+# Bots that share a stream, strategy and parameter set (e.g. clones of the same
+# marketplace strategy) share one evaluator. Each distinct signal is computed once
+# per candle and fanned out to every subscribed bot for sizing and execution.
+# ==============================================================================
+class SignalEvent(NamedTuple):
+    """The result of evaluating one candle for one strategy configuration."""
+    candle: Optional[Candle]
+    action: str  # 'buy', 'sell', 'hold', 'info' or 'error'
+    message: Optional[str] = None  # Heartbeat / analysis line for the bot log
+    trigger: Optional[str] = None  # Log line shown when the signal is acted upon
 
-            # --- Advanced Price Action Strategy ---
-            "Smart_Money_Concepts": self.run_smc_strategy,
 
-            # --- Specialized, Non-Streaming Strategy ---
-            "Grid_Trading": self.run_grid_trading_strategy,
+class SignalEvaluator(ABC):
+    """
+    Stateful signal logic for a single (stream, strategy, params) configuration.
+    Evaluators never touch the database or user state; execution is per-bot.
+    Candle history and common indicators come from the stream's shared FeatureSet.
+    Evaluators with `offload` set run in the strategy process pool; they must not keep
+    state between candles, since any pool worker may evaluate the next one.
+    """
+    history_size: int = 200  # Candles required in the stream's FeatureSet
+    min_history: int = 200  # Candles required before the first evaluation
+    warmup_log_every: int = 10
+    offload: bool = False  # CPU-heavy: evaluate in the process pool instead of on the event loop
+    evaluation_deadline: float = 20.0  # Seconds an offloaded evaluation may take before it is dropped
 
-            # --- NEW: Advanced Pre-Built Strategies ---
-            "Volatility_Squeeze": self.run_volatility_squeeze_strategy,
-            "SuperTrend_ADX_Filter": self.run_supertrend_adx_strategy,
-            "Ichimoku_Cloud_Breakout": self.run_ichimoku_breakout_strategy,
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        self.params = params
+        self.symbol = symbol
 
-            # --- NEW: AI-Powered & Meta Strategies ---
-            "AI_Signal_Confirmation": self.run_ai_enhanced_strategy,
-            "Optimizer_Portfolio": self.run_optimizer_portfolio_strategy,
+    @abstractmethod
+    def evaluate(self, features: FeatureSet) -> Tuple[str, Optional[str], Optional[str]]:
+        """Returns (action, heartbeat message, trigger message) for the latest candle in `features`."""
+        pass
 
-            # --- NEW: Externally Driven Strategies ---
-            "TradingView_Alert": self.run_webhook_strategy,
-            "Visual_Strategy_Builder": self.run_visual_strategy,
-        }
 
-        # Helper classes and state management attributes
+class VisualSignalEvaluator(SignalEvaluator):
+    history_size = 250
+    min_history = 200
+    offload = True
+
+    def evaluate(self, features):
+        candle = features.latest
+        interpreter = VisualStrategyInterpreter(self.params, features.frame())
+        signal = interpreter.evaluate()  # 'buy', 'sell', 'hold'
+        log_msg = f"📊 Visual Logic Result: {signal.upper()} | Price ${candle.close:.2f}"
+        if signal == 'buy':
+            return 'buy', log_msg, "🟢 Visual Logic Triggered BUY!"
+        if signal == 'sell':
+            return 'sell', log_msg, "🔴 Visual Logic Triggered SELL!"
+        return 'hold', log_msg, None
+
+
+class RsiMacdSignalEvaluator(SignalEvaluator):
+    warmup_log_every = 5
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.rsi_period = params.get('rsi_period', 14)
+        self.rsi_overbought = params.get('rsi_overbought', 70)
+        self.rsi_oversold = params.get('rsi_oversold', 30)
+        self.macd_fast = params.get('macd_fast', 12)
+        self.macd_slow = params.get('macd_slow', 26)
+        self.macd_signal_period = params.get('macd_signal', 9)
+        self.history_size = self.min_history = max(self.rsi_period, self.macd_slow) + 15
+        self.previous_macd_hist_state = 0
+
+    def evaluate(self, features):
+        close_price = features.latest.close
+        current_rsi = features.rsi(self.rsi_period).iloc[-1]
+        macd_line, signal_line = features.macd(self.macd_fast, self.macd_slow, self.macd_signal_period)
+        current_macd_val = macd_line.iloc[-1]
+        current_signal_val = signal_line.iloc[-1]
+        current_macd_hist_state = 1 if current_macd_val > current_signal_val else -1
+
+        log_msg = f"📊 Analysis: Price ${close_price:.2f} | RSI: {current_rsi:.1f} | MACD: {current_macd_val:.4f}"
+
+        buy_signal = current_rsi < self.rsi_oversold and current_macd_hist_state == 1 and self.previous_macd_hist_state == -1
+        sell_signal = current_rsi > self.rsi_overbought and current_macd_hist_state == -1 and self.previous_macd_hist_state == 1
+        self.previous_macd_hist_state = current_macd_hist_state
+
+        if buy_signal:
+            return 'buy', log_msg, "🟢 Oversold + MACD Cross! BUYING..."
+        if sell_signal:
+            return 'sell', log_msg, "🔴 Overbought + MACD Cross! SELLING..."
+        return 'hold', log_msg, None
+
+
+class MaCrossSignalEvaluator(SignalEvaluator):
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.short_window = params.get('short_window', 50)
+        self.long_window = params.get('long_window', 200)
+        self.history_size = self.long_window + 10
+        self.min_history = self.long_window
+        self.previous_ma_state = 0
+
+    def evaluate(self, features):
+        close_price = features.latest.close
+        current_short_ma = features.sma(self.short_window).iloc[-1]
+        current_long_ma = features.sma(self.long_window).iloc[-1]
+        current_ma_state = 1 if current_short_ma > current_long_ma else -1
+
+        log_msg = (f"📊 Analysis: Price ${close_price:.2f} | MA({self.short_window}): {current_short_ma:.2f} | "
+                   f"MA({self.long_window}): {current_long_ma:.2f}")
+
+        buy_signal = current_ma_state == 1 and self.previous_ma_state == -1
+        sell_signal = current_ma_state == -1 and self.previous_ma_state == 1
+        self.previous_ma_state = current_ma_state
+
+        if buy_signal:
+            return 'buy', log_msg, "🟢 GOLDEN CROSS DETECTED! Executing BUY..."
+        if sell_signal:
+            return 'sell', log_msg, "🔴 DEATH CROSS DETECTED! Executing SELL..."
+        return 'hold', log_msg, None
+
+
+class BollingerBandsSignalEvaluator(SignalEvaluator):
+    warmup_log_every = 5
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.window = params.get('window', 20)
+        self.std_dev = params.get('std_dev', 2.0)
+        self.history_size = self.window + 10
+        self.min_history = self.window
+
+    def evaluate(self, features):
+        close_price = features.latest.close
+        sma = features.sma(self.window).iloc[-1]
+        std = features.std(self.window).iloc[-1]
+        upper_band = sma + (std * self.std_dev)
+        lower_band = sma - (std * self.std_dev)
+
+        log_msg = f"📊 Analysis: Price ${close_price:.2f} | Upper: {upper_band:.2f} | Lower: {lower_band:.2f}"
+
+        if close_price <= lower_band:
+            return 'buy', log_msg, "🟢 Price below Lower Band. Reversion BUY..."
+        if close_price >= upper_band:
+            return 'sell', log_msg, "🔴 Price above Upper Band. Reversion SELL..."
+        return 'hold', log_msg, None
+
+
+class SmcSignalEvaluator(SignalEvaluator):
+    history_size = 200
+    min_history = 50
+    offload = True
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
         self.smc_analyzer = SMCAnalyzer()
-        self.running_bot_tasks: Dict[PythonUUID, asyncio.Task] = {}
-        self.bot_contexts: Dict[PythonUUID, Dict] = {}
-        self._bot_locks = defaultdict(asyncio.Lock)
 
-    async def _get_authenticated_client(self, user_id: str, exchange_name: str) -> Optional[ccxt.Exchange]:
-        """
-        Securely fetches, decrypts, and creates an authenticated ccxt client for a user.
+    def evaluate(self, features):
+        candle = features.latest
+        df = features.frame()
+        df = self.smc_analyzer.find_bos_choch(df)
+        df = self.smc_analyzer.find_order_blocks(df)
+        latest = df.iloc[-1]
+
+        structure = "BOS (Bullish)" if latest['bos'] == 1 else ("BOS (Bearish)" if latest['bos'] == -1 else "Neutral")
+        ob_level = latest['bullish_ob'] if latest['bullish_ob'] > 0 else "None"
+        log_msg = f"📊 Analysis: Price ${candle.close:.2f} | Structure: {structure} | Bullish OB: {ob_level}"
+
+        # Logic: 1. Bullish Change of Character detected recently. 2. Price dips into Bullish Order Block.
+        bullish_choch = (df['choch'] == 1).rolling(10).sum().iloc[-1] > 0
+        in_zone = latest['close'] <= latest['bullish_ob'] and latest['bullish_ob'] > 0
+        if bullish_choch and in_zone:
+            return 'buy', log_msg, "🟢 SMC Entry Validated! BUYING..."
+        return 'hold', log_msg, None
+
+
+class VolatilitySqueezeSignalEvaluator(SignalEvaluator):
+    warmup_log_every = 5
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.bb_period = params.get('bb_period', 20)
+        self.bb_std = params.get('bb_std', 2.0)
+        self.kc_period = params.get('kc_period', 20)
+        self.kc_atr_mult = params.get('kc_atr_mult', 1.5)
+        self.history_size = self.min_history = max(self.bb_period, self.kc_period) + 10
+        self.in_squeeze = False
+
+    def evaluate(self, features):
+        candle = features.latest
+        df = features.frame()
+        df.ta.bbands(length=self.bb_period, std=self.bb_std, append=True)
+        df.ta.kc(length=self.kc_period, scalar=self.kc_atr_mult, append=True)
+        latest = df.iloc[-1]
+
+        bb_upper = latest[f'BBU_{self.bb_period}_{self.bb_std}']
+        squeeze_is_on = latest[f'BBL_{self.bb_period}_{self.bb_std}'] > latest[f'KCL_{self.kc_period}_{self.kc_atr_mult}'] and \
+                        bb_upper < latest[f'KCU_{self.kc_period}_{self.kc_atr_mult}']
+        squeeze_released = not squeeze_is_on and self.in_squeeze
+
+        status = "ON (Accumulating)" if squeeze_is_on else "OFF"
+        log_msg = f"📊 Analysis: Price ${candle.close:.2f} | Squeeze: {status}"
+
+        buy_signal = squeeze_released and latest['close'] > bb_upper
+        self.in_squeeze = squeeze_is_on
+
+        if buy_signal:
+            return 'buy', log_msg, "🟢 Squeeze Released Upward! BUYING..."
+        return 'hold', log_msg, None
+
+
+class SuperTrendAdxSignalEvaluator(SignalEvaluator):
+    warmup_log_every = 5
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.st_period = params.get('st_period', 12)
+        self.st_multiplier = params.get('st_multiplier', 3.0)
+        self.adx_period = params.get('adx_period', 14)
+        self.adx_threshold = params.get('adx_threshold', 25)
+        self.history_size = self.min_history = max(self.st_period, self.adx_period) + 15
+
+    def evaluate(self, features):
+        df = features.frame()
+        df.ta.supertrend(length=self.st_period, multiplier=self.st_multiplier, append=True)
+        df.ta.adx(length=self.adx_period, append=True)
+        latest = df.iloc[-1]
+        prev = df.iloc[-2]
+
+        st_col = f'SUPERTd_{self.st_period}_{self.st_multiplier}'
+        # Check if supertrend column exists before accessing
+        if st_col not in latest:
+            return 'hold', None, None
+
+        adx_val = latest[f'ADX_{self.adx_period}']
+        is_trending = adx_val > self.adx_threshold
+        trend_str = "TRENDING" if is_trending else "RANGING"
+        dir_str = "BULLISH" if latest[st_col] == 1 else "BEARISH"
+        log_msg = f"📊 Analysis: ADX: {adx_val:.1f} ({trend_str}) | SuperTrend: {dir_str}"
+
+        buy_flip = latest[st_col] == 1 and prev[st_col] == -1
+        sell_flip = latest[st_col] == -1 and prev[st_col] == 1
+        if buy_flip and is_trending:
+            return 'buy', log_msg, "🟢 Trend Start (Buy) Detected!"
+        if sell_flip and is_trending:
+            return 'sell', log_msg, "🔴 Trend Flip (Sell) Detected!"
+        return 'hold', log_msg, None
+
+
+class IchimokuSignalEvaluator(SignalEvaluator):
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.tenkan = params.get('tenkan_period', 9)
+        self.kijun = params.get('kijun_period', 26)
+        self.senkou = params.get('senkou_period', 52)
+        self.history_size = self.min_history = self.senkou + 26 + 10  # Senkou B shift + buffer
+
+    def evaluate(self, features):
+        df = features.frame()
+        df.ta.ichimoku(tenkan=self.tenkan, kijun=self.kijun, senkou=self.senkou, append=True)
+        latest = df.iloc[-1]
+        prev = df.iloc[-2]
+
+        # Cloud Components
+        span_a = latest[f'ISA_{self.tenkan}']
+        span_b = latest[f'ISB_{self.kijun}']
+        cloud_top = max(span_a, span_b)
+        cloud_bottom = min(span_a, span_b)
+        price = latest['close']
+
+        pos = "ABOVE Cloud" if price > cloud_top else ("BELOW Cloud" if price < cloud_bottom else "INSIDE Cloud")
+        log_msg = f"📊 Analysis: Price ${price:.2f} | {pos}"
+
+        bullish_breakout = price > cloud_top and prev['close'] <= max(prev[f'ISA_{self.tenkan}'], prev[f'ISB_{self.kijun}'])
+        bearish_breakout = price < cloud_bottom and prev['close'] >= min(prev[f'ISA_{self.tenkan}'], prev[f'ISB_{self.kijun}'])
+        if bullish_breakout:
+            return 'buy', log_msg, "🟢 Kumo Breakout UP! BUYING..."
+        if bearish_breakout:
+            return 'sell', log_msg, "🔴 Kumo Breakout DOWN! SELLING..."
+        return 'hold', log_msg, None
+
+
+class AiEnhancedSignalEvaluator(SignalEvaluator):
+    history_size = 205
+    min_history = 200  # Needed for AI feature engineering
+    offload = True
+    fast_ema = 10
+    slow_ema = 30
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.confidence_threshold = params.get('confidence_threshold', 0.2)
+
+    def evaluate(self, features):
+        candle = features.latest
+
+        # Base Logic (EMA Cross)
+        ema_fast = features.ema(self.fast_ema)
+        ema_slow = features.ema(self.slow_ema)
+        base_buy = ema_fast.iloc[-1] > ema_slow.iloc[-1] and ema_fast.iloc[-2] <= ema_slow.iloc[-2]
+        base_sell = ema_fast.iloc[-1] < ema_slow.iloc[-1] and ema_fast.iloc[-2] >= ema_slow.iloc[-2]
+
+        if not base_buy and not base_sell:
+            return 'hold', f"📊 Analysis: Price ${candle.close:.2f} | AI Ready.", None
+
+        # Run AI only on signal
+        ai_score = ml_service.analyze_market_conditions(features.frame()).get("score", 0)
+        log_msg = f"🤖 Base Signal detected. Optimus AI score: {ai_score:.2f} | Price ${candle.close:.2f}"
+        if base_buy:
+            if ai_score > self.confidence_threshold:
+                return 'buy', log_msg, f"🟢 AI Confirmed (Score: {ai_score:.2f})! BUYING..."
+            return 'hold', f"⛔ AI Vetoed Buy (Score: {ai_score:.2f} < {self.confidence_threshold}).", None
+        if ai_score < -self.confidence_threshold:  # Confidence in bearishness
+            return 'sell', log_msg, f"🔴 AI Confirmed (Score: {ai_score:.2f})! SELLING..."
+        return 'hold', log_msg, None
+
+
+class OptimizerPortfolioSignalEvaluator(SignalEvaluator):
+    history_size = 255
+    min_history = 250
+    offload = True
+
+    def __init__(self, params: Dict[str, Any], symbol: str):
+        super().__init__(params, symbol)
+        self.min_confluence = params.get('min_confluence', 2)
+        self.trend_filter_period = params.get('trend_filter_period', 200)
+        # Instantiate sub-strategies with empty state and their schema defaults
+        self.sub_strategies = []
+        for name in params.get('strategy_pool', ["RSI_MACD_Crossover", "MA_Cross"]):
+            StrategyClass = STRATEGY_REGISTRY.get(name)
+            if StrategyClass and name != "Optimizer_Portfolio":
+                sub_params = StrategyClass.get_parameter_schema()().model_dump()
+                self.sub_strategies.append(StrategyClass(0, self.symbol, '1m', sub_params, {}))
+
+    def evaluate(self, features):
+        candle = features.latest
+
+        buy_votes = 0
+        sell_votes = 0
+        for sub in self.sub_strategies:
+            sub.update_features(features)  # Shared indicators, private DataFrame copy
+            signal_obj = sub.generate_signal()
+            if signal_obj.action == "BUY":
+                buy_votes += 1
+            elif signal_obj.action == "SELL":
+                sell_votes += 1
+
+        # Trend Filter
+        long_ema = features.ema(self.trend_filter_period).iloc[-1]
+        is_uptrend = candle.close > long_ema
+        trend_str = "UP" if is_uptrend else "DOWN"
+        log_msg = f"🗳️ Votes: {buy_votes} BUY / {sell_votes} SELL | Trend: {trend_str}"
+
+        if buy_votes >= self.min_confluence and is_uptrend:
+            return 'buy', log_msg, f"🏆 Confluence Reached ({buy_votes} Votes)! BUYING..."
+        if sell_votes >= self.min_confluence and not is_uptrend:
+            return 'sell', log_msg, f"🏆 Confluence Reached ({sell_votes} Votes)! SELLING..."
+        return 'hold', log_msg, None
+
+
+SIGNAL_EVALUATOR_REGISTRY = {
+    "RSI_MACD_Crossover": RsiMacdSignalEvaluator,
+    "MA_Cross": MaCrossSignalEvaluator,
+    "Bollinger_Bands": BollingerBandsSignalEvaluator,
+    "Smart_Money_Concepts": SmcSignalEvaluator,
+    "Volatility_Squeeze": VolatilitySqueezeSignalEvaluator,
+    "SuperTrend_ADX_Filter": SuperTrendAdxSignalEvaluator,
+    "Ichimoku_Cloud_Breakout": IchimokuSignalEvaluator,
+    "AI_Signal_Confirmation": AiEnhancedSignalEvaluator,
+    "Optimizer_Portfolio": OptimizerPortfolioSignalEvaluator,
+    "Visual_Strategy_Builder": VisualSignalEvaluator,
+}
+
+
+# --- NEW: Process pool for CPU-heavy evaluators ---
+_worker_evaluators: Dict[tuple, SignalEvaluator] = {}
+
+
+def _evaluate_in_worker(strategy_name: str, params: Dict[str, Any], symbol: str,
+                        snapshot: Dict[str, Any]) -> Tuple[str, Optional[str], Optional[str]]:
+    """Pool entry point. Evaluators are rebuilt once per worker and configuration, then reused."""
+    key = (strategy_name, json.dumps(params, sort_keys=True), symbol)
+    evaluator = _worker_evaluators.get(key)
+    if evaluator is None:
+        if len(_worker_evaluators) >= 256:
+            _worker_evaluators.clear()
+        evaluator = SIGNAL_EVALUATOR_REGISTRY[strategy_name](params, symbol)
+        _worker_evaluators[key] = evaluator
+    return evaluator.evaluate(FeatureSet.from_snapshot(snapshot))
+
+
+class StrategyExecutor:
+    """
+    Ships FeatureSet snapshots of offloaded evaluators to a process pool, so a burst of
+    candle closes at the top of the minute doesn't stall websockets and HTTP handlers.
+    The pool starts lazily, after the AI models are loaded, so forked workers inherit them.
+    """
+
+    def __init__(self):
+        self.max_workers = settings.STRATEGY_POOL_WORKERS or max(1, (os.cpu_count() or 2) - 1)
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def submit(self, strategy_name: str, evaluator: SignalEvaluator, features: FeatureSet) -> asyncio.Future:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            logger.info(f"Started strategy process pool with {self.max_workers} workers.")
+        args = (strategy_name, evaluator.params, evaluator.symbol, features.snapshot())
+        try:
+            return asyncio.get_running_loop().run_in_executor(self._pool, _evaluate_in_worker, *args)
+        except BrokenProcessPool:
+            self.reset()
+            return self.submit(strategy_name, evaluator, features)
+
+    def reset(self):
+        """Drops a broken pool; the next submit starts a fresh one."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def shutdown(self):
+        self.reset()
+
+
+strategy_executor = StrategyExecutor()
+
+
+class SignalChannel:
+    """One shared evaluator, the stream's FeatureSet and the bot queues it fans out to."""
+
+    def __init__(self, key: tuple, exchange: str, symbol: str, evaluator: SignalEvaluator, timeframe: str = '1m'):
+        self.key = key
+        self.exchange = exchange
+        self.symbol = symbol
+        self.timeframe = timeframe
+        self.evaluator = evaluator
+        self.features = feature_store.get(exchange, symbol, timeframe, evaluator.history_size)
+        self.subscribers: List[SubscriberQueue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    def publish(self, event: SignalEvent):
+        for queue in self.subscribers:
+            queue.offer(event)
+
+
+class SignalMulticaster:
+    def __init__(self):
+        self._channels: Dict[tuple, SignalChannel] = {}
+
+    @staticmethod
+    def supports(strategy_name: str) -> bool:
+        return strategy_name in SIGNAL_EVALUATOR_REGISTRY
+
+    @staticmethod
+    def get_channel_key(bot: TradingBot) -> tuple:
+        """(stream, timeframe, strategy, params hash). Params are canonicalised so key order and whitespace don't matter."""
+        raw_config = bot.visual_strategy_json if bot.strategy_name == "Visual_Strategy_Builder" else bot.strategy_params
+        canonical = json.dumps(json.loads(raw_config or "{}"), sort_keys=True, separators=(",", ":"))
+        params_hash = hashlib.sha256(canonical.encode()).hexdigest()[:16]
+        return f"{bot.exchange}:{bot.symbol}".lower(), bot.timeframe, bot.strategy_name, params_hash
+
+    def subscribe(self, bot: TradingBot) -> SubscriberQueue:
+        """A bot calls this to receive the shared signal stream for its configuration."""
+        key = self.get_channel_key(bot)
+        channel = self._channels.get(key)
+        if channel is None:
+            raw_config = bot.visual_strategy_json if bot.strategy_name == "Visual_Strategy_Builder" else bot.strategy_params
+            config = json.loads(raw_config or "{}")
+            evaluator = SIGNAL_EVALUATOR_REGISTRY[bot.strategy_name](config, bot.symbol)
+            channel = SignalChannel(key, bot.exchange, bot.symbol, evaluator, bot.timeframe)
+            self._channels[key] = channel
+            logger.info(f"Starting signal channel {key}")
+            channel.task = asyncio.create_task(self._run_channel(channel))
+
+        # A lagging bot loses its oldest events rather than acting late on stale signals.
+        queue = SubscriberQueue("drop_oldest", name=f"bot:{bot.id}")
+        channel.subscribers.append(queue)
+        return queue
+
+    async def unsubscribe(self, queue: asyncio.Queue, key: tuple):
+        channel = self._channels.get(key)
+        if not channel:
+            return
+        if queue in channel.subscribers:
+            channel.subscribers.remove(queue)
+
+        # If there are no more subscribers, stop evaluating this configuration.
+        if not channel.subscribers:
+            logger.info(f"Closing signal channel {key} due to no subscribers.")
+            del self._channels[key]
+            if channel.task:
+                channel.task.cancel()
+
+    async def _hydrate(self, channel: SignalChannel):
+        """Backfills the stream's shared FeatureSet, unless another consumer already has."""
+        try:
+            channel.publish(SignalEvent(None, 'info', "📥 Fetching historical data..."))
+            await feature_store.backfill(channel.features, channel.evaluator.history_size)
+            channel.publish(SignalEvent(None, 'info', f"✅ Hydrated with {len(channel.features.candles)} candles."))
+        except Exception as e:
+            logger.error(f"Hydration failed for signal channel {channel.key}: {e}")
+
+    def get_subscriber_stats(self) -> Dict[str, List[Dict[str, Any]]]:
+        return {":".join(key): [queue.stats() for queue in channel.subscribers]
+                for key, channel in self._channels.items()}
+
+    async def _run_channel(self, channel: SignalChannel):
+        # Conflating: the FeatureSet already holds every candle, so only the newest needs evaluating.
+        data_queue = await market_streamer.subscribe(channel.symbol, channel.exchange, "conflate",
+                                                     name=f"channel:{':'.join(channel.key)}",
+                                                     timeframe=channel.timeframe)
+        try:
+            await self._hydrate(channel)
+            evaluator = channel.evaluator
+            features = channel.features
+            while True:
+                candle: Candle = await data_queue.get()
+                # The streamer has already added this candle to the FeatureSet. If a newer one is
+                # queued behind it, skip ahead rather than evaluating stale data twice.
+                if features.latest is not candle and not data_queue.empty():
+                    continue
+
+                collected = len(features.candles)
+                if collected < evaluator.min_history:
+                    if collected % evaluator.warmup_log_every == 0:
+                        channel.publish(SignalEvent(candle, 'info',
+                                                    f"⏳ Gathering data: {collected}/{evaluator.min_history} candles..."))
+                    continue
+
+                try:
+                    if evaluator.offload:
+                        result = await self._evaluate_offloaded(channel, data_queue)
+                        if result is None:
+                            continue
+                    else:
+                        result = evaluator.evaluate(features)
+                    action, message, trigger = result
+                    channel.publish(SignalEvent(candle, action, message, trigger))
+                except Exception as e:
+                    logger.error(f"Signal evaluation error in channel {channel.key}: {e}", exc_info=True)
+                    channel.publish(SignalEvent(candle, 'error', f"Logic Error: {e}"))
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await market_streamer.unsubscribe(data_queue, channel.symbol, channel.exchange, channel.timeframe)
+
+    async def _evaluate_offloaded(self, channel: SignalChannel,
+                                  data_queue: asyncio.Queue) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        """
+        Evaluates in the process pool. Returns None when the result would be stale: the next
+        candle arrived first, or the evaluator's deadline passed.
+        """
+        evaluator = channel.evaluator
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + evaluator.evaluation_deadline
+        future = strategy_executor.submit(channel.key[2], evaluator, channel.features)
+        try:
+            while not future.done():
+                if not data_queue.empty():
+                    logger.info(f"Dropped stale evaluation in signal channel {channel.key}; a newer candle arrived.")
+                    return None
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    channel.publish(SignalEvent(channel.features.latest, 'info',
+                                                f"⏱️ Analysis exceeded {evaluator.evaluation_deadline:.0f}s. Candle skipped."))
+                    return None
+                await asyncio.wait({future}, timeout=min(0.25, remaining))
+            return future.result()
+        except BrokenProcessPool:
+            logger.error(f"Strategy process pool broke while evaluating {channel.key}. Evaluating in-process.")
+            strategy_executor.reset()
+            return evaluator.evaluate(channel.features)
+        finally:
+            future.cancel()  # No-op once done; otherwise the worker's result is discarded
+
+    async def close(self):
+        for channel in list(self._channels.values()):
+            if channel.task:
+                channel.task.cancel()
+        self._channels.clear()
+
+
+signal_multicaster = SignalMulticaster()
+
+
+# --- NEW: Multi-Symbol Market Scanner ---
+class ScannerBuffer:
+    """
+    Columnar OHLCV history for the whole scan universe: one row per symbol, one column per
+    candle, oldest first, NaN until a row has a full window. Kernels read whole columns at
+    once, so a scan costs a handful of array operations rather than a DataFrame per symbol.
+    """
+
+    def __init__(self, window: int, rows: int = 64):
+        self.window = window
+        self.symbols: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.last_ts = np.zeros(rows, dtype=np.int64)
+        self.columns = {name: np.full((rows, window), np.nan) for name in ("open", "high", "low", "close", "volume")}
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def add_symbol(self, symbol: str) -> int:
+        if symbol in self.rows:
+            return self.rows[symbol]
+        row = len(self.symbols)
+        if row == len(self.last_ts):
+            grow = len(self.last_ts)
+            self.last_ts = np.concatenate([self.last_ts, np.zeros(grow, dtype=np.int64)])
+            for name, column in self.columns.items():
+                self.columns[name] = np.vstack([column, np.full((grow, self.window), np.nan)])
+        self.symbols.append(symbol)
+        self.rows[symbol] = row
+        return row
+
+    def load(self, row: int, candles: List[Candle]):
+        candles = candles[-self.window:]
+        if not candles:
+            return
+        for name, column in self.columns.items():
+            column[row, :] = np.nan
+            column[row, -len(candles):] = [getattr(c, name) for c in candles]
+        self.last_ts[row] = candles[-1].timestamp
+
+    def append(self, row: int, candle: Candle):
+        if candle.timestamp < self.last_ts[row]:
+            return  # Out of order; the row is already ahead
+        shift = candle.timestamp > self.last_ts[row]
+        for name, column in self.columns.items():
+            if shift:
+                column[row, :-1] = column[row, 1:]
+            column[row, -1] = getattr(candle, name)
+        self.last_ts[row] = candle.timestamp
+
+    def snapshot(self) -> Dict[str, np.ndarray]:
+        """A consistent copy of the used rows, safe to scan off the event loop."""
+        n = len(self.symbols)
+        return {name: column[:n].copy() for name, column in self.columns.items()}
+
+
+def _scan_ema(values: np.ndarray, span: int) -> np.ndarray:
+    """Row-wise EMA matching pandas' ewm(span, adjust=False); each row starts at its first valid value."""
+    alpha = 2.0 / (span + 1)
+    out = np.empty_like(values)
+    ema = values[:, 0].copy()
+    out[:, 0] = ema
+    for i in range(1, values.shape[1]):
+        x = values[:, i]
+        ema = np.where(np.isnan(ema), x, alpha * x + (1 - alpha) * ema)
+        out[:, i] = ema
+    return out
+
+
+def _scan_sma(values: np.ndarray, period: int, lag: int = 0) -> np.ndarray:
+    end = values.shape[1] - lag
+    return values[:, end - period:end].mean(axis=1)
+
+
+def _scan_true_range(cols: Dict[str, np.ndarray]) -> np.ndarray:
+    prev_close = np.concatenate([np.full((cols["close"].shape[0], 1), np.nan), cols["close"][:, :-1]], axis=1)
+    return np.fmax(cols["high"] - cols["low"],
+                   np.fmax(np.abs(cols["high"] - prev_close), np.abs(cols["low"] - prev_close)))
+
+
+def _scan_ma_cross(cols: Dict[str, np.ndarray], ev: "MaCrossSignalEvaluator") -> np.ndarray:
+    close = cols["close"]
+    now = _scan_sma(close, ev.short_window) > _scan_sma(close, ev.long_window)
+    before = _scan_sma(close, ev.short_window, 1) > _scan_sma(close, ev.long_window, 1)
+    return np.where(now & ~before, 1, np.where(~now & before, -1, 0))
+
+
+def _scan_rsi_macd(cols: Dict[str, np.ndarray], ev: "RsiMacdSignalEvaluator") -> np.ndarray:
+    close = cols["close"]
+    delta = np.diff(close[:, -(ev.rsi_period + 1):], axis=1)
+    gain = np.where(delta > 0, delta, 0).mean(axis=1)
+    loss = np.where(delta < 0, -delta, 0).mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = 100 - 100 / (1 + gain / loss)
+    macd = _scan_ema(close, ev.macd_fast) - _scan_ema(close, ev.macd_slow)
+    hist = macd - _scan_ema(macd, ev.macd_signal_period)
+    crossed_up = (hist[:, -1] > 0) & (hist[:, -2] <= 0)
+    crossed_down = (hist[:, -1] <= 0) & (hist[:, -2] > 0)
+    return np.where((rsi < ev.rsi_oversold) & crossed_up, 1,
+                    np.where((rsi > ev.rsi_overbought) & crossed_down, -1, 0))
+
+
+def _scan_bollinger(cols: Dict[str, np.ndarray], ev: "BollingerBandsSignalEvaluator") -> np.ndarray:
+    window = cols["close"][:, -ev.window:]
+    mid, std = window.mean(axis=1), window.std(axis=1, ddof=1)
+    close = cols["close"][:, -1]
+    return np.where(close <= mid - ev.std_dev * std, 1, np.where(close >= mid + ev.std_dev * std, -1, 0))
+
+
+def _scan_volatility_squeeze(cols: Dict[str, np.ndarray], ev: "VolatilitySqueezeSignalEvaluator") -> np.ndarray:
+    close = cols["close"]
+    kc_mid = _scan_ema(close, ev.kc_period)
+    kc_range = _scan_ema(_scan_true_range(cols), ev.kc_period) * ev.kc_atr_mult
+
+    def squeeze(lag: int):
+        window = close[:, close.shape[1] - lag - ev.bb_period:close.shape[1] - lag]
+        mid, std = window.mean(axis=1), window.std(axis=1)
+        bb_upper, bb_lower = mid + ev.bb_std * std, mid - ev.bb_std * std
+        i = -1 - lag
+        return (bb_lower > kc_mid[:, i] - kc_range[:, i]) & (bb_upper < kc_mid[:, i] + kc_range[:, i]), bb_upper
+
+    squeeze_now, bb_upper = squeeze(0)
+    squeeze_before, _ = squeeze(1)
+    return np.where(squeeze_before & ~squeeze_now & (close[:, -1] > bb_upper), 1, 0)
+
+
+def _scan_ichimoku(cols: Dict[str, np.ndarray], ev: "IchimokuSignalEvaluator") -> np.ndarray:
+    high, low, close = cols["high"], cols["low"], cols["close"]
+
+    def midpoint(period: int, lag: int) -> np.ndarray:
+        end = high.shape[1] - lag
+        return (high[:, end - period:end].max(axis=1) + low[:, end - period:end].min(axis=1)) / 2
+
+    def cloud(lag: int) -> Tuple[np.ndarray, np.ndarray]:
+        # The spans plotted at a candle were computed kijun candles earlier.
+        shifted = lag + ev.kijun
+        span_a = (midpoint(ev.tenkan, shifted) + midpoint(ev.kijun, shifted)) / 2
+        span_b = midpoint(ev.senkou, shifted)
+        return np.fmax(span_a, span_b), np.fmin(span_a, span_b)
+
+    top, bottom = cloud(0)
+    prev_top, prev_bottom = cloud(1)
+    return np.where((close[:, -1] > top) & (close[:, -2] <= prev_top), 1,
+                    np.where((close[:, -1] < bottom) & (close[:, -2] >= prev_bottom), -1, 0))
+
+
+# Vectorized twins of the stateless evaluators in SIGNAL_EVALUATOR_REGISTRY, run with each evaluator's
+# default parameters. Path-dependent (SuperTrend) and model/pattern-based evaluators aren't scanned.
+SCANNER_KERNELS: Dict[str, Callable[[Dict[str, np.ndarray], SignalEvaluator], np.ndarray]] = {
+    "MA_Cross": _scan_ma_cross,
+    "RSI_MACD_Crossover": _scan_rsi_macd,
+    "Bollinger_Bands": _scan_bollinger,
+    "Volatility_Squeeze": _scan_volatility_squeeze,
+    "Ichimoku_Cloud_Breakout": _scan_ichimoku,
+}
+
+
+class MarketScanner:
+    """
+    Scans a universe of symbols on the shared market stream. Each closed candle is written into
+    a ScannerBuffer row; once a burst of closes settles, every kernel in SCANNER_KERNELS runs across
+    all rows at once, alongside the regime features MarketRegimeService uses (close and 50 MA
+    against the 200 MA), relative volume and volatility. The ranked opportunities are pushed to
+    websocket viewers every SCANNER_PUBLISH_SECONDS.
+    """
+    WINDOW = 260  # 200 MA plus the previous candle, and the Ichimoku cloud's 52 + 26 lookback
+    SETTLE_SECONDS = 0.5  # Closes for one candle arrive in a burst; scan once it has settled
+    HYDRATE_CONCURRENCY = 10
+
+    def __init__(self):
+        self.exchange = settings.SCANNER_EXCHANGE
+        self.timeframe = settings.SCANNER_TIMEFRAME
+        self.buffer = ScannerBuffer(self.WINDOW)
+        self.evaluators = {name: SIGNAL_EVALUATOR_REGISTRY[name]({}, "*") for name in SCANNER_KERNELS}
+        self._dirty = asyncio.Event()
+        self._feeds: Dict[str, asyncio.Task] = {}
+        self.results: List[Dict[str, Any]] = []
+        self.scanned_at: Optional[datetime.datetime] = None
+        self.scan_ms = 0.0
+        self.scans = 0
+
+    async def _resolve_universe(self) -> List[str]:
+        if settings.SCANNER_SYMBOLS:
+            symbols = [s.strip().upper() for s in settings.SCANNER_SYMBOLS.split(",") if s.strip()]
+        else:
+            client = await exchange_manager.get_public_client(self.exchange)
+            markets = await client.load_markets()
+            symbols = sorted(m["symbol"] for m in markets.values()
+                             if m.get("spot") and m.get("active") and m.get("quote") == "USDT")
+        return symbols[:settings.SCANNER_MAX_SYMBOLS]
+
+    async def _hydrate(self, symbol: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                features = await feature_store.get_fresh(self.exchange, symbol, self.timeframe, self.WINDOW)
+                self.buffer.load(self.buffer.rows[symbol], list(features.candles))
+            except Exception as e:
+                logger.warning(f"Scanner could not hydrate {symbol}: {e}")
+
+    async def _run_feed(self, symbol: str):
+        row = self.buffer.rows[symbol]
+        queue = await market_streamer.subscribe(symbol, self.exchange, "conflate",
+                                                name=f"scanner:{symbol}", timeframe=self.timeframe)
+        try:
+            while True:
+                self.buffer.append(row, await queue.get())
+                self._dirty.set()
+        finally:
+            await market_streamer.unsubscribe(queue, symbol, self.exchange, self.timeframe)
+
+    def scan(self, cols: Dict[str, np.ndarray], symbols: List[str]) -> List[Dict[str, Any]]:
+        """Runs every kernel over the snapshot and ranks the symbols with at least one signal."""
+        votes = {name: kernel(cols, self.evaluators[name]) for name, kernel in SCANNER_KERNELS.items()}
+        net = np.sum(list(votes.values()), axis=0)
+
+        close = cols["close"][:, -1]
+        ma_50, ma_200 = _scan_sma(cols["close"], 50), _scan_sma(cols["close"], 200)
+        regime = np.where((close > ma_200) & (ma_50 > ma_200), 1, np.where((close < ma_200) & (ma_50 < ma_200), -1, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rel_volume = cols["volume"][:, -1] / _scan_sma(cols["volume"], 20, 1)
+            volatility = _scan_sma(_scan_true_range(cols), 14) / close
+            change = close / cols["close"][:, -2] - 1
+        # Net strategy votes, plus half a point when the regime agrees and up to half for a volume surge.
+        score = np.abs(net) + 0.5 * (regime == np.sign(net)) + 0.5 * np.clip(np.nan_to_num(rel_volume) / 3, 0, 1)
+
+        regimes = {1: MarketRegime.BULLISH.value, -1: MarketRegime.BEARISH.value, 0: MarketRegime.SIDEWAYS.value}
+        results = []
+        for i in np.flatnonzero((net != 0) & ~np.isnan(ma_200)):
+            results.append({
+                "symbol": symbols[i],
+                "direction": "long" if net[i] > 0 else "short",
+                "score": round(float(score[i]), 3),
+                "signals": {name: ("buy" if v[i] > 0 else "sell") for name, v in votes.items() if v[i] != 0},
+                "regime": regimes[int(regime[i])],
+                "price": float(close[i]),
+                "change_pct": round(float(change[i]) * 100, 3),
+                "relative_volume": round(float(np.nan_to_num(rel_volume[i])), 2),
+                "volatility_pct": round(float(np.nan_to_num(volatility[i])) * 100, 3),
+            })
+        results.sort(key=lambda r: r["score"], reverse=True)
+        return results[:settings.SCANNER_TOP_N]
+
+    async def _run_scans(self):
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(self.SETTLE_SECONDS)
+            self._dirty.clear()
+            started = time.perf_counter()
+            cols, symbols = self.buffer.snapshot(), list(self.buffer.symbols)
+            try:
+                self.results = await asyncio.to_thread(self.scan, cols, symbols)
+                self.scanned_at = datetime.datetime.now(datetime.timezone.utc)
+                self.scans += 1
+            except Exception as e:
+                logger.error(f"Market scan failed: {e}", exc_info=True)
+            self.scan_ms = (time.perf_counter() - started) * 1000
+
+    async def _run_publisher(self):
+        while True:
+            await asyncio.sleep(settings.SCANNER_PUBLISH_SECONDS)
+            if self.scanned_at is not None:
+                await websocket_manager.broadcast_to_scanner_viewers(self.get_results())
+
+    def get_results(self) -> Dict[str, Any]:
+        return {"type": "scanner_update", "exchange": self.exchange, "timeframe": self.timeframe,
+                "scanned_at": self.scanned_at.isoformat() if self.scanned_at else None,
+                "universe": len(self.buffer), "opportunities": self.results}
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"symbols": len(self.buffer), "feeds": len(self._feeds), "scans": self.scans,
+                "last_scan_ms": round(self.scan_ms, 2)}
+
+    async def run(self):
+        """Resolves the universe, hydrates the buffer, then scans and publishes until cancelled."""
+        symbols = await self._resolve_universe()
+        for symbol in symbols:
+            self.buffer.add_symbol(symbol)
+        semaphore = asyncio.Semaphore(self.HYDRATE_CONCURRENCY)
+        await asyncio.gather(*(self._hydrate(symbol, semaphore) for symbol in symbols))
+        for symbol in symbols:
+            self._feeds[symbol] = asyncio.create_task(self._run_feed(symbol))
+        logger.info(f"Market scanner running over {len(symbols)} {self.exchange} symbols ({self.timeframe}).")
+        try:
+            await asyncio.gather(self._run_scans(), self._run_publisher())
+        finally:
+            for task in self._feeds.values():
+                task.cancel()
+            await asyncio.gather(*self._feeds.values(), return_exceptions=True)
+            self._feeds.clear()
+
+
+market_scanner = MarketScanner()
+
+
+# --- NEW: In-Process Bot Registry ---
+class BotRegistryEntry(NamedTuple):
+    owner_id: str
+    subscription_expires_at: Optional[datetime.datetime]  # None means no expiry applies
+
+
+class BotRegistry:
+    """
+    Authoritative, in-process record of which bots are running. Strategy loops check it
+    on every candle instead of querying the database. start_bot activates entries;
+    stop_bot, the kill switch, subscription expiry and any ORM write of
+    `TradingBot.is_active = False` (see the listener below) deactivate them.
+    """
+
+    def __init__(self):
+        self._entries: Dict[PythonUUID, BotRegistryEntry] = {}
+        self._expired: set = set()
+
+    def activate(self, bot: TradingBot, user: User):
+        expires_at = None
+        if user.role != UserRole.SUPERUSER.value and user.subscription_expires_at is not None:
+            expires_at = user.subscription_expires_at
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+        self._entries[bot.id] = BotRegistryEntry(user.id, expires_at)
+        self._expired.discard(bot.id)
+
+    def deactivate(self, bot_id: PythonUUID):
+        self._entries.pop(bot_id, None)
+
+    def deactivate_user(self, user_id: str) -> List[PythonUUID]:
+        bot_ids = [bot_id for bot_id, entry in self._entries.items() if entry.owner_id == user_id]
+        for bot_id in bot_ids:
+            self.deactivate(bot_id)
+        return bot_ids
+
+    def deactivate_all(self) -> List[PythonUUID]:
+        bot_ids = list(self._entries)
+        self._entries.clear()
+        return bot_ids
+
+    def is_active(self, bot_id: PythonUUID) -> bool:
+        entry = self._entries.get(bot_id)
+        if entry is None:
+            return False
+        if entry.subscription_expires_at and entry.subscription_expires_at <= datetime.datetime.now(datetime.timezone.utc):
+            logger.info(f"Bot {bot_id} halted: owner's subscription expired.")
+            self.deactivate(bot_id)
+            self._expired.add(bot_id)
+            return False
+        return True
+
+    def pop_expired(self, bot_id: PythonUUID) -> bool:
+        """True (once) if the bot was halted because its owner's subscription lapsed."""
+        if bot_id in self._expired:
+            self._expired.discard(bot_id)
+            return True
+        return False
+
+    def active_count(self) -> int:
+        return len(self._entries)
+
+
+bot_registry = BotRegistry()
+
+
+@event.listens_for(TradingBot.is_active, "set")
+def _deactivate_registered_bot(target, value, oldvalue, initiator):
+    """Any code path that switches a bot off also halts its in-process loop immediately."""
+    if not value and target.id is not None:
+        bot_registry.deactivate(target.id)
+
+
+# --- NEW: Grid order venues (batch placement + pushed order updates) ---
+class GridOrderVenue(ABC):
+    """
+    Where a grid bot rests its limit orders. `place_orders` sends a whole batch at once and
+    `next_updates` returns the bot's orders as soon as the venue reports them filled or
+    cancelled, so a fill is re-gridded without waiting on a poll.
+    """
+    TERMINAL_STATUSES = ('closed', 'canceled', 'expired', 'rejected')
+    EARLY_UPDATE_CAPACITY = 256
+
+    def __init__(self, symbol: str):
+        self.symbol = symbol
+        self.open_orders: Dict[str, Dict] = {}
+        # Updates that beat their order's placement response (a fill can arrive before create_order returns).
+        self._early: Dict[str, Dict] = {}
+        self._updates: asyncio.Queue = asyncio.Queue()
+        self._pump_task: Optional[asyncio.Task] = None
+
+    @abstractmethod
+    async def fetch_price(self) -> Decimal:
+        pass
+
+    @abstractmethod
+    async def _submit(self, orders: List[Dict]) -> List[Dict]:
+        """Sends limit orders ({"side", "amount", "price"}) and returns the venue's order dicts."""
+        pass
+
+    @abstractmethod
+    async def _pump(self):
+        """Feeds every order update the venue reports into `_on_order_update` until cancelled."""
+        pass
+
+    @abstractmethod
+    async def cancel_all_orders(self):
+        pass
+
+    def start(self):
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def place_orders(self, orders: List[Dict]) -> List[Dict]:
+        if not orders:
+            return []
+        placed = []
+        for request, order in zip(orders, await self._submit(orders)):
+            if not order or not order.get('id'):
+                continue
+            # Some exchanges acknowledge with a bare id; keep what we asked for alongside it.
+            order = {**request, **{k: v for k, v in order.items() if v is not None}}
+            self.open_orders[order['id']] = order
+            placed.append(order)
+            if order['id'] in self._early:
+                self._on_order_update(self._early.pop(order['id']))
+        return placed
+
+    def _on_order_update(self, order: Dict):
+        if order.get('status') not in self.TERMINAL_STATUSES:
+            return
+        order_id = order.get('id')
+        if order_id in self.open_orders:
+            known = self.open_orders.pop(order_id)
+            self._updates.put_nowait({**known, **{k: v for k, v in order.items() if v is not None}})
+        elif order_id is not None:
+            self._early[order_id] = order
+            while len(self._early) > self.EARLY_UPDATE_CAPACITY:
+                self._early.pop(next(iter(self._early)))
+
+    async def next_updates(self, timeout: float) -> List[Dict]:
+        """Waits up to `timeout` seconds for finished orders and returns all that are ready."""
+        if self._pump_task is not None and self._pump_task.done():
+            # Surface a dead feed instead of waiting forever for fills that will never be reported.
+            self._pump_task.result()
+            raise ConnectionError("Grid order update feed stopped.")
+        try:
+            updates = [await asyncio.wait_for(self._updates.get(), timeout)]
+        except asyncio.TimeoutError:
+            return []
+        while not self._updates.empty():
+            updates.append(self._updates.get_nowait())
+        return updates
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._pump_task = None
+
+
+class CcxtGridVenue(GridOrderVenue):
+    """
+    Live exchange venue. Orders go out through ccxt's createOrders batch endpoint where the
+    exchange has one, otherwise concurrently (ccxt's rate limiter spaces the requests).
+    Fills arrive over the exchange's private order stream (ccxt.pro watch_orders); exchanges
+    without one fall back to polling open orders.
+    """
+    BATCH_LIMITS = {'binance': 5, 'bybit': 10, 'okx': 20, 'kucoin': 5}
+    POLL_INTERVAL = 5.0
+
+    def __init__(self, adapter: CcxtClient, symbol: str):
+        super().__init__(symbol)
+        self._adapter = adapter
+        self._client = adapter._client
+        self._stream: Optional[ccxt.Exchange] = None
+        self._batch_supported = bool(self._client.has.get('createOrders'))
+
+    async def fetch_price(self) -> Decimal:
+        ticker = await self._client.fetch_ticker(self.symbol)
+        return Decimal(str(ticker['last']))
+
+    async def _submit(self, orders: List[Dict]) -> List[Dict]:
+        if self._batch_supported:
+            try:
+                return await self._submit_batches(orders)
+            except ccxt.NotSupported as e:
+                # e.g. Binance only batches derivatives orders.
+                logger.info(f"{self._client.id} rejected batch orders for {self.symbol} ({e}); sending individually.")
+                self._batch_supported = False
+
+        results = await asyncio.gather(
+            *(self._client.create_limit_order(self.symbol, o['side'], o['amount'], o['price']) for o in orders),
+            return_exceptions=True)
+        placed = []
+        for order, result in zip(orders, results):
+            if isinstance(result, Exception):
+                logger.error(f"Grid order {order['side']} @ {order['price']} failed: {result}")
+                placed.append(None)
+            else:
+                placed.append(result)
+        return placed
+
+    async def _submit_batches(self, orders: List[Dict]) -> List[Dict]:
+        size = self.BATCH_LIMITS.get(self._client.id, 5)
+        requests = [{'symbol': self.symbol, 'type': 'limit', 'side': o['side'], 'amount': o['amount'],
+                     'price': o['price']} for o in orders]
+        placed = []
+        for start in range(0, len(requests), size):
+            placed.extend(await self._client.create_orders(requests[start:start + size]))
+        return placed
+
+    async def _reconcile(self):
+        """Catches fills missed while no stream was listening by diffing against open orders."""
+        known = set(self.open_orders)
+        open_ids = {o['id'] for o in await self._client.fetch_open_orders(self.symbol)}
+        for order_id in known - open_ids:
+            order = self.open_orders.get(order_id)
+            if order is None:
+                continue
+            try:
+                self._on_order_update(await self._client.fetch_order(order_id, self.symbol))
+            except Exception:
+                # Gone from the book without a readable status: treat it as filled.
+                self._on_order_update({**order, 'status': 'closed'})
+
+    async def _pump(self):
+        stream_class = getattr(ccxtpro, self._client.id, None)
+        if stream_class is not None:
+            self._stream = stream_class({
+                'apiKey': self._client.apiKey,
+                'secret': self._client.secret,
+                'password': self._client.password,
+                'enableRateLimit': True,
+                'options': {'defaultType': self._client.options.get('defaultType', 'spot')},
+            })
+            self._stream.set_markets(self._client.markets, self._client.currencies)
+        if self._stream is None or not self._stream.has.get('watchOrders'):
+            logger.info(f"{self._client.id} has no order stream; polling {self.symbol} every {self.POLL_INTERVAL}s.")
+            while True:
+                await asyncio.sleep(self.POLL_INTERVAL)
+                try:
+                    await self._reconcile()
+                except Exception as e:
+                    logger.warning(f"Grid order poll failed for {self.symbol}: {e}")
+
+        attempt = 0
+        while True:
+            try:
+                for order in await self._stream.watch_orders(self.symbol):
+                    self._on_order_update(order)
+                attempt = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                attempt += 1
+                delay = random.uniform(0, min(StreamConnection.RECONNECT_MAX_DELAY,
+                                              StreamConnection.RECONNECT_BASE_DELAY * 2 ** attempt))
+                logger.warning(f"Order stream for {self.symbol} on {self._client.id} failed ({e}); "
+                               f"reconnecting in {delay:.1f}s.")
+                await asyncio.sleep(delay)
+                try:
+                    await self._reconcile()
+                except Exception as e:
+                    logger.warning(f"Grid order reconcile failed for {self.symbol}: {e}")
+
+    async def cancel_all_orders(self):
+        await self._client.cancel_all_orders(self.symbol)
+        self.open_orders.clear()
+
+    async def close(self):
+        await super().close()
+        if self._stream is not None:
+            await self._stream.close()
+        await self._adapter.close()
+
+
+class SimulatedGridVenue(GridOrderVenue):
+    """
+    Local matching for paper grid bots and tests: a resting buy fills when the market trades
+    down to its price, a sell when it trades up to it. Driven by the shared 1m kline stream,
+    or directly through `match()`.
+    """
+
+    def __init__(self, exchange: str, symbol: str):
+        super().__init__(symbol)
+        self.exchange = exchange
+
+    async def fetch_price(self) -> Decimal:
+        history = await market_streamer.get_history(self.symbol, self.exchange, 1)
+        if not history:
+            raise ConnectionError(f"No market data for {self.symbol} on {self.exchange}.")
+        return Decimal(str(history[-1].close))
+
+    async def _submit(self, orders: List[Dict]) -> List[Dict]:
+        return [{'id': f"sim-{uuid4()}", 'status': 'open', 'filled': 0.0} for _ in orders]
+
+    def match(self, low: float, high: float):
+        """Fills every resting order the price range [low, high] traded through."""
+        for order in list(self.open_orders.values()):
+            crossed = low <= order['price'] if order['side'] == 'buy' else high >= order['price']
+            if crossed:
+                self._on_order_update({**order, 'status': 'closed', 'filled': order['amount'],
+                                       'average': order['price']})
+
+    async def _pump(self):
+        queue = await market_streamer.subscribe(self.symbol, self.exchange, "drop_oldest",
+                                                name=f"grid-sim:{self.symbol}")
+        try:
+            while True:
+                candle = await queue.get()
+                self.match(candle.low, candle.high)
+        finally:
+            await market_streamer.unsubscribe(queue, self.symbol, self.exchange)
+
+    async def cancel_all_orders(self):
+        self.open_orders.clear()
+
+
+# --- NEW: Paper trading matching engine ---
+class PaperMatchingEngine:
+    """
+    Simulated execution for paper bots. Market orders fill after PAPER_LATENCY_MS at the latest
+    streamed price plus slippage; limit and stop orders rest until a live candle trades through
+    them, and orders sharing an `oco` group cancel each other. Fills pay maker/taker fees and
+    are written to trade_logs in bulk every PAPER_FLUSH_SECONDS, together with the bots'
+    position and P&L changes, instead of one commit per trade. The engine's in-memory position
+    is authoritative while a bot runs here; the flush only persists it.
+    """
+
+    def __init__(self):
+        self.taker_fee = settings.PAPER_TAKER_FEE
+        self.maker_fee = settings.PAPER_MAKER_FEE
+        self.slippage = settings.PAPER_SLIPPAGE_BPS / 10_000
+        self.latency = settings.PAPER_LATENCY_MS / 1000
+        self.flush_interval = settings.PAPER_FLUSH_SECONDS
+        # "exchange:symbol" -> {order_id: order} resting limit/stop orders, and the task matching them
+        self._resting: Dict[str, Dict[str, Dict]] = defaultdict(dict)
+        self._matchers: Dict[str, asyncio.Task] = {}
+        # Waiting to be flushed
+        self._pending_logs: List[Dict[str, Any]] = []
+        self._pnl_deltas: Dict[PythonUUID, float] = defaultdict(float)
+        self._positions: Dict[PythonUUID, Dict[str, Optional[float]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # Current (entry price, amount) per bot, bots with a market order still filling, and stopped
+        # bots whose position is dropped from memory once it has been flushed
+        self._live_positions: Dict[PythonUUID, Tuple[Optional[float], Optional[float]]] = {}
+        self._in_flight: set = set()
+        self._released: set = set()
+        self.fills = 0
+
+    @staticmethod
+    def _stream_key(exchange: str, symbol: str) -> str:
+        return f"{exchange}:{symbol}".lower()
+
+    def submit(self, user_id: str, bot_id: PythonUUID, exchange: str, symbol: str, side: str, amount: float,
+               order_type: str = 'market', price: Optional[float] = None, stop_price: Optional[float] = None,
+               oco: Optional[str] = None, on_fill: Optional[Callable[[Dict], Any]] = None) -> Dict:
+        """
+        Places a simulated order. `price` is the reference price for market orders and the
+        limit for limit orders; stop orders trigger at `stop_price` and then fill like a market
+        order. `on_fill(order)` is awaited after the order fills.
+        """
+        order = {"id": f"paper-{uuid4()}", "user_id": user_id, "bot_id": bot_id, "exchange": exchange,
+                 "symbol": symbol, "side": side, "type": order_type, "amount": amount, "price": price,
+                 "stop_price": stop_price, "oco": oco, "on_fill": on_fill, "status": "open",
+                 "submitted_at": time.time()}
+        if order_type == 'market':
+            self._in_flight.add(bot_id)
+            asyncio.create_task(self._fill_market(order))
+        else:
+            key = self._stream_key(exchange, symbol)
+            self._resting[key][order["id"]] = order
+            if key not in self._matchers:
+                self._matchers[key] = asyncio.create_task(self._run_matcher(key, exchange, symbol))
+        return order
+
+    def cancel_bot_orders(self, bot_id: PythonUUID):
+        for orders in self._resting.values():
+            for order_id in [oid for oid, o in orders.items() if o["bot_id"] == bot_id]:
+                orders.pop(order_id)["status"] = "canceled"
+
+    async def _fill_market(self, order: Dict):
+        try:
+            await asyncio.sleep(self.latency)
+            # Whatever traded most recently, if it's newer than the order; else the price the bot saw.
+            candle = market_streamer.get_last_candle(order["symbol"], order["exchange"])
+            reference = order["price"]
+            if candle is not None and (candle.close_time or candle.timestamp) / 1000 >= order["submitted_at"]:
+                reference = candle.close
+            if not reference:
+                logger.error(f"Paper order {order['id']} has no price to fill at; dropping it.")
+                return
+            slipped = reference * (1 + self.slippage) if order["side"] == 'buy' else reference * (1 - self.slippage)
+            await self._fill(order, slipped, self.taker_fee)
+        finally:
+            self._in_flight.discard(order["bot_id"])
+
+    def _match(self, key: str, candle: Candle):
+        """Fills the resting orders on a stream that this candle traded through."""
+        for order in list(self._resting[key].values()):
+            if order["status"] != "open":
+                continue
+            side = order["side"]
+            if order["type"] == 'limit':
+                limit = order["price"]
+                touched = candle.low <= limit if side == 'buy' else candle.high >= limit
+                # A gap through the limit fills at the better open.
+                fill_price = min(limit, candle.open) if side == 'buy' else max(limit, candle.open)
+                fee = self.maker_fee
+            else:
+                stop = order["stop_price"]
+                touched = candle.high >= stop if side == 'buy' else candle.low <= stop
+                trigger = max(stop, candle.open) if side == 'buy' else min(stop, candle.open)
+                fill_price = trigger * (1 + self.slippage) if side == 'buy' else trigger * (1 - self.slippage)
+                fee = self.taker_fee
+            if touched:
+                self._resting[key].pop(order["id"], None)
+                asyncio.create_task(self._fill(order, fill_price, fee))
+
+    async def _run_matcher(self, key: str, exchange: str, symbol: str):
+        queue = None
+        try:
+            queue = await market_streamer.subscribe(symbol, exchange, "drop_oldest", name=f"paper:{key}")
+            while self._resting[key]:
+                try:
+                    candle = await asyncio.wait_for(queue.get(), timeout=60)
+                except asyncio.TimeoutError:
+                    continue
+                self._match(key, candle)
+        except Exception as e:
+            logger.error(f"Paper matcher for {key} failed; its resting orders are canceled: {e}", exc_info=True)
+        finally:
+            self._matchers.pop(key, None)
+            for order in self._resting.pop(key, {}).values():
+                order["status"] = "canceled"
+            if queue is not None:
+                await market_streamer.unsubscribe(queue, symbol, exchange)
+
+    async def _fill(self, order: Dict, fill_price: float, fee_rate: float):
+        if order["status"] != "open":
+            return
+        order.update(status="closed", filled=order["amount"], average=fill_price)
+        if order["oco"]:
+            for orders in self._resting.values():
+                for other_id in [oid for oid, o in orders.items() if o["oco"] == order["oco"]]:
+                    orders.pop(other_id)["status"] = "canceled"
+
+        gross = order["amount"] * fill_price
+        fee = gross * fee_rate
+        # trade_logs has no fee column, so cost is net of fees (P&L is derived from cost).
+        cost = gross + fee if order["side"] == 'buy' else gross - fee
+        order["cost"] = cost
+        self._pending_logs.append({
+            "user_id": order["user_id"], "bot_id": order["bot_id"], "exchange": "paper", "symbol": order["symbol"],
+            "order_id": order["id"], "side": order["side"], "type": order["type"], "amount": order["amount"],
+            "price": fill_price, "cost": cost, "is_paper_trade": True,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc),
+        })
+        self._pnl_deltas[order["bot_id"]] += cost if order["side"] == 'sell' else -cost
+        self.fills += 1
+        self._ensure_flusher()
+        if order["on_fill"] is not None:
+            try:
+                await order["on_fill"](order)
+            except Exception as e:
+                logger.error(f"Paper fill callback failed for order {order['id']}: {e}", exc_info=True)
+
+    def set_position(self, bot_id: PythonUUID, entry_price: Optional[float], amount: Optional[float]):
+        """Records the bot's paper position and queues it for the next flush (last write wins)."""
+        self._live_positions[bot_id] = (entry_price, amount)
+        self._released.discard(bot_id)
+        self._positions[bot_id] = {"active_position_entry_price": entry_price, "active_position_amount": amount}
+        self._ensure_flusher()
+
+    def get_position(self, bot: TradingBot) -> Tuple[Optional[float], Optional[float]]:
+        """(entry price, amount) of a paper bot; the stored columns may lag by up to one flush."""
+        return self._live_positions.get(bot.id, (bot.active_position_entry_price, bot.active_position_amount))
+
+    def has_order_in_flight(self, bot_id: PythonUUID) -> bool:
+        return bot_id in self._in_flight
+
+    def release(self, bot_id: PythonUUID):
+        """The bot stopped running here; its stored position is authoritative again once flushed."""
+        if bot_id in self._positions:
+            self._released.add(bot_id)
+        else:
+            self._live_positions.pop(bot_id, None)
+
+    def _ensure_flusher(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run_flusher())
+
+    async def _run_flusher(self):
+        try:
+            while self._pending_logs or self._pnl_deltas or self._positions:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        logs, self._pending_logs = self._pending_logs, []
+        pnl_deltas, self._pnl_deltas = self._pnl_deltas, defaultdict(float)
+        positions, self._positions = self._positions, {}
+        if not (logs or pnl_deltas or positions):
+            return
+        try:
+            async with async_session_maker() as db:
+                if logs:
+                    await db.execute(insert(TradeLog), logs)
+                for bot_id in set(pnl_deltas) | set(positions):
+                    values = dict(positions.get(bot_id, {}))
+                    if bot_id in pnl_deltas:
+                        values["paper_pnl_usd"] = func.coalesce(TradingBot.paper_pnl_usd, 0) + pnl_deltas[bot_id]
+                    await db.execute(update(TradingBot).where(TradingBot.id == bot_id).values(**values))
+                await db.commit()
+            for bot_id in self._released & set(positions):
+                if bot_id not in self._positions:
+                    self._released.discard(bot_id)
+                    self._live_positions.pop(bot_id, None)
+        except Exception as e:
+            logger.error(f"Paper trade flush failed ({len(logs)} fills); retrying next interval: {e}")
+            self._pending_logs[:0] = logs
+            for bot_id, delta in pnl_deltas.items():
+                self._pnl_deltas[bot_id] += delta
+            self._positions = {**positions, **self._positions}
+            self._ensure_flusher()
+
+    async def close(self):
+        for task in list(self._matchers.values()):
+            task.cancel()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush()
+
+
+paper_engine = PaperMatchingEngine()
+
+
+# --- NEW: Server-side Stop Engine ---
+class SymbolStopBook:
+    """
+    Exit levels protecting the long positions on one stream. Fixed stops and take-profits are
+    (level, bot_id) lists kept sorted with bisect, so a candle finds everything it crossed with
+    one search. Trailing stops are grouped by the peak they trail: when price makes a new high,
+    every group below it merges into one group at that peak, and each group keeps its members
+    ordered by distance, so neither ratcheting nor triggering visits untouched stops.
+    """
+
+    def __init__(self):
+        self.stops: List[Tuple[float, str]] = []
+        self.targets: List[Tuple[float, str]] = []
+        self.groups: Dict[int, Dict[str, Any]] = {}  # id -> {"peak": float, "members": [(pct, bot_id)]}
+        self.peaks: List[Tuple[float, int]] = []  # min-heap of (peak, group id); stale entries are skipped
+        self.trail_levels: List[Tuple[float, int]] = []  # (level of the group's tightest stop, group id)
+        self._bots: Dict[str, Dict[str, Any]] = {}  # bot_id -> where its levels live
+        self._next_group = 0
+
+    def __len__(self) -> int:
+        return len(self._bots)
+
+    def bot_ids(self) -> List[str]:
+        return list(self._bots)
+
+    @staticmethod
+    def _discard(levels: List[Tuple[float, Any]], entry: Tuple[float, Any]):
+        i = bisect.bisect_left(levels, entry)
+        if i < len(levels) and levels[i] == entry:
+            del levels[i]
+
+    @staticmethod
+    def _group_level(group: Dict[str, Any]) -> float:
+        return group["peak"] * (1 - group["members"][0][0])
+
+    def add(self, bot_id: str, stop: Optional[float] = None, target: Optional[float] = None,
+            trail_pct: Optional[float] = None, peak: Optional[float] = None):
+        entry: Dict[str, Any] = {"stop": stop, "target": target, "group": None, "pct": trail_pct}
+        if stop:
+            bisect.insort(self.stops, (stop, bot_id))
+        if target:
+            bisect.insort(self.targets, (target, bot_id))
+        if trail_pct:
+            group_id, self._next_group = self._next_group, self._next_group + 1
+            group = {"peak": peak, "members": [(trail_pct, bot_id)]}
+            self.groups[group_id] = group
+            heapq.heappush(self.peaks, (peak, group_id))
+            bisect.insort(self.trail_levels, (self._group_level(group), group_id))
+            entry["group"] = group_id
+        self._bots[bot_id] = entry
+
+    def remove(self, bot_id: str):
+        entry = self._bots.pop(bot_id, None)
+        if entry is None:
+            return
+        if entry["stop"]:
+            self._discard(self.stops, (entry["stop"], bot_id))
+        if entry["target"]:
+            self._discard(self.targets, (entry["target"], bot_id))
+        group_id = entry["group"]
+        if group_id is not None:
+            group = self.groups[group_id]
+            self._discard(self.trail_levels, (self._group_level(group), group_id))
+            self._discard(group["members"], (entry["pct"], bot_id))
+            if group["members"]:
+                bisect.insort(self.trail_levels, (self._group_level(group), group_id))
+            else:
+                del self.groups[group_id]
+
+    def _ratchet(self, high: float):
+        merged = []
+        while self.peaks and self.peaks[0][0] < high:
+            peak, group_id = heapq.heappop(self.peaks)
+            group = self.groups.get(group_id)
+            if group is not None and group["peak"] == peak:
+                merged.append(group_id)
+        if not merged:
+            return
+        for group_id in merged:
+            self._discard(self.trail_levels, (self._group_level(self.groups[group_id]), group_id))
+        # Merge the smaller groups into the largest one.
+        merged.sort(key=lambda gid: len(self.groups[gid]["members"]), reverse=True)
+        base_id = merged[0]
+        base = self.groups[base_id]
+        for group_id in merged[1:]:
+            for member in self.groups.pop(group_id)["members"]:
+                bisect.insort(base["members"], member)
+                self._bots[member[1]]["group"] = base_id
+        base["peak"] = high
+        heapq.heappush(self.peaks, (high, base_id))
+        bisect.insort(self.trail_levels, (self._group_level(base), base_id))
+
+    def _trailing_hits(self, price: float) -> List[Tuple[str, float]]:
+        hits = []
+        while self.trail_levels and self.trail_levels[-1][0] >= price:
+            _, group_id = self.trail_levels.pop()
+            group = self.groups[group_id]
+            members = group["members"]
+            i = 0
+            while i < len(members) and group["peak"] * (1 - members[i][0]) >= price:
+                hits.append((members[i][1], group["peak"] * (1 - members[i][0])))
+                i += 1
+            del members[:i]
+            if members:
+                bisect.insort(self.trail_levels, (self._group_level(group), group_id))
+            else:
+                del self.groups[group_id]
+            for bot_id, _ in hits[-i:] if i else []:
+                self._bots[bot_id]["group"] = None
+        return hits
+
+    def on_candle(self, candle: Candle) -> List[Tuple[str, str, float]]:
+        """Returns (bot_id, reason, trigger price) for every exit this candle crossed and removes them."""
+        hits: List[Tuple[str, str, float]] = []
+        # The low is assumed to come before the high, which is the conservative order for longs.
+        i = bisect.bisect_left(self.stops, candle.low, key=lambda entry: entry[0])
+        hits += [(bot_id, "Stop loss", min(level, candle.open)) for level, bot_id in self.stops[i:]]
+        del self.stops[i:]
+        hits += [(bot_id, "Trailing stop", min(level, candle.open)) for bot_id, level in self._trailing_hits(candle.low)]
+        j = bisect.bisect_right(self.targets, candle.high, key=lambda entry: entry[0])
+        hits += [(bot_id, "Take profit", max(level, candle.open)) for level, bot_id in self.targets[:j]]
+        del self.targets[:j]
+        # A new high raises the trailing stops, which the close may then cross.
+        self._ratchet(candle.high)
+        hits += [(bot_id, "Trailing stop", candle.close) for bot_id, _ in self._trailing_hits(candle.close)]
+
+        triggered, seen = [], set()
+        for bot_id, reason, price in hits:
+            if bot_id not in seen:
+                seen.add(bot_id)
+                self.remove(bot_id)
+                triggered.append((bot_id, reason, price))
+        return triggered
+
+
+class StopEngine:
+    """
+    Manages stop-loss, take-profit and trailing-stop exits for bots in a position, evaluated
+    against the shared market stream instead of per-bot polling. One feed task per symbol
+    drives a SymbolStopBook; triggered exits go through StrategyService.execute_bot_trade
+    like any other sell. Where an exchange OCO bracket already rests, only the trailing stop
+    is handled here.
+    """
+
+    def __init__(self):
+        self._books: Dict[str, SymbolStopBook] = {}
+        self._feeds: Dict[str, asyncio.Task] = {}
+        self._armed: Dict[str, Tuple[str, User, TradingBot]] = {}  # bot_id -> (stream key, user, bot)
+        self._exits: set = set()  # Exit tasks in progress
+        self.triggered = 0
+
+    @staticmethod
+    def _stream_key(exchange: str, symbol: str) -> str:
+        return f"{exchange}:{symbol}".lower()
+
+    @staticmethod
+    def has_resting_bracket(bot: TradingBot) -> bool:
+        """
+        Non-custodial spot entries place their own OCO bracket on the exchange when both TP and SL are set.
+        Paper bots don't: a simulated bracket would live only in this process's matching engine and be lost
+        on restart or when the bot moves to another runner, so the stop engine manages their exits.
+        """
+        on_venue = not bot.is_paper_trading and (bot.mode == BotMode.NON_CUSTODIAL.value
+                                                 and bot.market_type == MarketType.SPOT.value)
+        return on_venue and bool(bot.take_profit_percentage and bot.stop_loss_percentage)
+
+    def arm(self, user: User, bot: TradingBot, entry_price: float):
+        """(Re)arms the exits for a bot's long position opened at `entry_price`."""
+        self.disarm(bot.id)
+        entry_price = float(entry_price)
+        stop = target = None
+        if not self.has_resting_bracket(bot):
+            if bot.stop_loss_percentage:
+                stop = entry_price * (1 - bot.stop_loss_percentage / 100)
+            if bot.take_profit_percentage:
+                target = entry_price * (1 + bot.take_profit_percentage / 100)
+        trail_pct = bot.trailing_stop_percentage / 100 if bot.trailing_stop_percentage else None
+        if not (stop or target or trail_pct):
+            return
+
+        key = self._stream_key(bot.exchange, bot.symbol)
+        candle = market_streamer.get_last_candle(bot.symbol, bot.exchange)
+        peak = max(entry_price, candle.close) if candle is not None else entry_price
+        book = self._books.setdefault(key, SymbolStopBook())
+        book.add(str(bot.id), stop=stop, target=target, trail_pct=trail_pct, peak=peak)
+        self._armed[str(bot.id)] = (key, user, bot)
+        if key not in self._feeds:
+            self._feeds[key] = asyncio.create_task(self._run_feed(key, bot.exchange, bot.symbol))
+
+    def disarm(self, bot_id: Any):
+        armed = self._armed.pop(str(bot_id), None)
+        if armed is not None and armed[0] in self._books:
+            self._books[armed[0]].remove(str(bot_id))
+
+    async def _run_feed(self, key: str, exchange: str, symbol: str):
+        queue = None
+        try:
+            queue = await market_streamer.subscribe(symbol, exchange, "drop_oldest", name=f"stops:{key}")
+            while self._books.get(key):
+                try:
+                    candle = await asyncio.wait_for(queue.get(), timeout=60)
+                except asyncio.TimeoutError:
+                    continue
+                for bot_id, reason, price in self._books[key].on_candle(candle):
+                    armed = self._armed.pop(bot_id, None)
+                    if armed is not None:
+                        self.triggered += 1
+                        task = asyncio.create_task(self._exit(armed[1], armed[2], reason, price))
+                        self._exits.add(task)
+                        task.add_done_callback(self._exits.discard)
+        except Exception as e:
+            logger.error(f"Stop feed for {key} failed; its {len(self._books.get(key) or [])} stops are dropped: {e}",
+                         exc_info=True)
+            book = self._books.pop(key, None)
+            for bot_id in book.bot_ids() if book else []:
+                self._armed.pop(bot_id, None)
+        finally:
+            self._feeds.pop(key, None)
+            if queue is not None:
+                await market_streamer.unsubscribe(queue, symbol, exchange)
+        if self._books.get(key):
+            # Armed again while this feed was shutting down.
+            self._feeds[key] = asyncio.create_task(self._run_feed(key, exchange, symbol))
+        else:
+            self._books.pop(key, None)
+
+    async def _exit(self, user: User, bot: TradingBot, reason: str, price: float):
+        try:
+            async with async_session_maker() as db:
+                current_bot = await db.get(TradingBot, bot.id)
+                if not current_bot:
+                    logger.info(f"{reason} for bot {bot.id} skipped: the bot no longer exists.")
+                    return
+                entry_price = strategy_service.get_position(current_bot)[0]
+                if entry_price is None:
+                    logger.info(f"{reason} for bot {bot.id} skipped: it has no open position.")
+                    return
+                if current_bot.is_paper_trading and paper_engine.has_order_in_flight(bot.id):
+                    # The sell would be ignored while another order fills; keep the position protected.
+                    logger.warning(f"{reason} for bot {bot.id} deferred: an order is still filling. Re-arming.")
+                    self.arm(user, bot, entry_price)
+                    return
+                bot_log_bus.emit(user.id, str(bot.id), f"🛡️ {reason} triggered at ~${price:.4f}. Closing position.")
+                await strategy_service.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(price)),
+                                                         BackgroundTasks())
+        except Exception as e:
+            logger.error(f"{reason} exit for bot {bot.id} failed: {e}", exc_info=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"armed": len(self._armed), "symbols": {key: len(book) for key, book in self._books.items()},
+                "triggered": self.triggered}
+
+    def close(self):
+        for task in list(self._feeds.values()):
+            task.cancel()
+
+
+stop_engine = StopEngine()
+
+
+# --- NEW: Price Alert Engine ---
+class PriceAlertEngine:
+    """
+    Evaluates every user's price alerts against the shared market stream. Each symbol keeps two
+    sorted price arrays (with parallel id arrays): alerts above the price when they were set, which
+    fire once a high reaches them, and alerts below it, which fire once a low does. A candle
+    bisects each array once and slices off only the crossed alerts, so the per-tick cost doesn't
+    grow with the number of alerts. Delivery (notification, Telegram, websocket) runs off the feed.
+    """
+    MAX_ALERTS_PER_USER = 200
+
+    def __init__(self):
+        # stream key -> {"above": ([prices], [alert ids]), "below": ([prices], [alert ids])}
+        self._books: Dict[str, Dict[str, Tuple[List[float], List[str]]]] = {}
+        self._alerts: Dict[str, Dict[str, Any]] = {}  # alert id -> alert details
+        self._feeds: Dict[str, asyncio.Task] = {}
+        self.triggered = 0
+
+    @staticmethod
+    def _stream_key(exchange: str, symbol: str) -> str:
+        return f"{exchange}:{symbol}".lower()
+
+    def add(self, alert: "PriceAlert"):
+        self._insert(str(alert.id), {"key": self._stream_key(alert.exchange, alert.symbol), "user_id": alert.user_id,
+                                     "exchange": alert.exchange, "symbol": alert.symbol, "direction": alert.direction,
+                                     "price": alert.price, "note": alert.note})
+
+    def _insert(self, alert_id: str, alert: Dict[str, Any]):
+        self.remove(alert_id)
+        key = alert["key"]
+        book = self._books.setdefault(key, {"above": ([], []), "below": ([], [])})
+        prices, ids = book[alert["direction"]]
+        i = bisect.bisect_right(prices, alert["price"])
+        prices.insert(i, alert["price"])
+        ids.insert(i, alert_id)
+        self._alerts[alert_id] = alert
+        if key not in self._feeds:
+            self._feeds[key] = asyncio.create_task(self._run_feed(key, alert["exchange"], alert["symbol"]))
+
+    def remove(self, alert_id: str):
+        alert = self._alerts.pop(str(alert_id), None)
+        if alert is None or alert["key"] not in self._books:
+            return
+        prices, ids = self._books[alert["key"]][alert["direction"]]
+        lo, hi = bisect.bisect_left(prices, alert["price"]), bisect.bisect_right(prices, alert["price"])
+        for i in range(lo, hi):
+            if ids[i] == str(alert_id):
+                del prices[i], ids[i]
+                break
+
+    def count_for_user(self, user_id: str) -> int:
+        return sum(1 for alert in self._alerts.values() if alert["user_id"] == user_id)
+
+    def _has_alerts(self, key: str) -> bool:
+        book = self._books.get(key)
+        return bool(book and (book["above"][0] or book["below"][0]))
+
+    def match(self, key: str, high: float, low: float) -> List[Tuple[str, float]]:
+        """Pops the alerts this price range crossed; returns (alert id, trigger price)."""
+        book = self._books.get(key)
+        if not book:
+            return []
+        crossed = []
+        prices, ids = book["above"]
+        i = bisect.bisect_right(prices, high)
+        if i:
+            crossed += zip(ids[:i], prices[:i])
+            del prices[:i], ids[:i]
+        prices, ids = book["below"]
+        j = bisect.bisect_left(prices, low)
+        if j < len(prices):
+            crossed += zip(ids[j:], prices[j:])
+            del prices[j:], ids[j:]
+        return crossed
+
+    async def load(self):
+        """Loads every active alert; called once at startup."""
+        async with async_session_maker() as db:
+            alerts = (await db.scalars(select(PriceAlert).where(PriceAlert.is_active.is_(True)))).all()
+        for alert in alerts:
+            self.add(alert)
+        logger.info(f"Loaded {len(alerts)} active price alerts across {len(self._books)} symbols.")
+
+    async def _run_feed(self, key: str, exchange: str, symbol: str):
+        queue = None
+        try:
+            queue = await market_streamer.subscribe(symbol, exchange, "drop_oldest", name=f"alerts:{key}")
+            while self._has_alerts(key):
+                try:
+                    candle = await asyncio.wait_for(queue.get(), timeout=60)
+                except asyncio.TimeoutError:
+                    continue
+                crossed = self.match(key, candle.high, candle.low)
+                if crossed:
+                    fired = [(alert_id, self._alerts.pop(alert_id), price) for alert_id, price in crossed
+                             if alert_id in self._alerts]
+                    self.triggered += len(fired)
+                    asyncio.create_task(self._deliver(fired))
+        except Exception as e:
+            logger.error(f"Price alert feed for {key} failed; its alerts stay inactive until a restart: {e}",
+                         exc_info=True)
+            book = self._books.pop(key, None)
+            for prices, ids in book.values() if book else []:
+                for alert_id in ids:
+                    self._alerts.pop(alert_id, None)
+        finally:
+            self._feeds.pop(key, None)
+            if queue is not None:
+                await market_streamer.unsubscribe(queue, symbol, exchange)
+        if self._has_alerts(key):
+            self._feeds[key] = asyncio.create_task(self._run_feed(key, exchange, symbol))
+        else:
+            self._books.pop(key, None)
+
+    async def _deliver(self, fired: List[Tuple[str, Dict[str, Any], float]]):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            async with async_session_maker() as db:
+                # Only the process that flips the alert off delivers it.
+                result = await db.execute(update(PriceAlert).where(
+                    PriceAlert.id.in_([PythonUUID(alert_id) for alert_id, _, _ in fired]),
+                    PriceAlert.is_active.is_(True)).values(is_active=False, triggered_at=now).returning(PriceAlert.id))
+                claimed = {str(alert_id) for alert_id in result.scalars().all()}
+                messages = []
+                for alert_id, alert, price in fired:
+                    if alert_id not in claimed:
+                        continue
+                    arrow = "📈" if alert["direction"] == "above" else "📉"
+                    message = (f"{arrow} *Price Alert*: `{alert['symbol']}` crossed {alert['direction']} "
+                               f"`{price:g}` on {alert['exchange']}")
+                    if alert["note"]:
+                        message += f"\n{alert['note']}"
+                    messages.append((alert_id, alert, message))
+                    await notification_service.create_notification(db, type=NotificationType.PRICE_ALERT,
+                                                                   message=message, user_id=alert["user_id"])
+                await db.commit()
+        except Exception as e:
+            logger.error(f"Failed to deliver {len(fired)} price alerts; returning them to the book: {e}", exc_info=True)
+            for alert_id, alert, _ in fired:
+                self._insert(alert_id, alert)
+            return
+        for alert_id, alert, message in messages:
+            await telegram_service.notify_user(alert["user_id"], message)
+            await websocket_manager.send_personal_message(
+                {"type": "price_alert", "alert_id": alert_id, "symbol": alert["symbol"], "exchange": alert["exchange"],
+                 "direction": alert["direction"], "price": alert["price"], "message": message}, alert["user_id"])
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"active": len(self._alerts), "symbols": len(self._books), "triggered": self.triggered}
+
+    def close(self):
+        for task in list(self._feeds.values()):
+            task.cancel()
+
+
+price_alert_engine = PriceAlertEngine()
+
+
+class StrategyService:
+    def __init__(self):
+        """
+        The constructor that initializes the service. It's crucial that this
+        method exists and defines the 'strategies' dictionary.
+        """
+        # This dictionary maps the strategy names (from the DB/frontend)
+        # to the actual Python methods that run them.
+        self.strategies = {
+            # --- Standard Indicator-Based Strategies ---
+            # Signal logic lives in SIGNAL_EVALUATOR_REGISTRY and is shared between bots
+            # with identical configurations; run_signal_strategy handles per-bot execution.
+            "RSI_MACD_Crossover": self.run_signal_strategy,
+            "MA_Cross": self.run_signal_strategy,
+            "Bollinger_Bands": self.run_signal_strategy,
+
+            # --- Advanced Price Action Strategy ---
+            "Smart_Money_Concepts": self.run_signal_strategy,
+
+            # --- Specialized, Non-Streaming Strategy ---
+            "Grid_Trading": self.run_grid_trading_strategy,
+
+            # --- NEW: Advanced Pre-Built Strategies ---
+            "Volatility_Squeeze": self.run_signal_strategy,
+            "SuperTrend_ADX_Filter": self.run_signal_strategy,
+            "Ichimoku_Cloud_Breakout": self.run_signal_strategy,
+
+            # --- NEW: AI-Powered & Meta Strategies ---
+            "AI_Signal_Confirmation": self.run_signal_strategy,
+            "Optimizer_Portfolio": self.run_signal_strategy,
+
+            # --- NEW: Externally Driven Strategies ---
+            "TradingView_Alert": self.run_webhook_strategy,
+            "Visual_Strategy_Builder": self.run_signal_strategy,
+        }
+
+        # Helper classes and state management attributes
+        self.smc_analyzer = SMCAnalyzer()
+        self.running_bot_tasks: Dict[PythonUUID, asyncio.Task] = {}
+        self.bot_contexts: Dict[PythonUUID, Dict] = {}
+        self._bot_locks = defaultdict(asyncio.Lock)
+
+    async def _get_authenticated_client(self, user_id: str, exchange_name: str) -> Optional[ccxt.Exchange]:
+        """
+        Securely fetches, decrypts, and creates an authenticated ccxt client for a user.
         """
         async with async_session_maker() as db:
             api_key_entry = await db.scalar(
@@ -4845,10 +8785,7 @@ class StrategyService:
                 return
 
             # --- FEEDBACK: Immediate Boot Log ---
-            await websocket_manager.send_personal_message(
-                {"type": "bot_log", "bot_id": str(bot.id), "message": "🚀 System: Booting up strategy engine..."},
-                user.id
-            )
+            bot_log_bus.emit(user.id, str(bot.id), "🚀 System: Booting up strategy engine...")
 
             try:
                 # 2. MT4/MT5 Handlers
@@ -4864,9 +8801,7 @@ class StrategyService:
                         return
 
                     # --- Attempt Connection ---
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(bot.id), "message": "🔌 Connecting to MT5 Terminal..."}, user.id
-                    )
+                    bot_log_bus.emit(user.id, str(bot.id), "🔌 Connecting to MT5 Terminal...")
                     
                     try:
                         connected = await mt5_gateway_service.connect_and_login(
@@ -4888,14 +8823,12 @@ class StrategyService:
                     # Success logic
                     current_bot.is_active = True
                     await db.commit()
+                    bot_registry.activate(current_bot, user)
                     
                     await telegram_service.notify_user(user.id, f"🚀 Bot `{current_bot.name}` (MT5) is active.")
                     await websocket_manager.send_personal_message(
                         {"type": "bot_status", "bot_id": str(current_bot.id), "status": "started"}, user.id)
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(current_bot.id), "message": "✅ MT5 Bridge Connected. Waiting for terminal signals..."}, 
-                        user.id
-                    )
+                    bot_log_bus.emit(user.id, str(current_bot.id), "✅ MT5 Bridge Connected. Waiting for terminal signals...")
                     return # Exit, as MT5 bots don't run a Python loop
 
                 # 3. Webhook Handlers
@@ -4905,6 +8838,7 @@ class StrategyService:
 
                     current_bot.is_active = True
                     await db.commit()
+                    bot_registry.activate(current_bot, user)
 
                     webhook_url = f"{settings.BASE_URL}/api/bots/webhook/{current_bot.webhook_id}"
                     msg = (
@@ -4917,87 +8851,24 @@ class StrategyService:
                         {"type": "bot_status", "bot_id": str(current_bot.id), "status": "started", "webhook_url": webhook_url}, 
                         user.id
                     )
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(current_bot.id), "message": "✅ Webhook Listener Active. Waiting for alerts..."},
-                        user.id
-                    )
+                    bot_log_bus.emit(user.id, str(current_bot.id), "✅ Webhook Listener Active. Waiting for alerts...")
                     return # Exit, as webhook bots are event-driven
 
                 # 4. Internal Strategy Logic
-                strategy_func = self.strategies.get(current_bot.strategy_name)
-                if not strategy_func:
+                if current_bot.strategy_name not in self.strategies:
                     raise ValueError(f"Strategy '{current_bot.strategy_name}' not found.")
 
-                # --- FEEDBACK: Connection Log ---
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"📡 Connecting to {current_bot.exchange} websocket feed for {current_bot.symbol}..."},
-                    user.id
-                )
-
-                # 5. Subscribe to Market Data
-                data_queue = await market_streamer.subscribe(current_bot.symbol, current_bot.exchange)
-                self.bot_contexts[current_bot.id] = {"queue": data_queue}
+                if settings.BOT_RUNNER_MODE == "external":
+                    # A bot runner process claims the bot on its next lease sync.
+                    current_bot.is_active = True
+                    await db.commit()
+                    bot_log_bus.emit(user.id, str(bot.id), "🗂️ System: Queued for a bot runner...")
+                else:
+                    await self._launch_strategy_loop(user, current_bot, background_tasks)
 
-                # 6. Define the Self-Healing Wrapper
-                async def safe_strategy_runner():
-                    # --- FEEDBACK: Loop Start ---
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(bot.id), "message": "✅ Strategy Loop Active. Waiting for candle data..."},
-                        user.id
-                    )
-                    
-                    error_count = 0
-                    while True:
-                        try:
-                            # Database Check (ensure bot wasn't stopped via API while loop was running)
-                            async with async_session_maker() as check_db:
-                                check_bot = await check_db.get(TradingBot, bot.id)
-                                if not check_bot or not check_bot.is_active:
-                                    logger.info(f"Bot {bot.id} marked inactive. Stopping loop.")
-                                    break
-
-                            # EXECUTE STRATEGY LOGIC
-                            await strategy_func(user, bot, data_queue, background_tasks)
-                            
-                            # If strategy_func returns properly (e.g. stop requested), we break
-                            break 
-
-                        except asyncio.CancelledError:
-                            logger.info(f"Bot {bot.id} task cancelled.")
-                            break
-                        except Exception as e:
-                            error_count += 1
-                            logger.error(f"Bot {bot.id} crashed (Attempt {error_count}): {e}", exc_info=True)
-                            
-                            # Notify UI of crash and retry
-                            await websocket_manager.send_personal_message(
-                                {"type": "error", "bot_id": str(bot.id), "message": f"⚠️ Strategy crashed: {str(e)}. Retrying in 5s..."},
-                                user.id
-                            )
-                            
-                            # Exponential backoff cap
-                            if error_count > 10:
-                                await websocket_manager.send_personal_message(
-                                    {"type": "error", "bot_id": str(bot.id), "message": "🛑 Too many consecutive errors. Bot shutting down."},
-                                    user.id
-                                )
-                                await telegram_service.notify_user(user.id, f"🛑 Bot `{bot.name}` stopped after critical failures.")
-                                # Update DB state to inactive
-                                async with async_session_maker() as fail_db:
-                                    fail_bot = await fail_db.get(TradingBot, bot.id)
-                                    if fail_bot:
-                                        fail_bot.is_active = False
-                                        await fail_db.commit()
-                                break
-                            
-                            await asyncio.sleep(5)
-
-                # 7. Launch Task
-                self.running_bot_tasks[current_bot.id] = asyncio.create_task(safe_strategy_runner())
-                
-                # 8. Update DB State
-                current_bot.is_active = True
-                await db.commit()
+                    # 8. Update DB State
+                    current_bot.is_active = True
+                    await db.commit()
 
                 # 9. Final Success Message
                 await websocket_manager.send_personal_message(
@@ -5010,6 +8881,134 @@ class StrategyService:
                 await websocket_manager.send_personal_message(
                     {"type": "error", "message": f"Failed to start bot: {e}"}, user.id)
 
+    async def _launch_strategy_loop(self, user: User, bot: TradingBot, background_tasks: BackgroundTasks):
+        """Subscribes a streaming/grid bot to its data feed and starts its self-healing loop task."""
+        strategy_func = self.strategies.get(bot.strategy_name)
+        if not strategy_func:
+            raise ValueError(f"Strategy '{bot.strategy_name}' not found.")
+
+        # --- FEEDBACK: Connection Log ---
+        bot_log_bus.emit(user.id, str(bot.id), f"📡 Connecting to {bot.exchange} websocket feed for {bot.symbol}...")
+
+        # 5. Subscribe to Market Data (or to the shared signal channel for this configuration)
+        if signal_multicaster.supports(bot.strategy_name):
+            channel_key = signal_multicaster.get_channel_key(bot)
+            data_queue = signal_multicaster.subscribe(bot)
+            self.bot_contexts[bot.id] = {"signal_queue": data_queue, "channel_key": channel_key}
+        else:
+            data_queue = await market_streamer.subscribe(bot.symbol, bot.exchange, "conflate", name=f"bot:{bot.id}",
+                                                         timeframe=bot.timeframe)
+            self.bot_contexts[bot.id] = {"queue": data_queue}
+
+        # 6. Define the Self-Healing Wrapper
+        async def safe_strategy_runner():
+            # --- FEEDBACK: Loop Start ---
+            bot_log_bus.emit(user.id, str(bot.id), "✅ Strategy Loop Active. Waiting for candle data...")
+            
+            error_count = 0
+            while True:
+                try:
+                    # Registry Check (ensure bot wasn't stopped via API while loop was running)
+                    if not bot_registry.is_active(bot.id):
+                        logger.info(f"Bot {bot.id} marked inactive. Stopping loop.")
+                        break
+
+                    # EXECUTE STRATEGY LOGIC
+                    await strategy_func(user, bot, data_queue, background_tasks)
+                    
+                    # If strategy_func returns properly (e.g. stop requested), we break
+                    break 
+
+                except asyncio.CancelledError:
+                    logger.info(f"Bot {bot.id} task cancelled.")
+                    break
+                except Exception as e:
+                    error_count += 1
+                    logger.error(f"Bot {bot.id} crashed (Attempt {error_count}): {e}", exc_info=True)
+                    
+                    # Notify UI of crash and retry
+                    await websocket_manager.send_personal_message(
+                        {"type": "error", "bot_id": str(bot.id), "message": f"⚠️ Strategy crashed: {str(e)}. Retrying in 5s..."},
+                        user.id
+                    )
+                    
+                    # Exponential backoff cap
+                    if error_count > 10:
+                        await websocket_manager.send_personal_message(
+                            {"type": "error", "bot_id": str(bot.id), "message": "🛑 Too many consecutive errors. Bot shutting down."},
+                            user.id
+                        )
+                        await telegram_service.notify_user(user.id, f"🛑 Bot `{bot.name}` stopped after critical failures.")
+                        # Update DB state to inactive
+                        async with async_session_maker() as fail_db:
+                            fail_bot = await fail_db.get(TradingBot, bot.id)
+                            if fail_bot:
+                                fail_bot.is_active = False
+                                await fail_db.commit()
+                        break
+                    
+                    await asyncio.sleep(5)
+
+            # Release the stream/channel subscription however the loop ended.
+            await self._release_bot_context(bot)
+
+            if bot_registry.pop_expired(bot.id):
+                async with async_session_maker() as expiry_db:
+                    expired_bot = await expiry_db.get(TradingBot, bot.id)
+                    if expired_bot and expired_bot.is_active:
+                        expired_bot.is_active = False
+                        await expiry_db.commit()
+                self.running_bot_tasks.pop(bot.id, None)
+                await websocket_manager.send_personal_message(
+                    {"type": "bot_status", "bot_id": str(bot.id), "status": "stopped"}, user.id)
+                await telegram_service.notify_user(user.id, f"🛑 Bot `{bot.name}` stopped: your subscription has expired.")
+
+        # 7. Register & Launch Task
+        bot_registry.activate(bot, user)
+        self.running_bot_tasks[bot.id] = asyncio.create_task(safe_strategy_runner())
+        entry_price, position_amount = self.get_position(bot)
+        if entry_price is not None and (position_amount or 0) >= 0:
+            stop_engine.arm(user, bot, entry_price)
+        
+
+    def runs_in_runner(self, bot: TradingBot) -> bool:
+        """Streaming and grid bots run a Python loop; MT4/MT5 and webhook bots stay event-driven in the API."""
+        return (bot.exchange not in [ExchangeName.MT4.value, ExchangeName.MT5.value]
+                and bot.strategy_name != "TradingView_Alert"
+                and bot.strategy_name in self.strategies)
+
+    async def resume_bot(self, user: User, bot: TradingBot) -> bool:
+        """
+        Launches the loop of a bot that is already active in the database, e.g. after a
+        server restart or when a bot runner takes the bot over. Returns False if it failed.
+        """
+        async with self._bot_locks[bot.id]:
+            if bot.id in self.running_bot_tasks:
+                return True
+            try:
+                await self._launch_strategy_loop(user, bot, BackgroundTasks())
+            except Exception as e:
+                logger.error(f"Failed to resume bot {bot.id}: {e}", exc_info=True)
+                await self._release_bot_context(bot)
+                bot_registry.deactivate(bot.id)
+                return False
+        logger.info(f"Resumed bot {bot.id} for user {user.id}.")
+        return True
+
+    async def detach_bot(self, bot: TradingBot):
+        """Stops a bot's local loop without touching its database state, so another runner can take it over."""
+        async with self._bot_locks[bot.id]:
+            bot_registry.deactivate(bot.id)
+            task = self.running_bot_tasks.pop(bot.id, None)
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            await self._release_bot_context(bot)
+        logger.info(f"Detached bot {bot.id} from this process.")
+
     async def stop_bot(self, db: AsyncSession, bot: TradingBot):
         """
         Robustly stops a trading bot, cancelling its tasks and cleaning up all associated resources.
@@ -5021,6 +9020,7 @@ class StrategyService:
                 return
 
             logger.info(f"Attempting to stop bot {current_bot.id} ({current_bot.name})...")
+            bot_registry.deactivate(current_bot.id)
 
             # --- Stop and clean up internal strategy tasks ---
             task = self.running_bot_tasks.pop(current_bot.id, None)
@@ -5033,11 +9033,7 @@ class StrategyService:
                 logger.info(f"Bot task {current_bot.id} cancelled successfully.")
 
             # --- Clean up resources like market data subscriptions ---
-            if current_bot.id in self.bot_contexts:
-                context = self.bot_contexts.pop(current_bot.id)
-                if queue := context.get("queue"):
-                    await market_streamer.unsubscribe(queue, current_bot.symbol, current_bot.exchange)
-                    logger.info(f"Unsubscribed bot {current_bot.id} from market stream.")
+            await self._release_bot_context(current_bot)
 
             # --- For all bots (including webhook and MT4/5), mark as inactive in the database ---
             current_bot.is_active = False
@@ -5048,6 +9044,21 @@ class StrategyService:
             await telegram_service.notify_user(current_bot.owner_id, f"🛑 Bot `{current_bot.name}` has been stopped.")
             logger.info(f"Successfully stopped and cleaned up bot {current_bot.id}.")
 
+    async def _release_bot_context(self, bot: TradingBot):
+        """Drops a bot's market data or signal channel subscription. Safe to call more than once."""
+        context = self.bot_contexts.pop(bot.id, None)
+        bot_log_bus.forget(bot.id)
+        stop_engine.disarm(bot.id)
+        paper_engine.release(bot.id)
+        if not context:
+            return
+        if queue := context.get("signal_queue"):
+            await signal_multicaster.unsubscribe(queue, context["channel_key"])
+            logger.info(f"Unsubscribed bot {bot.id} from signal channel {context['channel_key']}.")
+        elif queue := context.get("queue"):
+            await market_streamer.unsubscribe(queue, bot.symbol, bot.exchange, bot.timeframe)
+            logger.info(f"Unsubscribed bot {bot.id} from market stream.")
+
     async def run_webhook_strategy(self, user: User, bot: TradingBot, request: Request,
                                    background_tasks: BackgroundTasks):
         """
@@ -5099,6 +9110,13 @@ class StrategyService:
 
         return {"status": "ok", "action": action}
 
+    @staticmethod
+    def get_position(bot: TradingBot) -> Tuple[Optional[float], Optional[float]]:
+        """(entry price, amount) of the bot's open position; paper positions come from the paper engine."""
+        if bot.is_paper_trading:
+            return paper_engine.get_position(bot)
+        return bot.active_position_entry_price, bot.active_position_amount
+
     # --- HELPER METHOD for executing trades ---
     async def execute_bot_trade(self, db: AsyncSession, user: User, bot: TradingBot, signal: str, price: Decimal,
                                 background_tasks: BackgroundTasks):
@@ -5108,7 +9126,11 @@ class StrategyService:
         execution logic based on the bot's configuration.
         """
         # 1. Validate Signal against Current State
-        in_position = bot.active_position_entry_price is not None
+        entry_price, position_amount = self.get_position(bot)
+        in_position = entry_price is not None
+        if bot.is_paper_trading and paper_engine.has_order_in_flight(bot.id):
+            logger.info(f"Bot {bot.id} received '{signal}' signal while its last paper order is still filling. Ignoring.")
+            return
         if signal.lower() == 'buy' and in_position:
             logger.info(f"Bot {bot.id} received 'buy' signal but is already in a position. Ignoring.")
             return
@@ -5121,26 +9143,26 @@ class StrategyService:
             regime = market_regime_service.get_regime(bot.symbol)
             if regime != MarketRegime.BULLISH:
                 log_msg = f"Trade '{signal}' for bot '{bot.name}' skipped due to unfavorable market regime ({regime.value})."
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
+                bot_log_bus.emit(user.id, str(bot.id), log_msg)
                 return
 
         base_asset, _ = bot.symbol.split('/')
 
-        # 3. Handle Paper Trading
+        # 3. Handle Paper Trading (simulated fills, persisted in batches)
         if bot.is_paper_trading:
-            investment_usd = trading_service.get_dynamic_investment_usd(user)
-            amount_base = investment_usd / price if price > 0 else Decimal(0)
+            if signal == 'sell' and position_amount:
+                amount_base = Decimal(str(position_amount))
+            else:
+                investment_usd = trading_service.get_dynamic_investment_usd(user)
+                amount_base = investment_usd / price if price > 0 else Decimal(0)
             if amount_base <= 0: return
+            if not in_position and not await self._check_exposure(user, bot, signal, amount_base, price):
+                return
 
-            trade = TradeLog(user_id=user.id, bot_id=bot.id, exchange="paper", symbol=bot.symbol,
-                             order_id=f"paper-{uuid4()}", side=signal, type='market', amount=float(amount_base),
-                             price=float(price), cost=float(investment_usd), is_paper_trade=True)
-            db.add(trade)
-            await db.commit()
-
-            msg = f"📄 *Paper Trade Executed*\nBot: `{bot.name}`\n{signal.upper()} `{amount_base:.6f}` at `~${price:.2f}`"
-            send_telegram_notification_task.delay(user_id=user.id, message=msg)
+            if signal == 'sell':
+                paper_engine.cancel_bot_orders(bot.id)  # Any resting TP/SL
+            paper_engine.submit(user.id, bot.id, bot.exchange, bot.symbol, signal, float(amount_base),
+                                price=float(price), on_fill=lambda order: self._on_paper_fill(user, bot, order))
             return
 
         # 4. Handle Live Trading
@@ -5152,6 +9174,13 @@ class StrategyService:
                 # For now, we'll risk a small fixed USD amount.
                 risk_amount_usd = Decimal("5.0")  # Risk $10 per trade
                 amount_in_lots = risk_amount_usd / 10000  # Simplified lot calculation
+                units = float(amount_in_lots) * exposure_book.MT5_LOT_SIZE
+                mt5_login = await db.scalar(
+                    select(MT5Credentials.account_number).where(MT5Credentials.user_id == user.id))
+                if not mt5_login:
+                    raise ConnectionAbortedError("No MT5 account is connected. Connect one on the Integrations page.")
+                if not await self._check_exposure(user, bot, signal, units, price):
+                    return
 
                 result = await mt5_gateway_service.execute_trade(
                     symbol=bot.symbol,
@@ -5159,43 +9188,56 @@ class StrategyService:
                     volume=float(amount_in_lots),
                     price=float(price),
                     sl_pips=500,  # Example: 50 pips
-                    tp_pips=1000  # Example: 100 pips
+                    tp_pips=1000,  # Example: 100 pips
+                    login=int(mt5_login)
                 )
 
                 if result["status"] == "error":
                     raise ConnectionAbortedError(f"MT5 Trade Failed: {result['message']}")
                 else:
+                    exposure_book.on_fill(user.id, bot.id, bot.symbol, signal, units, float(price), persisted=False)
                     msg = f"✅ *MT5 Trade Executed via Gateway*\nBot: `{bot.name}`\n{signal.upper()} `{amount_in_lots:.2f}` lots of `{bot.symbol}`"
-                    send_telegram_notification_task.delay(user_id=user.id, message=msg)
+                    await telegram_service.notify_user(user.id, msg)
 
             # --- ROUTE 2: CCXT Non-Custodial (External Exchange) ---
             elif bot.mode == BotMode.NON_CUSTODIAL.value:
                 private_client = await exchange_manager.get_private_client(user.id, bot.exchange,
-                                                                           AssetClass(bot.asset_class))
+                                                                           AssetClass(bot.asset_class),
+                                                                           MarketType(bot.market_type))
                 if not private_client:
                     raise ConnectionError(f"Could not connect to {bot.exchange}. Check API keys.")
 
-                amount_to_trade = await trading_service.get_position_size(user, bot, private_client)
-                if amount_to_trade <= 0:
-                    logger.warning(f"Skipping trade for bot {bot.id}: Position size is zero or less.")
-                    return
+                try:
+                    amount_to_trade = await trading_service.get_position_size(user, bot, private_client)
+                    if amount_to_trade <= 0:
+                        logger.warning(f"Skipping trade for bot {bot.id}: Position size is zero or less.")
+                        return
+                    if not in_position and not await self._check_exposure(user, bot, signal, amount_to_trade, price):
+                        return
 
-                if bot.market_type == MarketType.SPOT.value:
-                    if signal == 'buy':
-                        await self._execute_spot_entry(db, user, bot, price, private_client, background_tasks)
-                    elif signal == 'sell':
-                        await self._execute_spot_exit(db, user, bot, price, private_client, background_tasks)
-                else:  # Futures
-                    await self._execute_future_trade(db, user, bot, signal, price, private_client, background_tasks)
+                    if bot.market_type == MarketType.SPOT.value:
+                        if signal == 'buy':
+                            await self._execute_spot_entry(db, user, bot, price, private_client, background_tasks)
+                        elif signal == 'sell':
+                            await self._execute_spot_exit(db, user, bot, price, private_client, background_tasks)
+                    else:  # Futures
+                        await self._execute_future_trade(db, user, bot, signal, price, private_client, background_tasks)
+                finally:
+                    await private_client.close()
 
             # --- ROUTE 3: Custodial (Internal Ledger) ---
             elif bot.mode == BotMode.CUSTODIAL.value:
                 # Sizing for internal ledger based on wallet balance
-                quote_asset = bot.symbol.split('/')[1]
-                quote_balance = await wallet_service.get_balance(db, user.id, quote_asset)
-                amount_to_risk = quote_balance * Decimal("0.1")  # Risk 10% of quote balance
-                amount_base = amount_to_risk / price if price > 0 else Decimal(0)
+                if signal == 'sell' and bot.active_position_amount:
+                    amount_base = Decimal(str(bot.active_position_amount))
+                else:
+                    quote_asset = bot.symbol.split('/')[1]
+                    quote_balance = await wallet_service.get_balance(db, user.id, quote_asset)
+                    amount_to_risk = quote_balance * Decimal("0.1")  # Risk 10% of quote balance
+                    amount_base = amount_to_risk / price if price > 0 else Decimal(0)
                 if amount_base <= 0: return
+                if not in_position and not await self._check_exposure(user, bot, signal, amount_base, price):
+                    return
 
                 await trading_service.place_order_internal(user, bot, signal, amount_base, price)
 
@@ -5212,16 +9254,22 @@ class StrategyService:
         amount_to_trade = await trading_service.get_position_size(user, bot, client)
         if amount_to_trade <= 0: return
         entry_order = await client.create_market_buy_order(bot.symbol, float(amount_to_trade))
-        await asyncio.sleep(5)
-        filled_order = await client.fetch_order(entry_order['id'], bot.symbol)
-        entry_price = float(filled_order['average'])
-        amount_filled = float(filled_order['filled'])
+        filled_order = await order_fill_watcher.wait_for_fill(client, entry_order, bot.symbol)
+        amount_filled = float(filled_order.get('filled') or 0)
+        if amount_filled <= 0:
+            logger.error(f"Entry order {entry_order['id']} for bot {bot.id} did not fill (status: {filled_order.get('status')}).")
+            await telegram_service.notify_user(user.id, f"⚠️ Bot `{bot.name}`: BUY order on {bot.symbol} was not filled.")
+            return
+        entry_price = float(filled_order.get('average') or filled_order.get('price') or price)
+        account_state_cache.on_fill(account_state_cache.bot_account_key(bot), bot.symbol, filled_order)
+        exposure_book.on_fill(user.id, bot.id, bot.symbol, 'buy', amount_filled, entry_price)
+        stop_engine.arm(user, bot, entry_price)
         bot.active_position_id = filled_order['id']
         bot.active_position_entry_price = entry_price
         bot.active_position_amount = amount_filled
         await db.commit()
         msg = f"✅ *Spot Position Opened*\nBot: `{bot.name}`\nBUY `{amount_filled:.6f}` `{base_asset}` @ `~${entry_price:.2f}`"
-        send_telegram_notification_task.delay(user_id=user.id, message=msg)
+        await telegram_service.notify_user(user.id, msg)
         if bot.take_profit_percentage and bot.stop_loss_percentage:
             tp_price = entry_price * (1 + bot.take_profit_percentage / 100)
             sl_price = entry_price * (1 - bot.stop_loss_percentage / 100)
@@ -5240,7 +9288,12 @@ class StrategyService:
                 await client.cancel_order(bot.active_exit_order_id, bot.symbol)
             except Exception:
                 logger.warning(f"Could not cancel OCO order {bot.active_exit_order_id}.")
-        await client.create_market_sell_order(bot.symbol, bot.active_position_amount)
+        exit_order = await client.create_market_sell_order(bot.symbol, bot.active_position_amount)
+        account_state_cache.on_fill(account_state_cache.bot_account_key(bot), bot.symbol, exit_order)
+        exposure_book.on_fill(user.id, bot.id, bot.symbol, 'sell',
+                              float(exit_order.get('filled') or bot.active_position_amount),
+                              exit_order.get('average') or float(price))
+        stop_engine.disarm(bot.id)
         entry_price = bot.active_position_entry_price
         bot.active_position_id = None
         bot.active_position_entry_price = None
@@ -5260,7 +9313,8 @@ class StrategyService:
         except Exception as e:
             logger.warning(f"Could not set leverage for {bot.symbol}: {e}")
 
-        positions = await client.fetch_positions([bot.symbol])
+        account_key = account_state_cache.bot_account_key(bot)
+        positions = await account_state_cache.get_positions(account_key, bot.symbol, client)
         current_position = next((p for p in positions if p.get('symbol') == bot.symbol and p.get('contracts', 0) != 0),
                                 None)
 
@@ -5272,8 +9326,14 @@ class StrategyService:
             amount = float(current_position['contracts'])
             params = {'reduceOnly': True}
             logger.info(f"CLOSING {current_position['side']} position for bot {bot.id} with a {side} order.")
-            await client.create_order(bot.symbol, 'market', side, amount, params=params)
+            close_order = await client.create_order(bot.symbol, 'market', side, amount, params=params)
+            account_state_cache.on_fill(account_key, bot.symbol, close_order)
+            account_state_cache.set_positions(account_key, bot.symbol, [])
+            exposure_book.on_fill(user.id, bot.id, bot.symbol, side, float(close_order.get('filled') or amount),
+                                  close_order.get('average') or float(price))
+            stop_engine.disarm(bot.id)
             bot.active_position_entry_price = None
+            bot.active_position_amount = None
             await db.commit()
             background_tasks.add_task(trading_service.update_bot_pnl, db, bot.id)
             pnl_percent = ((float(price) - float(current_position['entryPrice'])) / float(
@@ -5282,419 +9342,105 @@ class StrategyService:
             result_emoji = "🎉" if pnl_percent >= 0 else "🔻"
             await telegram_service.notify_user(user.id,
                                                f"{result_emoji} *Futures Position Closed*\nBot: `{bot.name}`. Est. PNL: **{pnl_percent:+.2f}%**")
-        else:
-            side = 'buy' if signal == 'buy' else 'sell'
-            position_type = "LONG" if side == 'buy' else "SHORT"
-            logger.info(f"OPENING {position_type} position for bot {bot.id}.")
-            order = await client.create_market_order(bot.symbol, side, float(amount_to_trade))
-            await asyncio.sleep(2)  # Give time for position to register
-            positions_after = await client.fetch_positions([bot.symbol])
-            new_position = next(
-                (p for p in positions_after if p.get('symbol') == bot.symbol and p.get('contracts', 0) != 0), None)
-            if new_position:
-                bot.active_position_entry_price = float(new_position['entryPrice'])
-                await db.commit()
-            await telegram_service.notify_user(user.id,
-                                               f"🚀 *Futures Position Opened*\nBot: `{bot.name}` ({position_type} @ {bot.leverage}x).")  # --- NEW: The runner for all visual strategies ---
-
-
-    async def run_visual_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                  background_tasks: BackgroundTasks):
-        from collections import deque
-        historical_candles = deque(maxlen=250)
-
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', 250)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX: ADDED TRY HERE
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
-
-                if len(historical_candles) < 200:
-                    if len(historical_candles) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/200..."}, user.id)
-                    continue
-
-                df = pd.DataFrame(list(historical_candles))
-
-                # Evaluate Logic
-                try:
-                    interpreter = VisualStrategyInterpreter(json.loads(bot.visual_strategy_json), df)
-                    signal = interpreter.evaluate() # 'buy', 'sell', 'hold'
-                    
-                    # --- Heartbeat Log ---
-                    log_msg = f"📊 Visual Logic Result: {signal.upper()} | Price ${candle['close']:.2f}"
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                    async with async_session_maker() as db:
-                        current_bot = await db.get(TradingBot, bot.id)
-                        if not current_bot or not current_bot.is_active: break
-                        in_position = current_bot.active_position_entry_price is not None
-
-                        if signal == 'buy' and not in_position:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Visual Logic Triggered BUY!"}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
-                        elif signal == 'sell' and in_position:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 Visual Logic Triggered SELL!"}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(candle['close'])), background_tasks)
-
-                except Exception as e:
-                    logger.error(f"Visual strategy error: {e}")
-                    await websocket_manager.send_personal_message(
-                        {"type": "error", "bot_id": str(bot.id), "message": f"Logic Error: {e}"}, user.id)
-
-        except asyncio.CancelledError:
-            logger.info(f"Visual bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in Visual bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-
-    # --- STRATEGY 1: RSI & MACD Crossover ---
-    async def run_rsi_macd_crossover_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                              background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        rsi_period = params.get('rsi_period', 14)
-        rsi_overbought = params.get('rsi_overbought', 70)
-        rsi_oversold = params.get('rsi_oversold', 30)
-        macd_fast = params.get('macd_fast', 12)
-        macd_slow = params.get('macd_slow', 26)
-        macd_signal_period = params.get('macd_signal', 9)
-
-        from collections import deque
-        required_history = max(rsi_period, macd_slow) + 15
-        historical_closes = deque(maxlen=required_history)
-        previous_macd_hist_state = 0
-
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for candle in initial_ohlcv: historical_closes.append(float(candle[4]))
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_closes)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Execution Block ---
-        try: # <--- ADDED TRY HERE
-            while True:
-                kline = await data_queue.get()
-                close_price = float(kline['c'])
-                historical_closes.append(close_price)
-
-                if len(historical_closes) < required_history:
-                    if len(historical_closes) % 5 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_closes)}/{required_history} candles..."}, user.id)
-                    continue
-
-                # Indicators
-                series = pd.Series(list(historical_closes))
-                
-                # RSI
-                delta = series.diff()
-                gain = (delta.where(delta > 0, 0)).rolling(window=rsi_period).mean().iloc[-1]
-                loss = (-delta.where(delta < 0, 0)).rolling(window=rsi_period).mean().iloc[-1]
-                rs = gain / loss if loss != 0 else 0
-                current_rsi = 100 - (100 / (1 + rs))
-
-                # MACD
-                ema_fast = series.ewm(span=macd_fast, adjust=False).mean()
-                ema_slow = series.ewm(span=macd_slow, adjust=False).mean()
-                macd_line = ema_fast - ema_slow
-                signal_line = macd_line.ewm(span=macd_signal_period, adjust=False).mean()
-                current_macd_val = macd_line.iloc[-1]
-                current_signal_val = signal_line.iloc[-1]
-                current_macd_hist_state = 1 if current_macd_val > current_signal_val else -1
-
-                # Heartbeat Log
-                log_msg = f"📊 Analysis: Price ${close_price:.2f} | RSI: {current_rsi:.1f} | MACD: {current_macd_val:.4f}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                buy_signal = current_rsi < rsi_oversold and current_macd_hist_state == 1 and previous_macd_hist_state == -1
-                sell_signal = current_rsi > rsi_overbought and current_macd_hist_state == -1 and previous_macd_hist_state == 1
-                previous_macd_hist_state = current_macd_hist_state
-
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
-
-                    if buy_signal and not in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Oversold + MACD Cross! BUYING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(kline['c'])), background_tasks)
-                    elif sell_signal and in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 Overbought + MACD Cross! SELLING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(kline['c'])), background_tasks)
-
-        except asyncio.CancelledError:
-            logger.info(f"RSI/MACD bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in RSI/MACD bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-
-    async def hydrate_client(self, user: User, bot: TradingBot) -> Optional[BrokerClient]:
-        """A robust helper to create a private client for bot hydration."""
-        client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class))
-        if not client:
-            # This specific error message will be propagated to the user.
-            raise ConnectionError(f"Bot '{bot.name}' stopped: No valid API keys found for the '{bot.exchange}' exchange. Please add them in your settings.")
-        return client
-
-    # --- STRATEGY 2: Moving Average Crossover ---
-    async def run_ma_cross_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                    background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        short_window = params.get('short_window', 50)
-        long_window = params.get('long_window', 200)
-        
-        from collections import deque
-        # Store enough history
-        historical_closes = deque(maxlen=long_window + 5)
-        previous_ma_state = 0
-
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', long_window + 10)
-                await client.close()
-                for candle in initial_ohlcv: historical_closes.append(float(candle[4]))
-                
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_closes)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Execution Block ---
-        try:  # <--- THIS WAS MISSING
-            while True:
-                # 1. Wait for data
-                kline = await data_queue.get()
-                close_price = float(kline['c'])
-                historical_closes.append(close_price)
-
-                if len(historical_closes) < long_window:
-                    if len(historical_closes) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_closes)}/{long_window} candles..."}, user.id)
-                    continue
-
-                # 2. Indicators
-                series = pd.Series(list(historical_closes))
-                current_short_ma = series.rolling(window=short_window).mean().iloc[-1]
-                current_long_ma = series.rolling(window=long_window).mean().iloc[-1]
-                
-                current_ma_state = 1 if current_short_ma > current_long_ma else -1
-                
-                # 3. Heartbeat
-                log_msg = f"📊 Analysis: Price ${close_price:.2f} | MA({short_window}): {current_short_ma:.2f} | MA({long_window}): {current_long_ma:.2f}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, 
-                    user.id
-                )
-
-                # 4. Logic
-                buy_signal = current_ma_state == 1 and previous_ma_state == -1
-                sell_signal = current_ma_state == -1 and previous_ma_state == 1
-                previous_ma_state = current_ma_state
-
-                # 5. Execution
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
-
-                    if buy_signal and not in_position:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 GOLDEN CROSS DETECTED! Executing BUY..."},
-                            user.id
-                        )
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(kline['c'])), background_tasks)
-
-                    elif sell_signal and in_position:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 DEATH CROSS DETECTED! Executing SELL..."},
-                            user.id
-                        )
-                        await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(kline['c'])), background_tasks)
-
-        except asyncio.CancelledError:
-            logger.info(f"MA Cross bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in MA Cross bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-
-    # --- STRATEGY 3: Bollinger Bands ---
-
-    async def run_bollinger_bands_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                           background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        window = params.get('window', 20)
-        std_dev = params.get('std_dev', 2.0)
-        
-        from collections import deque
-        historical_closes = deque(maxlen=window + 5)
-
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', window + 10)
-                await client.close()
-                for candle in initial_ohlcv: historical_closes.append(float(candle[4]))
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_closes)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
+        else:
+            side = 'buy' if signal == 'buy' else 'sell'
+            position_type = "LONG" if side == 'buy' else "SHORT"
+            logger.info(f"OPENING {position_type} position for bot {bot.id}.")
+            order = await client.create_market_order(bot.symbol, side, float(amount_to_trade))
+            filled_order = await order_fill_watcher.wait_for_fill(client, order, bot.symbol)
+            if not float(filled_order.get('filled') or 0):
+                logger.error(f"Entry order {order['id']} for bot {bot.id} did not fill (status: {filled_order.get('status')}).")
+                await telegram_service.notify_user(user.id, f"⚠️ Bot `{bot.name}`: {position_type} order on {bot.symbol} was not filled.")
+                return
+            # The position exists once the order has filled; its entry price accounts for fees and partial fills.
+            account_state_cache.on_fill(account_key, bot.symbol, filled_order)
+            filled = float(filled_order['filled'])
+            exposure_book.on_fill(user.id, bot.id, bot.symbol, side, filled, filled_order.get('average') or float(price))
+            positions_after = await client.fetch_positions([bot.symbol])
+            account_state_cache.set_positions(account_key, bot.symbol, positions_after)
+            new_position = next(
+                (p for p in positions_after if p.get('symbol') == bot.symbol and p.get('contracts', 0) != 0), None)
+            entry_price = new_position['entryPrice'] if new_position else filled_order.get('average')
+            if entry_price:
+                bot.active_position_entry_price = float(entry_price)
+                bot.active_position_amount = filled if side == 'buy' else -filled  # Negative for shorts
+                await db.commit()
+                if side == 'buy':  # The stop engine protects long positions
+                    stop_engine.arm(user, bot, float(entry_price))
+            await telegram_service.notify_user(user.id,
+                                               f"🚀 *Futures Position Opened*\nBot: `{bot.name}` ({position_type} @ {bot.leverage}x).")
+
+    async def _on_paper_fill(self, user: User, bot: TradingBot, order: Dict):
+        """Tracks a paper bot's position through its simulated fills; the stop engine handles its TP/SL exits."""
+        exposure_book.on_fill(user.id, bot.id, bot.symbol, order["side"], order["filled"], order["average"], paper=True)
+        if order["side"] == 'buy':
+            paper_engine.set_position(bot.id, order["average"], order["filled"])
+            stop_engine.arm(user, bot, order["average"])
+        else:
+            paper_engine.set_position(bot.id, None, None)
+            stop_engine.disarm(bot.id)
 
-        # --- Main Execution Block ---
-        try: # <--- ADDED TRY HERE
-            while True:
-                kline = await data_queue.get()
-                close_price = float(kline['c'])
-                historical_closes.append(close_price)
+        msg = (f"📄 *Paper Trade Executed*\nBot: `{bot.name}`\n{order['side'].upper()} `{order['filled']:.6f}` "
+               f"at `${order['average']:.2f}` ({order['type']})")
+        await telegram_service.notify_user(user.id, msg)
 
-                if len(historical_closes) < window:
-                    if len(historical_closes) % 5 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_closes)}/{window} candles..."}, user.id)
-                    continue
+    async def _check_exposure(self, user: User, bot: TradingBot, side: str, amount: Any, price: Any) -> bool:
+        """Pre-trade risk check against the user's exposure across all of their bots."""
+        reason = exposure_book.check(user.id, bot.symbol, side, float(amount), price, paper=bot.is_paper_trading)
+        if reason is None:
+            return True
+        msg = f"Trade '{side}' for bot '{bot.name}' blocked by risk limits: {reason}"
+        bot_log_bus.emit(user.id, str(bot.id), msg)
+        await websocket_manager.send_personal_message({"type": "error", "bot_id": str(bot.id), "message": msg}, user.id)
+        return False
 
-                series = pd.Series(list(historical_closes))
-                sma = series.rolling(window=window).mean().iloc[-1]
-                std = series.rolling(window=window).std().iloc[-1]
-                upper_band = sma + (std * std_dev)
-                lower_band = sma - (std * std_dev)
+    # --- NEW: The runner for all multicast (shared signal) strategies ---
+    async def run_signal_strategy(self, user: User, bot: TradingBot, signal_queue: asyncio.Queue,
+                                  background_tasks: BackgroundTasks):
+        """
+        Consumes the shared SignalEvents for this bot's configuration and applies the
+        bot-specific part: position state, sizing and execution.
+        """
+        while True:
+            event: SignalEvent = await signal_queue.get()
+            if not bot_registry.is_active(bot.id):
+                break
 
-                # Heartbeat Log
-                log_msg = f"📊 Analysis: Price ${close_price:.2f} | Upper: {upper_band:.2f} | Lower: {lower_band:.2f}"
+            if event.action == 'error':
                 await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                buy_signal = close_price <= lower_band
-                sell_signal = close_price >= upper_band
-
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
+                    {"type": "error", "bot_id": str(bot.id), "message": event.message}, user.id)
+                continue
 
-                    if buy_signal and not in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Price below Lower Band. Reversion BUY..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(kline['c'])), background_tasks)
-                    elif sell_signal and in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 Price above Upper Band. Reversion SELL..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(kline['c'])), background_tasks)
+            # --- Heartbeat Log ---
+            if event.message:
+                bot_log_bus.emit(user.id, str(bot.id), event.message, level="heartbeat")
+            # Only actionable signals need the database; the registry already answered is_active.
+            if event.action not in ('buy', 'sell'):
+                continue
 
-        except asyncio.CancelledError:
-            logger.info(f"Bollinger Bands bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in Bollinger Bands bot {bot.id}: {e}", exc_info=True)
             async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-
-    # --- STRATEGY 4: Smart Money Concepts ---
-    async def run_smc_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                               background_tasks: BackgroundTasks):
-        from collections import deque
-        historical_candles = deque(maxlen=200)
-
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', 200)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Execution Block ---
-        try: # <--- ADDED TRY HERE
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
-
-                if len(historical_candles) < 50:
-                    if len(historical_candles) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/50 candles..."}, user.id)
-                    continue
-
-                df = pd.DataFrame(list(historical_candles))
-                df = self.smc_analyzer.find_bos_choch(df)
-                df = self.smc_analyzer.find_order_blocks(df)
-                latest = df.iloc[-1]
-
-                # Heartbeat Log
-                structure = "BOS (Bullish)" if latest['bos'] == 1 else ("BOS (Bearish)" if latest['bos'] == -1 else "Neutral")
-                ob_level = latest['bullish_ob'] if latest['bullish_ob'] > 0 else "None"
-                log_msg = f"📊 Analysis: Price ${candle['close']:.2f} | Structure: {structure} | Bullish OB: {ob_level}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
+                current_bot = await db.get(TradingBot, bot.id)
+                if not current_bot or not current_bot.is_active:
+                    bot_registry.deactivate(bot.id)
+                    break
+                in_position = self.get_position(current_bot)[0] is not None
 
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
-
-                    if not in_position:
-                        # Logic: 1. Bullish Change of Character detected recently. 2. Price dips into Bullish Order Block.
-                        bullish_choch = (df['choch'] == 1).rolling(10).sum().iloc[-1] > 0
-                        in_zone = latest['close'] <= latest['bullish_ob'] and latest['bullish_ob'] > 0
-                        
-                        if bullish_choch and in_zone:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 SMC Entry Validated! BUYING..."}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
+                if (event.action == 'buy' and not in_position) or (event.action == 'sell' and in_position):
+                    bot_log_bus.emit(user.id, str(bot.id), event.trigger)
+                    await self.execute_bot_trade(db, user, current_bot, event.action, Decimal(str(event.candle.close)),
+                                                 background_tasks)
 
-        except asyncio.CancelledError:
-            logger.info(f"SMC bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in SMC bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
+    async def hydrate_client(self, user: User, bot: TradingBot) -> Optional[BrokerClient]:
+        """A robust helper to create a private client for bot hydration."""
+        client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class))
+        if not client:
+            # This specific error message will be propagated to the user.
+            raise ConnectionError(f"Bot '{bot.name}' stopped: No valid API keys found for the '{bot.exchange}' exchange. Please add them in your settings.")
+        return client
 
     # --- STRATEGY 5: Grid Trading ---
     async def run_grid_trading_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue = None, background_tasks: BackgroundTasks = None):
-        # NOTE: Grid trading manages its own loop via API polling, not the data_queue.
+        # NOTE: Grid trading reacts to order fills from its venue, not to the data_queue.
         params = json.loads(bot.strategy_params)
         upper_price = Decimal(str(params.get('upper_price')))
         lower_price = Decimal(str(params.get('lower_price')))
@@ -5702,90 +9448,77 @@ class StrategyService:
         trade_amount_base = Decimal(str(params.get('trade_amount_base')))
 
         # --- Feedback ---
-        await websocket_manager.send_personal_message(
-            {"type": "bot_log", "bot_id": str(bot.id), "message": f"🕸️ Initializing Grid: {num_grids} levels between ${lower_price} and ${upper_price}."}, user.id)
+        bot_log_bus.emit(user.id, str(bot.id), f"🕸️ Initializing Grid: {num_grids} levels between ${lower_price} and ${upper_price}.")
 
         grid_lines = [Decimal(x) for x in np.linspace(float(lower_price), float(upper_price), num_grids)]
         grid_step = (upper_price - lower_price) / Decimal(num_grids - 1)
-        private_exchange = None
+        venue: Optional[GridOrderVenue] = None
 
         try:
-            # We need the raw CCXT client for grid management
-            broker_adapter = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if not isinstance(broker_adapter, CcxtClient):
-                raise ConnectionError("Grid trading requires a CCXT-compatible exchange.")
-            
-            private_exchange = broker_adapter._client 
+            if bot.is_paper_trading:
+                venue = SimulatedGridVenue(bot.exchange, bot.symbol)
+            else:
+                # We need the raw CCXT client for grid management
+                broker_adapter = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
+                if not isinstance(broker_adapter, CcxtClient):
+                    raise ConnectionError("Grid trading requires a CCXT-compatible exchange.")
+                venue = CcxtGridVenue(broker_adapter, bot.symbol)
 
             # 1. Setup
-            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🧹 Canceling existing open orders for symbol..."}, user.id)
-            await private_exchange.cancel_all_orders(bot.symbol)
-            
-            ticker = await private_exchange.fetch_ticker(bot.symbol)
-            current_price = Decimal(str(ticker['last']))
+            bot_log_bus.emit(user.id, str(bot.id), "🧹 Canceling existing open orders for symbol...")
+            await venue.cancel_all_orders()
+            current_price = await venue.fetch_price()
+
+            # Listen for fills before the first order goes out so none are missed.
+            venue.start()
 
-            # 2. Place Initial Grid
-            live_orders = {}
+            # 2. Place Initial Grid (one batch)
+            initial_orders = []
             for price in grid_lines:
                 side = 'buy' if price < current_price else 'sell'
                 # Skip if price is too close to current (avoid immediate fill taker fees if possible)
                 if abs(price - current_price) / current_price < 0.002: continue
+                initial_orders.append({"side": side, "amount": float(trade_amount_base), "price": float(price)})
 
-                try:
-                    order = await private_exchange.create_limit_order(bot.symbol, side, float(trade_amount_base), float(price))
-                    live_orders[order['id']] = order
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(bot.id), "message": f"placed {side.upper()} grid at ${price:.2f}"}, user.id)
-                    await asyncio.sleep(0.2) # Rate limit protection
-                except Exception as e:
-                    logger.error(f"Grid order failed: {e}")
-
-            await websocket_manager.send_personal_message(
-                {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Grid Active. Monitoring {len(live_orders)} orders..."}, user.id)
+            placed = await venue.place_orders(initial_orders)
+            bot_log_bus.emit(user.id, str(bot.id), f"✅ Grid Active. Placed {len(placed)}/{len(initial_orders)} orders, listening for fills...")
 
-            # 3. Monitor Loop
+            # 3. Event Loop: re-grid as soon as the venue reports a fill
             while True:
-                # Check database status
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
+                # Check registry status
+                if not bot_registry.is_active(bot.id): break
 
-                await asyncio.sleep(30) # Poll every 30s
-                
-                try:
-                    open_orders = await private_exchange.fetch_open_orders(bot.symbol)
-                    open_order_ids = {o['id'] for o in open_orders}
-                    filled_order_ids = set(live_orders.keys()) - open_order_ids
+                updates = await venue.next_updates(timeout=30)
+                if not updates:
+                    # Heartbeat
+                    bot_log_bus.emit(user.id, str(bot.id), "zzz... No grid levels hit.", level="heartbeat")
+                    continue
 
-                    if not filled_order_ids:
-                        # Heartbeat
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": "zzz... No grid levels hit."}, user.id)
+                counter_orders = []
+                for order in updates:
+                    filled_price = Decimal(str(order['price']))
+                    filled_side = order['side']
+                    if order['status'] != 'closed':
+                        bot_log_bus.emit(user.id, str(bot.id), f"⚠️ Grid {filled_side.upper()} at ${filled_price} was {order['status']}.")
                         continue
 
-                    for order_id in filled_order_ids:
-                        filled_order = live_orders.pop(order_id)
-                        filled_price = Decimal(str(filled_order['price']))
-                        filled_side = filled_order['side']
-                        
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"💰 Grid Level Hit! {filled_side.upper()} filled at ${filled_price}."}, user.id)
-
-                        # Place Counter-Order
-                        new_side = 'sell' if filled_side == 'buy' else 'buy'
-                        new_price = filled_price + grid_step if new_side == 'sell' else filled_price - grid_step
-                        
-                        # Validate bounds
-                        if lower_price <= new_price <= upper_price:
-                            new_order = await private_exchange.create_limit_order(bot.symbol, new_side, float(trade_amount_base), float(new_price))
-                            live_orders[new_order['id']] = new_order
-                            await websocket_manager.send_personal_message(
-                                {"type": "bot_log", "bot_id": str(bot.id), "message": f"🔄 Replacing grid: {new_side.upper()} at ${new_price:.2f}"}, user.id)
+                    bot_log_bus.emit(user.id, str(bot.id), f"💰 Grid Level Hit! {filled_side.upper()} filled at ${filled_price}.")
+
+                    # Counter-Order
+                    new_side = 'sell' if filled_side == 'buy' else 'buy'
+                    new_price = filled_price + grid_step if new_side == 'sell' else filled_price - grid_step
 
+                    # Validate bounds
+                    if lower_price <= new_price <= upper_price:
+                        counter_orders.append({"side": new_side, "amount": float(trade_amount_base), "price": float(new_price)})
+
+                try:
+                    for new_order in await venue.place_orders(counter_orders):
+                        bot_log_bus.emit(user.id, str(bot.id), f"🔄 Replacing grid: {new_order['side'].upper()} at ${new_order['price']:.2f}", level="debug")
                 except Exception as e:
-                    logger.error(f"Grid monitor error: {e}")
+                    logger.error(f"Grid re-placement error: {e}")
                     await websocket_manager.send_personal_message(
-                        {"type": "error", "bot_id": str(bot.id), "message": f"Grid polling error: {str(e)}"}, user.id)
+                        {"type": "error", "bot_id": str(bot.id), "message": f"Grid order error: {str(e)}"}, user.id)
 
         except asyncio.CancelledError:
             logger.info("Grid task cancelled")
@@ -5794,447 +9527,281 @@ class StrategyService:
             async with async_session_maker() as db:
                 await self.stop_bot(db, bot)
         finally:
-            if private_exchange:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "🛑 Stopping Grid. Cancelling open orders..."}, user.id)
+            if venue:
+                bot_log_bus.emit(user.id, str(bot.id), "🛑 Stopping Grid. Cancelling open orders...")
                 try:
-                    await private_exchange.cancel_all_orders(bot.symbol)
+                    await venue.cancel_all_orders()
                 except: pass
-                await private_exchange.close()
-
-    async def run_volatility_squeeze_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                              background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        bb_period = params.get('bb_period', 20)
-        bb_std = params.get('bb_std', 2.0)
-        kc_period = params.get('kc_period', 20)
-        kc_atr_mult = params.get('kc_atr_mult', 1.5)
-
-        from collections import deque
-        required_history = max(bb_period, kc_period) + 10
-        historical_candles = deque(maxlen=required_history)
-        in_squeeze = False
+                await venue.close()
 
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX: Added this try block
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
-
-                if len(historical_candles) < required_history:
-                    if len(historical_candles) % 5 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/{required_history} candles..."}, user.id)
-                    continue
-
-                df = pd.DataFrame(list(historical_candles))
-                df.ta.bbands(length=bb_period, std=bb_std, append=True)
-                df.ta.kc(length=kc_period, scalar=kc_atr_mult, append=True)
-                latest = df.iloc[-1]
-
-                # Logic
-                squeeze_is_on = latest[f'BBL_{bb_period}_{bb_std}'] > latest[f'KCL_{kc_period}_{kc_atr_mult}'] and \
-                                latest[f'BBU_{bb_period}_{bb_std}'] < latest[f'KCU_{kc_period}_{kc_atr_mult}']
-                squeeze_released = not squeeze_is_on and in_squeeze
-                
-                # --- Heartbeat Log ---
-                status = "ON (Accumulating)" if squeeze_is_on else "OFF"
-                log_msg = f"📊 Analysis: Price ${candle['close']:.2f} | Squeeze: {status}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                buy_signal = squeeze_released and latest['close'] > latest[f'BBU_{bb_period}_{bb_std}']
-                # Update state
-                in_squeeze = squeeze_is_on
-
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
 
-                    if buy_signal and not in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Squeeze Released Upward! BUYING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
+strategy_service = StrategyService()
 
-        except asyncio.CancelledError:
-            logger.info(f"Volatility Squeeze bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in Volatility Squeeze bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-                
-    async def run_supertrend_adx_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                          background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        st_period = params.get('st_period', 12)
-        st_multiplier = params.get('st_multiplier', 3.0)
-        adx_period = params.get('adx_period', 14)
-        adx_threshold = params.get('adx_threshold', 25)
 
-        from collections import deque
-        required_history = max(st_period, adx_period) + 15
-        historical_candles = deque(maxlen=required_history)
+# --- NEW: Sharded Bot Runners ---
+class ConsistentHashRing:
+    """Maps bot ids onto runner ids so a runner joining or leaving only moves ~1/N of the bots."""
 
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
+    def __init__(self, nodes: List[str], replicas: int = 64):
+        self._ring: List[Tuple[int, str]] = sorted(
+            (self._hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in self._ring]
 
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
 
-                if len(historical_candles) < required_history:
-                    if len(historical_candles) % 5 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/{required_history} candles..."}, user.id)
-                    continue
+    def get_node(self, key: str) -> Optional[str]:
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
 
-                df = pd.DataFrame(list(historical_candles))
-                df.ta.supertrend(length=st_period, multiplier=st_multiplier, append=True)
-                df.ta.adx(length=adx_period, append=True)
-                latest = df.iloc[-1]
-                prev = df.iloc[-2]
 
-                # Logic
-                adx_val = latest[f'ADX_{adx_period}']
-                is_trending = adx_val > adx_threshold
-                st_col = f'SUPERTd_{st_period}_{st_multiplier}'
-                
-                # --- Heartbeat Log ---
-                trend_str = "TRENDING" if is_trending else "RANGING"
-                # Check if supertrend column exists before accessing
-                if st_col in latest:
-                    dir_str = "BULLISH" if latest[st_col] == 1 else "BEARISH"
-                    log_msg = f"📊 Analysis: ADX: {adx_val:.1f} ({trend_str}) | SuperTrend: {dir_str}"
-                    await websocket_manager.send_personal_message(
-                        {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                    buy_flip = latest[st_col] == 1 and prev[st_col] == -1
-                    sell_flip = latest[st_col] == -1 and prev[st_col] == 1
-                    buy_signal = buy_flip and is_trending
-                    sell_signal = sell_flip and is_trending
-
-                    async with async_session_maker() as db:
-                        current_bot = await db.get(TradingBot, bot.id)
-                        if not current_bot or not current_bot.is_active: break
-                        in_position = current_bot.active_position_entry_price is not None
-
-                        if buy_signal and not in_position:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Trend Start (Buy) Detected!"}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
-                        elif sell_signal and in_position:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 Trend Flip (Sell) Detected!"}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(candle['close'])), background_tasks)
-        
-        except asyncio.CancelledError:
-            logger.info(f"SuperTrend/ADX bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in SuperTrend/ADX bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
+class BotShardCoordinator:
+    """
+    Runs inside each bot runner process. Every sync it heartbeats, rebuilds the hash ring from
+    the live runners, and runs exactly the active bots that hash to it and whose lease it holds.
+    A bot is only ever run by the holder of an unexpired lease, so a crashed runner's bots are
+    picked up by the others once its heartbeat and leases lapse.
+    """
 
-    async def run_ichimoku_breakout_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                             background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        tenkan = params.get('tenkan_period', 9)
-        kijun = params.get('kijun_period', 26)
-        senkou = params.get('senkou_period', 52)
+    def __init__(self, runner_id: Optional[str] = None):
+        self.runner_id = runner_id or settings.BOT_RUNNER_ID or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = settings.BOT_RUNNER_LEASE_SECONDS
+        self.sync_seconds = settings.BOT_RUNNER_SYNC_SECONDS
+        self.owned_bots: Dict[PythonUUID, TradingBot] = {}
+        self._last_renewal = 0.0
+        self._stopping = asyncio.Event()
 
-        from collections import deque
-        required_history = senkou + 26 + 10 # Senkou B shift + buffer
-        historical_candles = deque(maxlen=required_history)
+    def stop(self):
+        self._stopping.set()
 
-        # --- Hydration ---
+    async def run(self):
+        logger.info(f"Bot runner {self.runner_id} joining the shard ring.")
         try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
-
-                if len(historical_candles) < required_history:
-                    if len(historical_candles) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/{required_history} candles..."}, user.id)
-                    continue
-
-                df = pd.DataFrame(list(historical_candles))
-                df.ta.ichimoku(tenkan=tenkan, kijun=kijun, senkou=senkou, append=True)
-                latest = df.iloc[-1]
-                prev = df.iloc[-2]
-
-                # Cloud Components
-                span_a = latest[f'ISA_{tenkan}']
-                span_b = latest[f'ISB_{kijun}']
-                cloud_top = max(span_a, span_b)
-                cloud_bottom = min(span_a, span_b)
-                price = latest['close']
-
-                # --- Heartbeat Log ---
-                pos = "ABOVE Cloud" if price > cloud_top else ("BELOW Cloud" if price < cloud_bottom else "INSIDE Cloud")
-                log_msg = f"📊 Analysis: Price ${price:.2f} | {pos}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                # Breakout Logic
-                bullish_breakout = price > cloud_top and prev['close'] <= max(prev[f'ISA_{tenkan}'], prev[f'ISB_{kijun}'])
-                bearish_breakout = price < cloud_bottom and prev['close'] >= min(prev[f'ISA_{tenkan}'], prev[f'ISB_{kijun}'])
-
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
-
-                    if bullish_breakout and not in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🟢 Kumo Breakout UP! BUYING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
-                    elif bearish_breakout and in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🔴 Kumo Breakout DOWN! SELLING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(candle['close'])), background_tasks)
+            while not self._stopping.is_set():
+                try:
+                    await self.sync()
+                except Exception as e:
+                    logger.error(f"Bot runner {self.runner_id} sync failed: {e}", exc_info=True)
+                    # Fence ourselves once our leases may have lapsed; another runner may already own the bots.
+                    if self.owned_bots and time.monotonic() - self._last_renewal > self.lease_seconds:
+                        logger.warning(f"Bot runner {self.runner_id} could not renew its leases. Detaching all bots.")
+                        await self._detach_all()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.sync_seconds)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.leave()
 
-        except asyncio.CancelledError:
-            logger.info(f"Ichimoku bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in Ichimoku bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
+    async def sync(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expires_at = now + datetime.timedelta(seconds=self.lease_seconds)
 
-    async def run_ai_enhanced_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                       background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        confidence_threshold = params.get('confidence_threshold', 0.2)
-        fast_ema = 10
-        slow_ema = 30
+        async with async_session_maker() as db:
+            # 1. Heartbeat, then rebuild the ring from every runner seen within one lease period.
+            await db.merge(BotRunnerNode(runner_id=self.runner_id, last_heartbeat=now))
+            await db.execute(delete(BotRunnerNode).where(
+                BotRunnerNode.last_heartbeat < now - datetime.timedelta(seconds=self.lease_seconds * 10)))
+            await db.commit()
 
-        from collections import deque
-        required_history = 200 # Needed for AI feature engineering
-        historical_candles = deque(maxlen=required_history + 5)
+            live_since = now - datetime.timedelta(seconds=self.lease_seconds)
+            runner_ids = (await db.scalars(
+                select(BotRunnerNode.runner_id).where(BotRunnerNode.last_heartbeat > live_since))).all()
+            ring = ConsistentHashRing(list(runner_ids))
 
-        # --- Hydration ---
-        try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data for AI..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
-        except Exception as e:
-            logger.error(f"Hydration failed: {e}")
+            active_bots = (await db.scalars(select(TradingBot).where(TradingBot.is_active == True))).all()
+            assigned = {
+                bot.id: bot for bot in active_bots
+                if strategy_service.runs_in_runner(bot) and ring.get_node(str(bot.id)) == self.runner_id
+            }
 
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
+            # 2. Hand back bots that were stopped or now hash to another runner.
+            released = [bot_id for bot_id in self.owned_bots if bot_id not in assigned]
+            for bot_id in released:
+                await strategy_service.detach_bot(self.owned_bots.pop(bot_id))
+            if released:
+                await db.execute(delete(BotLease).where(
+                    BotLease.runner_id == self.runner_id, BotLease.bot_id.in_(released)))
+                logger.info(f"Bot runner {self.runner_id} released {len(released)} bot(s).")
+
+            # 3. Renew the leases we keep, and drop any bot whose lease was taken over meanwhile.
+            if self.owned_bots:
+                await db.execute(
+                    update(BotLease)
+                    .where(BotLease.runner_id == self.runner_id, BotLease.bot_id.in_(list(self.owned_bots)))
+                    .values(expires_at=expires_at)
+                )
+                held = set((await db.scalars(
+                    select(BotLease.bot_id).where(BotLease.runner_id == self.runner_id))).all())
+                for bot_id in [bot_id for bot_id in self.owned_bots if bot_id not in held]:
+                    logger.warning(f"Bot runner {self.runner_id} lost the lease on bot {bot_id}.")
+                    await strategy_service.detach_bot(self.owned_bots.pop(bot_id))
+            await db.commit()
+            self._last_renewal = time.monotonic()
 
-                if len(historical_candles) < required_history:
-                    if len(historical_candles) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/{required_history} for AI model..."}, user.id)
+            # 4. Claim newly assigned bots. One still leased to a runner that is handing it back is retried next sync.
+            for bot_id, bot in assigned.items():
+                if bot_id in self.owned_bots or not await self._acquire_lease(bot_id, now, expires_at):
                     continue
-
-                df = pd.DataFrame(list(historical_candles))
-                
-                # Base Logic (EMA Cross)
-                df['ema_fast'] = df['close'].ewm(span=fast_ema, adjust=False).mean()
-                df['ema_slow'] = df['close'].ewm(span=slow_ema, adjust=False).mean()
-                latest = df.iloc[-1]
-                prev = df.iloc[-2]
-                
-                base_buy = latest['ema_fast'] > latest['ema_slow'] and prev['ema_fast'] <= prev['ema_slow']
-                base_sell = latest['ema_fast'] < latest['ema_slow'] and prev['ema_fast'] >= prev['ema_slow']
-
-                # --- Heartbeat Log ---
-                log_msg = f"📊 Analysis: Price ${candle['close']:.2f} | AI Ready."
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
-
-                if not base_buy and not base_sell:
+                user = await db.get(User, bot.owner_id)
+                if not user or not user.is_subscription_active():
+                    bot.is_active = False
+                    await db.commit()
+                    await self._release_leases([bot_id])
+                    logger.warning(f"Deactivated bot {bot_id} due to inactive user or expired subscription.")
                     continue
+                if await strategy_service.resume_bot(user, bot):
+                    self.owned_bots[bot_id] = bot
+                else:
+                    await self._release_leases([bot_id])
 
-                # Run AI only on signal
-                await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": "🤖 Base Signal detected. Querying Optimus AI..."}, user.id)
-                ai_result = ml_service.analyze_market_conditions(df)
-                ai_score = ai_result.get("score", 0)
-                
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
-
-                    if base_buy and not in_position:
-                        if ai_score > confidence_threshold:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": f"🟢 AI Confirmed (Score: {ai_score:.2f})! BUYING..."}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
-                        else:
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": f"⛔ AI Vetoed Buy (Score: {ai_score:.2f} < {confidence_threshold})."}, user.id)
-
-                    elif base_sell and in_position:
-                        if ai_score < -confidence_threshold: # Confidence in bearishness
-                            await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": f"🔴 AI Confirmed (Score: {ai_score:.2f})! SELLING..."}, user.id)
-                            await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(candle['close'])), background_tasks)
-
-        except asyncio.CancelledError:
-            logger.info(f"AI Enhanced bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in AI Enhanced bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
-
-    async def run_optimizer_portfolio_strategy(self, user: User, bot: TradingBot, data_queue: asyncio.Queue,
-                                               background_tasks: BackgroundTasks):
-        params = json.loads(bot.strategy_params)
-        strategy_pool_names = params.get('strategy_pool', ["RSI_MACD_Crossover", "MA_Cross"])
-        min_confluence = params.get('min_confluence', 2)
-        trend_filter_period = params.get('trend_filter_period', 200)
+    async def _acquire_lease(self, bot_id: PythonUUID, now: datetime.datetime,
+                             expires_at: datetime.datetime) -> bool:
+        # A separate session keeps a lost race from rolling back the caller's loaded bots.
+        async with async_session_maker() as db:
+            result = await db.execute(
+                update(BotLease)
+                .where(BotLease.bot_id == bot_id,
+                       or_(BotLease.runner_id == self.runner_id, BotLease.expires_at <= now))
+                .values(runner_id=self.runner_id, expires_at=expires_at)
+            )
+            if result.rowcount:
+                await db.commit()
+                return True
+            if await db.get(BotLease, bot_id):
+                return False
+            db.add(BotLease(bot_id=bot_id, runner_id=self.runner_id, expires_at=expires_at))
+            try:
+                await db.commit()
+                return True
+            except SQLAlchemyIntegrityError:
+                return False
 
-        from collections import deque
-        required_history = 250 
-        historical_candles = deque(maxlen=required_history + 5)
+    async def _release_leases(self, bot_ids: List[PythonUUID]):
+        async with async_session_maker() as db:
+            await db.execute(delete(BotLease).where(
+                BotLease.runner_id == self.runner_id, BotLease.bot_id.in_(bot_ids)))
+            await db.commit()
 
-        # Instantiate sub-strategies
-        sub_strategies = []
-        for name in strategy_pool_names:
-            StrategyClass = STRATEGY_REGISTRY.get(name)
-            if StrategyClass and name != "Optimizer_Portfolio":
-                # Initialize with empty state and default params
-                sub_strategies.append(StrategyClass(0, bot.symbol, '1m', {}, {}))
+    async def _detach_all(self):
+        for bot in list(self.owned_bots.values()):
+            await strategy_service.detach_bot(bot)
+        self.owned_bots.clear()
 
-        # --- Hydration ---
+    async def leave(self):
+        """Stops local bots and gives up membership so the other runners take them over on their next sync."""
+        await self._detach_all()
         try:
-            client = await exchange_manager.get_private_client(user.id, bot.exchange, AssetClass(bot.asset_class), MarketType.SPOT)
-            if client:
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": "📥 Fetching historical data for Portfolio..."}, user.id)
-                initial_ohlcv = await client.fetch_ohlcv(bot.symbol, '1m', required_history)
-                await client.close()
-                for t, o, h, l, c, v in initial_ohlcv:
-                    historical_candles.append({'timestamp': t, 'open': o, 'high': h, 'low': l, 'close': c, 'volume': v})
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": f"✅ Hydrated with {len(historical_candles)} candles."}, user.id)
+            async with async_session_maker() as db:
+                await db.execute(delete(BotLease).where(BotLease.runner_id == self.runner_id))
+                await db.execute(delete(BotRunnerNode).where(BotRunnerNode.runner_id == self.runner_id))
+                await db.commit()
         except Exception as e:
-            logger.error(f"Hydration failed: {e}")
-
-        # --- Main Loop ---
-        try: # <--- CRITICAL FIX: ADDED TRY HERE
-            while True:
-                kline = await data_queue.get()
-                candle = {'timestamp': kline['t'], 'open': float(kline['o']), 'high': float(kline['h']),
-                          'low': float(kline['l']), 'close': float(kline['c']), 'volume': float(kline['v'])}
-                historical_candles.append(candle)
-
-                if len(historical_candles) < required_history:
-                    if len(historical_candles) % 10 == 0:
-                        await websocket_manager.send_personal_message(
-                            {"type": "bot_log", "bot_id": str(bot.id), "message": f"⏳ Gathering data: {len(historical_candles)}/{required_history} candles..."}, user.id)
-                    continue
+            logger.error(f"Bot runner {self.runner_id} could not release its leases: {e}")
+        logger.info(f"Bot runner {self.runner_id} left the shard ring.")
 
-                df = pd.DataFrame(list(historical_candles))
-
-                # Run Voting
-                buy_votes = 0
-                sell_votes = 0
-                details = []
-
-                for sub in sub_strategies:
-                    sub.update_data(df.copy()) # Pass copy to avoid conflicts
-                    signal_obj = sub.generate_signal()
-                    if signal_obj.action == "BUY":
-                        buy_votes += 1
-                        details.append(f"{type(sub).__name__}: BUY")
-                    elif signal_obj.action == "SELL":
-                        sell_votes += 1
-                        details.append(f"{type(sub).__name__}: SELL")
-
-                # Trend Filter
-                long_ema = df['close'].ewm(span=trend_filter_period, adjust=False).mean().iloc[-1]
-                is_uptrend = candle['close'] > long_ema
-                trend_str = "UP" if is_uptrend else "DOWN"
-
-                # --- Heartbeat Log ---
-                log_msg = f"🗳️ Votes: {buy_votes} BUY / {sell_votes} SELL | Trend: {trend_str}"
-                await websocket_manager.send_personal_message(
-                    {"type": "bot_log", "bot_id": str(bot.id), "message": log_msg}, user.id)
 
-                # Decision
-                final_buy = buy_votes >= min_confluence and is_uptrend
-                final_sell = sell_votes >= min_confluence and not is_uptrend
+bot_shard_coordinator = BotShardCoordinator()
 
-                async with async_session_maker() as db:
-                    current_bot = await db.get(TradingBot, bot.id)
-                    if not current_bot or not current_bot.is_active: break
-                    in_position = current_bot.active_position_entry_price is not None
 
-                    if final_buy and not in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": f"🏆 Confluence Reached ({buy_votes} Votes)! BUYING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'buy', Decimal(str(candle['close'])), background_tasks)
-                    elif final_sell and in_position:
-                        await websocket_manager.send_personal_message({"type": "bot_log", "bot_id": str(bot.id), "message": f"🏆 Confluence Reached ({sell_votes} Votes)! SELLING..."}, user.id)
-                        await self.execute_bot_trade(db, user, current_bot, 'sell', Decimal(str(candle['close'])), background_tasks)
+# --- NEW: Startup Bot Restart Scheduler ---
+class BotRestartScheduler:
+    """
+    Resumes the active bots after a restart in the background, so the API serves requests
+    while they come back. Bots holding a position go first, then by plan. Each exchange gets
+    its own worker pool and token bucket, so a large restart can't trip an exchange's rate limits.
+    """
+    PLAN_PRIORITY = {SubscriptionPlan.ULTIMATE.value: 0, SubscriptionPlan.PREMIUM.value: 1,
+                     SubscriptionPlan.BASIC.value: 2}
 
-        except asyncio.CancelledError:
-            logger.info(f"Optimizer bot {bot.id} task was cancelled.")
-        except Exception as e:
-            logger.error(f"Critical error in Optimizer bot {bot.id}: {e}", exc_info=True)
-            async with async_session_maker() as db:
-                await self.stop_bot(db, bot)
+    def __init__(self):
+        self.concurrency = settings.BOT_RESTART_CONCURRENCY
+        self.rate = settings.BOT_RESTART_RATE
+        self.state = "pending"
+        self.started_at: Optional[datetime.datetime] = None
+        self.finished_at: Optional[datetime.datetime] = None
+        self.deactivated = 0
+        self.exchanges: Dict[str, Dict[str, int]] = {}
+
+    def priority(self, bot: TradingBot) -> tuple:
+        return (bot.active_position_entry_price is None,
+                self.PLAN_PRIORITY.get(bot.owner.subscription_plan, len(self.PLAN_PRIORITY)))
+
+    async def run(self):
+        self.state = "restarting"
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            async with async_session_maker() as session:
+                active_bots = (await session.scalars(
+                    select(TradingBot).options(selectinload(TradingBot.owner)).where(TradingBot.is_active == True)
+                )).all()
+                queued = []
+                for bot in active_bots:
+                    if bot.owner and bot.owner.is_subscription_active():
+                        # In "external" mode the bot runner processes own the streaming/grid bots instead.
+                        if settings.BOT_RUNNER_MODE == "embedded" and strategy_service.runs_in_runner(bot):
+                            queued.append(bot)
+                    else:
+                        bot.is_active = False
+                        self.deactivated += 1
+                        logger.warning(f"Deactivated bot {bot.id} on startup due to inactive user or expired subscription.")
+                await session.commit()
 
+            by_exchange: Dict[str, deque] = defaultdict(deque)
+            for bot in sorted(queued, key=self.priority):
+                by_exchange[bot.exchange].append(bot)
+            self.exchanges = {name: {"total": len(bots), "restarted": 0, "failed": 0}
+                              for name, bots in by_exchange.items()}
+            logger.info(f"Restarting {len(queued)} active bots across {len(by_exchange)} exchanges.")
+
+            workers = []
+            for name, bots in by_exchange.items():
+                bucket = TokenBucket(self.rate, self.concurrency)
+                workers += [self._worker(name, bots, bucket) for _ in range(min(self.concurrency, len(bots)))]
+            await asyncio.gather(*workers)
+        finally:
+            self.state = "ready"
+            self.finished_at = datetime.datetime.now(datetime.timezone.utc)
+        status = self.get_status()
+        logger.info(f"Bot restart finished: {status['restarted']} restarted, {status['failed']} failed, "
+                    f"{self.deactivated} deactivated.")
+
+    async def _worker(self, exchange: str, bots: deque, bucket: TokenBucket):
+        while bots:
+            bot = bots.popleft()
+            await bucket.acquire()
+            logger.info(f"Restarting active bot {bot.id} for user {bot.owner_id} on server startup.")
+            # The bot is already active in the DB, so start_bot would ignore it; resume its loop directly.
+            ok = await strategy_service.resume_bot(bot.owner, bot)
+            self.exchanges[exchange]["restarted" if ok else "failed"] += 1
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def get_status(self) -> Dict[str, Any]:
+        total = sum(e["total"] for e in self.exchanges.values())
+        restarted = sum(e["restarted"] for e in self.exchanges.values())
+        failed = sum(e["failed"] for e in self.exchanges.values())
+        return {
+            "ready": self.ready,
+            "state": self.state,
+            "total": total,
+            "restarted": restarted,
+            "failed": failed,
+            "remaining": total - restarted - failed,
+            "deactivated": self.deactivated,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "exchanges": self.exchanges,
+        }
 
 
-strategy_service = StrategyService()
+bot_restart_scheduler = BotRestartScheduler()
 
 
 
@@ -6351,12 +9918,29 @@ notification_service = NotificationService()
 # 7. FASTAPI LIFESPAN MANAGER & APP SETUP
 # ==============================================================================
 
+# --- NEW: Columns added to existing tables (create_all only creates missing tables) ---
+ADDED_COLUMNS = [
+    ("trading_bots", "trailing_stop_percentage", "FLOAT"),
+]
+
+
+def add_missing_columns(sync_conn):
+    """Adds nullable columns introduced after a deployment's tables were first created."""
+    inspector = sa_inspect(sync_conn)
+    for table, column, ddl_type in ADDED_COLUMNS:
+        if column not in {c["name"] for c in inspector.get_columns(table)}:
+            logger.warning(f"Adding missing column {table}.{column}.")
+            sync_conn.execute(sa_text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # ==================================================================
     # APPLICATION STARTUP LOGIC
     # ==================================================================
     logger.info("QuantumLeap AI Trader Starting Up...")
+    if settings.TELEGRAM_WEBHOOK_URL and not settings.TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET must be set when TELEGRAM_WEBHOOK_URL is configured.")
     load_ai_models()
     
 
@@ -6366,6 +9950,7 @@ async def lifespan(app: FastAPI):
         # This command tells SQLAlchemy to look at all your classes that inherit
         # from `Base` and create the corresponding tables if they don't exist.
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_missing_columns)
     logger.info("Database tables verified/created successfully.")
 
     # --- THIS IS THE LOGIC THAT CREATES THE SUPERUSER ROW ---
@@ -6399,27 +9984,27 @@ async def lifespan(app: FastAPI):
         # --- 3. Start All Background Services ---
         logger.info("Starting background services...")
         # Store all background tasks on app.state for graceful shutdown.
-        # The `run_polling` method is now correctly run as a background task.
-        app.state.telegram_task = asyncio.create_task(telegram_service.run_polling())
+        # Updates arrive by webhook when TELEGRAM_WEBHOOK_URL is set, otherwise by long polling.
+        if settings.TELEGRAM_WEBHOOK_URL:
+            app.state.telegram_task = asyncio.create_task(telegram_service.run_webhook())
+        else:
+            app.state.telegram_task = asyncio.create_task(telegram_service.run_polling())
+        app.state.telegram_outbox_task = asyncio.create_task(telegram_outbox.run_dispatcher())
         app.state.market_regime_task = asyncio.create_task(market_regime_service.run_analysis_loop())
+        app.state.account_reconcile_task = asyncio.create_task(account_state_cache.run_reconciliation_loop())
+        app.state.exposure_reconcile_task = asyncio.create_task(exposure_book.run_reconciliation_loop())
         app.state.broadcast_task = asyncio.create_task(broadcast_market_data())
+        await price_alert_engine.load()
+        if settings.BOT_RUNNER_MODE == "external":
+            app.state.websocket_relay_task = asyncio.create_task(websocket_relay.run_subscriber())
+        if settings.SCANNER_ENABLED:
+            app.state.market_scanner_task = asyncio.create_task(market_scanner.run())
         logger.info("All background services have been started.")
 
     # --- 3. Restart Any Active Trading Bots ---
+    # Runs in the background; progress is reported by GET /api/public/ready.
     logger.info("Checking for active bots to restart...")
-    async with async_session_maker() as session:
-        active_bots_result = await session.execute(select(TradingBot).where(TradingBot.is_active == True))
-        active_bots = active_bots_result.scalars().all()
-
-        for bot in active_bots:
-            user = await session.get(User, bot.owner_id)
-            if user and user.is_subscription_active():
-                logger.info(f"Restarting active bot {bot.id} for user {user.id} on server startup.")
-                await strategy_service.start_bot(session, user, bot, BackgroundTasks())
-            else:
-                bot.is_active = False
-                await session.commit()
-                logger.warning(f"Deactivated bot {bot.id} on startup due to inactive user or expired subscription.")
+    app.state.bot_restart_task = asyncio.create_task(bot_restart_scheduler.run())
 
     # --- Application is now running ---
     yield
@@ -6438,12 +10023,24 @@ async def lifespan(app: FastAPI):
     # Safely get tasks from app.state, avoiding AttributeErrors
     if hasattr(app.state, 'telegram_task'):
         tasks_to_cancel.append(app.state.telegram_task)
+    if hasattr(app.state, 'telegram_outbox_task'):
+        tasks_to_cancel.append(app.state.telegram_outbox_task)
     if hasattr(app.state, 'market_regime_task'):
         tasks_to_cancel.append(app.state.market_regime_task)
     if hasattr(app.state, 'broadcast_task'):
         tasks_to_cancel.append(app.state.broadcast_task)
     if hasattr(app.state, 'mt5_listener_task'):
         tasks_to_cancel.append(app.state.mt5_listener_task)
+    if hasattr(app.state, 'websocket_relay_task'):
+        tasks_to_cancel.append(app.state.websocket_relay_task)
+    if hasattr(app.state, 'bot_restart_task'):
+        tasks_to_cancel.append(app.state.bot_restart_task)
+    if hasattr(app.state, 'account_reconcile_task'):
+        tasks_to_cancel.append(app.state.account_reconcile_task)
+    if hasattr(app.state, 'exposure_reconcile_task'):
+        tasks_to_cancel.append(app.state.exposure_reconcile_task)
+    if hasattr(app.state, 'market_scanner_task'):
+        tasks_to_cancel.append(app.state.market_scanner_task)
 
     logger.info("Cancelling background service tasks...")
     for task in tasks_to_cancel:
@@ -6465,7 +10062,16 @@ async def lifespan(app: FastAPI):
     logger.info("Closing external connections...")
     await mt5_gateway_service.shutdown()  # Ensure this is called
     await exchange_manager.close_all_public()
+    await order_fill_watcher.close()
+    await paper_engine.close()
+    stop_engine.close()
+    price_alert_engine.close()
+    await telegram_outbox.close()
+    await exchange_manager.close_all_private()
+    await signal_multicaster.close()
+    strategy_executor.shutdown()
     await market_streamer.close()
+    await websocket_relay.close()
     await engine.dispose()
     logger.info("All external connections closed. Shutdown complete.")
 
@@ -6930,6 +10536,7 @@ async def add_api_key(key_data: APIKeyCreate, current_user: User = Depends(get_c
     db.add(new_key)
     await db.commit()
     await db.refresh(new_key)
+    exchange_manager.invalidate_user_clients(current_user.id, key_data.exchange)
 
     # --- FIX 2: Include the asset_class in the response ---
     return APIKeySchema(
@@ -6973,6 +10580,7 @@ async def delete_api_key(key_id: int, current_user: User = Depends(get_current_u
         raise HTTPException(status_code=404, detail="API Key not found.")
     await db.delete(key_to_delete)
     await db.commit()
+    exchange_manager.invalidate_user_clients(current_user.id, key_to_delete.exchange)
     return
 
 
@@ -7057,14 +10665,7 @@ async def get_user_portfolio(
     api_keys = api_keys_result.scalars().all()
 
     for key_entry in api_keys:
-        private_client = await exchange_manager.get_private_client(
-            current_user.id,
-            key_entry.exchange,
-            AssetClass(key_entry.asset_class),
-            MarketType.SPOT
-        )
-        if private_client:
-            fetch_tasks.append(fetch_exchange_balance(private_client))
+        fetch_tasks.append(fetch_cached_exchange_balance(current_user.id, key_entry.exchange, key_entry.asset_class))
 
     # 3. Aggregation
     if not fetch_tasks:
@@ -7214,6 +10815,18 @@ async def fetch_exchange_balance(client: BrokerClient) -> Dict:
             await client.close()
 
 
+async def fetch_cached_exchange_balance(user_id: str, exchange: str, asset_class: str) -> Dict:
+    """Spot balances for the portfolio, served from the account state cache."""
+    key = account_state_cache.account_key(user_id, exchange, asset_class, MarketType.SPOT)
+    balance = await account_state_cache.get_balance(key)
+    non_zero_balances = {
+        asset: amount
+        for asset, amount in balance['total'].items()
+        if amount and amount > 0.00001
+    }
+    return {"source": exchange.title(), "balances": non_zero_balances}
+
+
 async def fetch_asset_price(exchange: ccxt.Exchange, symbol: str) -> float:
     """Helper coroutine to fetch a single asset price."""
     try:
@@ -7474,6 +11087,7 @@ async def create_trading_bot(
             owner_id=current_user.id,
             symbol=bot_data.symbol.upper(),
             exchange=bot_data.exchange.value,
+            timeframe=bot_data.timeframe,
             is_paper_trading=bot_data.is_paper_trading,
             strategy_type=bot_data.strategy_type.value,
             strategy_name=bot_data.strategy_name,
@@ -7483,6 +11097,7 @@ async def create_trading_bot(
             leverage=bot_data.leverage,
             take_profit_percentage=bot_data.take_profit_percentage,
             stop_loss_percentage=bot_data.stop_loss_percentage,
+            trailing_stop_percentage=bot_data.trailing_stop_percentage,
             market_regime_filter_enabled=bot_data.market_regime_filter_enabled,
             optimus_enabled=bot_data.optimus_enabled,
             # Add sizing strategy if it's part of your DB model
@@ -7810,6 +11425,12 @@ async def get_market_ticker(symbols: Optional[List[str]] = Query(None)):
 
     return list(all_tickers.values())
 
+@public_router.get("/ready")
+async def get_readiness():
+    """Readiness probe: 503 until every active bot has been restarted after a deploy, with progress."""
+    status = bot_restart_scheduler.get_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
 @public_router.post("/chat")
 async def handle_public_chat(request: ChatRequest):
     if not request.message.strip():
@@ -8057,6 +11678,7 @@ class TradingBotUpdate(BaseModel):
     name: Optional[str] = None
     symbol: Optional[str] = None
     exchange: Optional[ExchangeName] = None
+    timeframe: Optional[str] = None
     asset_class: Optional[AssetClass] = None
     strategy_type: Optional[StrategyType] = None
     market_type: Optional[MarketType] = None
@@ -8066,6 +11688,7 @@ class TradingBotUpdate(BaseModel):
     visual_strategy_json: Optional[Dict[str, Any]] = None
     take_profit_percentage: Optional[float] = Field(None, gt=0)
     stop_loss_percentage: Optional[float] = Field(None, gt=0)
+    trailing_stop_percentage: Optional[float] = Field(None, gt=0, lt=100)
     leverage: Optional[int] = Field(None, gt=0, le=125)
     market_regime_filter_enabled: Optional[bool] = None
     optimus_enabled: Optional[bool] = None
@@ -8073,6 +11696,13 @@ class TradingBotUpdate(BaseModel):
     # --- NEW: Allow cache to be passed without erroring ---
     backtest_results_cache: Optional[Any] = None
 
+    @field_validator('timeframe')
+    @classmethod
+    def check_timeframe(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and v not in TIMEFRAME_SECONDS:
+            raise ValueError(f"Unsupported timeframe '{v}'. Use one of: {', '.join(TIMEFRAME_SECONDS)}.")
+        return v
+
     # --- FIX: Validator to handle JSON strings ---
     @field_validator('strategy_params', 'visual_strategy_json', 'backtest_results_cache', mode='before')
     @classmethod
@@ -8168,6 +11798,7 @@ async def clone_strategy(
         strategy_params=public_bot.strategy_params,  # Copies the exact parameters
         symbol=public_bot.symbol,
         exchange=public_bot.exchange,
+        timeframe=public_bot.timeframe,
         # Cloned bots default to private and paper trading for safety
         is_public=False,
         is_paper_trading=True,
@@ -8263,6 +11894,17 @@ async def compare_strategies(
     return ranked_results
 
 
+@market_router.get("/scanner")
+async def get_market_scanner(user: User = Depends(get_current_user)):
+    """
+    The latest ranked opportunities from the market scanner. Live updates are pushed over the
+    websocket after sending {"action": "subscribe_scanner"}.
+    """
+    if not settings.SCANNER_ENABLED:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="The market scanner is not enabled.")
+    return market_scanner.get_results()
+
+
 @market_router.get("/analysis/copilot/{exchange}/{symbol:path}")
 async def get_copilot_analysis(
     request: Request, # <-- This type hint is now unambiguous and correct
@@ -8313,6 +11955,61 @@ async def get_copilot_analysis(
             detail="Market analysis is temporarily unavailable. Both primary and fallback data sources failed."
         )
 
+# --- NEW: Exposure Endpoints ---
+@users_router.get("/me/exposure")
+async def get_my_exposure(current_user: User = Depends(get_current_user)):
+    """Net position and USD exposure per asset across all of the user's bots, live and paper, with the limits."""
+    return exposure_book.get_user_exposure(current_user.id)
+
+
+# --- NEW: Price Alert Endpoints ---
+@users_router.post("/me/alerts", response_model=PriceAlertSchema, status_code=status.HTTP_201_CREATED)
+async def create_price_alert(alert_in: PriceAlertCreate, db: AsyncSession = Depends(get_db),
+                             current_user: User = Depends(get_current_user)):
+    """Creates a one-shot alert that fires when the price crosses the given level."""
+    if price_alert_engine.count_for_user(current_user.id) >= PriceAlertEngine.MAX_ALERTS_PER_USER:
+        raise HTTPException(status_code=400, detail=f"You can have at most {PriceAlertEngine.MAX_ALERTS_PER_USER} active price alerts.")
+    try:
+        market_streamer.get_provider(alert_in.exchange.value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Price alerts are not available for {alert_in.exchange.value}: it has no live market stream.")
+    direction = alert_in.direction
+    if direction is None:
+        try:
+            current_price = float(await account_state_cache.get_price(alert_in.exchange.value, alert_in.symbol))
+        except Exception as e:
+            logger.warning(f"Could not price {alert_in.symbol} for a new alert: {e}")
+            raise HTTPException(status_code=400, detail="Current price unavailable; specify the alert direction explicitly.")
+        direction = "above" if alert_in.price >= current_price else "below"
+    alert = PriceAlert(user_id=current_user.id, exchange=alert_in.exchange.value, symbol=alert_in.symbol,
+                       direction=direction, price=alert_in.price, note=alert_in.note)
+    db.add(alert)
+    await db.commit()
+    await db.refresh(alert)
+    price_alert_engine.add(alert)
+    return alert
+
+
+@users_router.get("/me/alerts", response_model=List[PriceAlertSchema])
+async def list_price_alerts(include_triggered: bool = False, db: AsyncSession = Depends(get_db),
+                            current_user: User = Depends(get_current_user)):
+    query = select(PriceAlert).where(PriceAlert.user_id == current_user.id)
+    if not include_triggered:
+        query = query.where(PriceAlert.is_active.is_(True))
+    return (await db.scalars(query.order_by(PriceAlert.created_at.desc()).limit(500))).all()
+
+
+@users_router.delete("/me/alerts/{alert_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_price_alert(alert_id: PythonUUID, db: AsyncSession = Depends(get_db),
+                             current_user: User = Depends(get_current_user)):
+    alert = await db.get(PriceAlert, alert_id)
+    if not alert or alert.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Price alert not found.")
+    price_alert_engine.remove(str(alert.id))
+    await db.delete(alert)
+    await db.commit()
+
+
 # --- NEW: Telegram Endpoints ---
 @users_router.get("/me/telegram/link", response_model=TelegramLinkResponse)
 async def get_telegram_link_code(current_user: User = Depends(get_current_user)):
@@ -8612,6 +12309,17 @@ async def log_mt5_trade(
     return {"status": "trade logged successfully"}
 
 
+@integrations_router.post("/telegram/webhook")
+async def telegram_webhook(request: Request):
+    """Receives bot updates from Telegram when TELEGRAM_WEBHOOK_URL is set."""
+    secret = settings.TELEGRAM_WEBHOOK_SECRET
+    # Without a secret anyone could post updates into the bot's handlers, so it is always required.
+    if not secret or not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+        raise HTTPException(status_code=403, detail="Invalid Telegram webhook secret.")
+    await telegram_service.process_webhook_update(await request.json())
+    return {"status": "ok"}
+
+
 @integrations_router.get("/mt5/credentials", response_model=List[MT5CredentialsSchema])
 async def get_mt5_credentials(user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(MT5Credentials).where(MT5Credentials.user_id == user.id))
@@ -8634,7 +12342,7 @@ async def connect_to_mt5(creds: MT5CredentialsCreate, user: User = Depends(get_c
         raise HTTPException(status_code=400, detail="Failed to connect to MT5. Check terminal status and credentials.")
 
     # 2. Fetch Account Summary (Balance, Equity, etc.)
-    details = await mt5_gateway_service.get_account_summary()
+    details = await mt5_gateway_service.get_account_summary(login=creds.account_number)
 
     # 3. Return combined response
     return {
@@ -8645,9 +12353,11 @@ async def connect_to_mt5(creds: MT5CredentialsCreate, user: User = Depends(get_c
 
 
 @integrations_router.post("/mt5/disconnect")
-async def disconnect_from_mt5(user: User = Depends(get_current_user)):
-    """Disconnects the gateway from the MT5 terminal."""
-    await mt5_gateway_service.shutdown()
+async def disconnect_from_mt5(user: User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    """Disconnects the user's account from the MT5 gateway; other users' accounts stay connected."""
+    mt5_login = await db.scalar(select(MT5Credentials.account_number).where(MT5Credentials.user_id == user.id))
+    if mt5_login:
+        await mt5_gateway_service.disconnect(int(mt5_login))
     return {"status": "success", "message": "MT5 Gateway disconnected."}
 
 
@@ -9027,6 +12737,24 @@ async def get_system_stats(db: AsyncSession = Depends(get_db)):
             "running_bot_tasks": len(strategy_service.running_bot_tasks), "total_trades_logged": total_trades}
 
 
+@superuser_router.get("/market-streams/subscribers", dependencies=[Depends(get_current_superuser)])
+async def get_stream_subscriber_stats():
+    """Queue depth and drop counts of every market data and signal channel subscriber in this process."""
+    return {"market_streams": market_streamer.get_subscriber_stats(),
+            "connections": market_streamer.get_connection_stats(),
+            "signal_channels": signal_multicaster.get_subscriber_stats(),
+            "bot_logs": bot_log_bus.get_stats(),
+            "stops": stop_engine.get_stats(),
+            "price_alerts": price_alert_engine.get_stats(),
+            "scanner": market_scanner.get_stats()}
+
+
+@superuser_router.get("/risk/exposure", dependencies=[Depends(get_current_superuser)])
+async def get_exposure_stats():
+    """Largest live exposures and pre-trade rejections, as booked by this process."""
+    return exposure_book.get_stats()
+
+
 @superuser_router.get("/users", response_model=List[UserSchema], dependencies=[Depends(get_current_superuser)])
 async def list_all_users(db: AsyncSession = Depends(get_db)):
     result = await db.execute(select(User).order_by(User.created_at.desc()))
@@ -9049,6 +12777,10 @@ async def impersonate_user(user_id: str, db: AsyncSession = Depends(get_db)):
 async def emergency_kill_switch(background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
     logger.critical("!!! EMERGENCY KILL SWITCH ACTIVATED BY SUPERUSER !!!")
 
+    # Halt every in-process loop immediately; the orderly stops below clean up resources.
+    halted = bot_registry.deactivate_all()
+    logger.critical(f"Kill Switch: {len(halted)} registered bots halted.")
+
     async def kill_bots_task():
         async with async_session_maker() as session:
             active_bots_result = await session.execute(select(TradingBot).where(TradingBot.is_active == True))
@@ -9323,6 +13055,24 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
             elif action == "unsubscribe_chart":
                 websocket_manager.unsubscribe_from_symbol(user_id)
 
+            elif action == "subscribe_bot":
+                bot_id = data.get("bot_id")
+                if bot_id:
+                    websocket_manager.subscribe_to_bot(user_id, str(bot_id))
+
+            elif action == "unsubscribe_bot":
+                bot_id = data.get("bot_id")
+                if bot_id:
+                    websocket_manager.unsubscribe_from_bot(user_id, str(bot_id))
+
+            elif action == "subscribe_scanner":
+                websocket_manager.set_viewing_scanner(user_id, True)
+                if market_scanner.scanned_at is not None:
+                    await websocket_manager.send_personal_message(market_scanner.get_results(), user_id)
+
+            elif action == "unsubscribe_scanner":
+                websocket_manager.set_viewing_scanner(user_id, False)
+
     except WebSocketDisconnect:
         if user_id:
             websocket_manager.disconnect(user_id)
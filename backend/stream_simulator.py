@@ -0,0 +1,192 @@
+# backend/stream_simulator.py (NEW FILE)
+#
+# Offline kline sources for load testing the market data pipeline.
+# Used in-process by the "synthetic" and "replay" stream providers in main.py, and served
+# over a local websocket that speaks Binance's combined-stream protocol:
+#
+#   python stream_simulator.py --port 8765 --rate 10000
+#   BINANCE_STREAM_URL=ws://localhost:8765/stream  (in the API / bot runner environment)
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import math
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+from aiohttp import WSMsgType, web
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def binance_stream_name(symbol: str) -> str:
+    """'BTC/USDT', 'btcusdt' or 'btc/usdt:usdt' -> 'btcusdt@kline_1m'."""
+    return f"{symbol.split(':')[0].replace('/', '').lower()}@kline_1m"
+
+
+def kline_message(stream: str, timestamp: int, o: float, h: float, l: float, c: float, v: float) -> str:
+    """A closed 1m kline in Binance's combined-stream envelope."""
+    symbol = stream.split('@')[0].upper()
+    return json.dumps({
+        "stream": stream,
+        "data": {
+            "e": "kline", "E": timestamp + 60_000, "s": symbol,
+            "k": {"t": timestamp, "T": timestamp + 59_999, "s": symbol, "i": "1m",
+                  "o": f"{o:.8f}", "h": f"{h:.8f}", "l": f"{l:.8f}", "c": f"{c:.8f}", "v": f"{v:.4f}",
+                  "x": True},
+        },
+    })
+
+
+class _Pacer:
+    """Sleeps just enough to hold `rate` messages per second on average; 0 means unthrottled."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._started = time.monotonic()
+        self._sent = 0
+
+    async def tick(self, count: int):
+        self._sent += count
+        if self.rate <= 0:
+            await asyncio.sleep(0)
+            return
+        delay = self._started + self._sent / self.rate - time.monotonic()
+        await asyncio.sleep(max(delay, 0))
+
+
+class SyntheticKlineSource:
+    """
+    Endless, realistic-looking 1m klines: a geometric random walk per symbol with
+    wick and volume noise. Each round emits one candle for every subscribed stream,
+    and candle time advances a minute per round regardless of wall-clock time.
+    """
+
+    def __init__(self, rate: float = 100.0, volatility: float = 0.002, seed: Optional[int] = None):
+        self.rate = rate
+        self.volatility = volatility
+        self._random = random.Random(seed)
+        self._prices: Dict[str, float] = {}
+        self._next_open: Dict[str, int] = {}
+
+    def _next_candle(self, stream: str) -> str:
+        start = int(time.time() // 60 * 60_000)
+        timestamp = self._next_open.get(stream, start)
+        self._next_open[stream] = timestamp + 60_000
+        o = self._prices.get(stream) or 10 ** self._random.uniform(0, 4.5)
+        c = o * math.exp(self._random.gauss(0, self.volatility))
+        h = max(o, c) * (1 + abs(self._random.gauss(0, self.volatility / 2)))
+        l = min(o, c) * (1 - abs(self._random.gauss(0, self.volatility / 2)))
+        v = self._random.lognormvariate(3, 1)
+        self._prices[stream] = c
+        return kline_message(stream, timestamp, o, h, l, c, v)
+
+    async def messages(self, streams: Set[str]) -> AsyncIterator[str]:
+        pacer = _Pacer(self.rate)
+        while True:
+            batch = sorted(streams)
+            if not batch:
+                await asyncio.sleep(0.1)
+                continue
+            for stream in batch:
+                yield self._next_candle(stream)
+            await pacer.tick(len(batch))
+
+
+class ReplayKlineSource:
+    """
+    Replays a CSV of 1m candles (header: symbol,timestamp,open,high,low,close,volume) in file
+    order, skipping symbols nobody subscribed to. With `loop`, the file repeats with timestamps
+    shifted forward so consumers keep seeing new candles.
+    """
+
+    def __init__(self, path: str, rate: float = 0.0, loop: bool = True):
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+
+    def _load(self) -> List[tuple]:
+        with open(self.path, newline='') as f:
+            return [(binance_stream_name(row['symbol']), int(row['timestamp']), float(row['open']),
+                     float(row['high']), float(row['low']), float(row['close']), float(row['volume']))
+                    for row in csv.DictReader(f)]
+
+    async def messages(self, streams: Set[str]) -> AsyncIterator[str]:
+        rows = self._load()
+        if not rows:
+            return
+        span = rows[-1][1] - rows[0][1] + 60_000
+        pacer = _Pacer(self.rate)
+        offset = 0
+        while True:
+            for stream, timestamp, o, h, l, c, v in rows:
+                if stream in streams:
+                    yield kline_message(stream, timestamp + offset, o, h, l, c, v)
+                    await pacer.tick(1)
+            if not self.loop:
+                return
+            offset += span
+
+
+# ==============================================================================
+# Local websocket server (Binance combined-stream protocol)
+# ==============================================================================
+async def _stream_handler(request: web.Request) -> web.WebSocketResponse:
+    ws = web.WebSocketResponse(autoping=True)
+    await ws.prepare(request)
+    streams: Set[str] = {s for s in request.query.get('streams', '').split('/') if s}
+    source = request.app['source_factory']()
+
+    async def pump():
+        async for message in source.messages(streams):
+            await ws.send_str(message)
+
+    pump_task = asyncio.create_task(pump())
+    logger.info(f"Client connected with {len(streams)} streams.")
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            frame = json.loads(msg.data)
+            method = frame.get("method")
+            if method == "SUBSCRIBE":
+                streams.update(frame.get("params", []))
+            elif method == "UNSUBSCRIBE":
+                streams.difference_update(frame.get("params", []))
+            await ws.send_str(json.dumps({"result": None, "id": frame.get("id")}))
+    finally:
+        pump_task.cancel()
+        logger.info("Client disconnected.")
+    return ws
+
+
+def build_app(source_factory) -> web.Application:
+    app = web.Application()
+    app['source_factory'] = source_factory
+    app.router.add_get('/stream', _stream_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake kline websocket server (Binance combined-stream protocol).")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rate', type=float, default=1000.0, help="Messages per second per connection; 0 = unthrottled.")
+    parser.add_argument('--replay', help="CSV file to replay instead of generating synthetic klines.")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.replay:
+        source_factory = lambda: ReplayKlineSource(args.replay, args.rate)
+    else:
+        source_factory = lambda: SyntheticKlineSource(args.rate, seed=args.seed)
+    logger.info(f"Serving fake klines on ws://{args.host}:{args.port}/stream at {args.rate or 'unthrottled'} msgs/s")
+    web.run_app(build_app(source_factory), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -171,13 +171,16 @@ def run_optimization_task(self, user_id: str, request_data: dict):
 # 2. HIGH-PRIORITY TASKS (Notifications)
 # ==============================================================================
 
-@celery_app.task(base=AsyncDbTask, name="app.tasks.send_telegram_notification_task")
-def send_telegram_notification_task(user_id: str, message: str):
-    """Sends a formatted notification to a user via Telegram."""
+@celery_app.task(base=AsyncDbTask, name="app.tasks.send_telegram_notification_task", bind=True)
+def send_telegram_notification_task(self, user_id: str, message: str):
+    """Queues a notification in the Telegram outbox; the API's dispatcher delivers it."""
+    from .main import telegram_outbox
     logger.info(f"Executing Telegram notification task for user {user_id}")
 
     async def main():
         await self.telegram_service.notify_user(user_id, message)
+        # Write it to the outbox now: this loop doesn't outlive the task.
+        await telegram_outbox.close()
 
     get_async_loop().run_until_complete(main())
 
@@ -2,7 +2,7 @@
 
 import asyncio
 import logging
-from main import telegram_service  # Import the already configured service from main.py
+from main import settings, telegram_outbox, telegram_service  # Import the already configured services from main.py
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -11,16 +11,21 @@ logger = logging.getLogger(__name__)
 async def main():
     """
     This is the entry point for the background worker.
-    It initializes and runs the Telegram polling service indefinitely.
+    It delivers the Telegram outbox and, unless the API receives updates by webhook
+    (TELEGRAM_WEBHOOK_URL), runs the Telegram polling service indefinitely.
     """
     logger.info("Starting Telegram background worker...")
     await telegram_service.initialize_bot_info()
     telegram_service.setup_handlers()
-    await telegram_service.run_polling()
-
-    # Keep the worker alive
-    while True:
-        await asyncio.sleep(3600)
+    dispatcher_task = asyncio.create_task(telegram_outbox.run_dispatcher())
+    try:
+        if not settings.TELEGRAM_WEBHOOK_URL:
+            await telegram_service.run_polling()
+        # Keep the worker alive delivering the outbox
+        await dispatcher_task
+    finally:
+        dispatcher_task.cancel()
+        await asyncio.gather(dispatcher_task, return_exceptions=True)
 
 
 if __name__ == "__main__":
@@ -89,6 +89,7 @@ const CreateBotForm = ({ onSubmit, isLoading, initialData = null }) => {
         leverage: 10,
         take_profit_percentage: '',
         stop_loss_percentage: '',
+        trailing_stop_percentage: '',
         market_regime_filter_enabled: false,
         optimus_enabled: false,
         strategy_params: {},
@@ -112,6 +113,7 @@ const CreateBotForm = ({ onSubmit, isLoading, initialData = null }) => {
                 strategy_params: parsedParams || {},
                 take_profit_percentage: initialData.take_profit_percentage || '',
                 stop_loss_percentage: initialData.stop_loss_percentage || '',
+                trailing_stop_percentage: initialData.trailing_stop_percentage || '',
                 leverage: initialData.leverage || 10,
             });
         }
@@ -165,6 +167,7 @@ const CreateBotForm = ({ onSubmit, isLoading, initialData = null }) => {
         payload.leverage = parseInt(botData.leverage, 10);
         payload.take_profit_percentage = botData.take_profit_percentage ? parseFloat(botData.take_profit_percentage) : null;
         payload.stop_loss_percentage = botData.stop_loss_percentage ? parseFloat(botData.stop_loss_percentage) : null;
+        payload.trailing_stop_percentage = botData.trailing_stop_percentage ? parseFloat(botData.trailing_stop_percentage) : null;
 
         if (payload.exchange === 'mt5' || payload.exchange === 'mt4') {
             payload.is_paper_trading = false;
@@ -317,6 +320,7 @@ const CreateBotForm = ({ onSubmit, isLoading, initialData = null }) => {
                 <div className="grid grid-cols-1 md:grid-cols-2 gap-4">
                     <Input label="Take Profit (%)" name="take_profit_percentage" type="number" step="0.1" placeholder="Optional, e.g., 5" value={botData.take_profit_percentage} onChange={handleInputChange} />
                     <Input label="Stop Loss (%)" name="stop_loss_percentage" type="number" step="0.1" placeholder="Optional, e.g., 2" value={botData.stop_loss_percentage} onChange={handleInputChange} />
+                    <Input label="Trailing Stop (%)" name="trailing_stop_percentage" type="number" step="0.1" placeholder="Optional, e.g., 3" value={botData.trailing_stop_percentage} onChange={handleInputChange} />
                 </div>
             </div>
 
@@ -27,7 +27,9 @@ export const WebSocketProvider = ({ children }) => {
             ws.current.onmessage = (event) => {
                 const message = JSON.parse(event.data);
                 console.log("WebSocket Message:", message);
-                setMessages(prevMessages => [message, ...prevMessages.slice(0, 99)]); // Keep last 100 messages
+                // Bot logs can arrive batched; unpack them so listeners see individual messages (newest first).
+                const incoming = message.type === 'bot_log_batch' ? [...message.entries].reverse() : [message];
+                setMessages(prevMessages => [...incoming, ...prevMessages].slice(0, 100)); // Keep last 100 messages
 
                 // Trigger Toasts for user feedback
                 if (message.type === 'trade_executed') {
@@ -1,11 +1,12 @@
 // src/pages/BotDetailPage.js
 
-import React, { useMemo, useState } from 'react';
+import React, { useEffect, useMemo, useState } from 'react';
 import { useParams, Link } from 'react-router-dom';
 import { useQuery, useMutation, useQueryClient } from '@tanstack/react-query';
 import { useApiMutation } from '../hooks/useApiMutation'; 
 import { fetchBotDetails, fetchBotLogs, startBot, stopBot, updateBot } from '../api/apiService'; // Ensure updateBot is imported
 import useWebSocketListener from '../hooks/useWebSocketListener';
+import { useWebSocket } from '../contexts/WebSocketContext';
 import Spinner from '../components/common/Spinner';
 import Alert from '../components/common/Alert';
 import Card from '../components/common/Card';
@@ -64,6 +65,14 @@ const BotDetailPage = () => {
     );
 
     // --- WebSocket for Real-time Logs ---
+    // The server only streams a bot's logs while someone has it open.
+    const { isConnected, sendMessage } = useWebSocket();
+    useEffect(() => {
+        if (!isConnected) return;
+        sendMessage({ action: 'subscribe_bot', bot_id: botId });
+        return () => sendMessage({ action: 'unsubscribe_bot', bot_id: botId });
+    }, [botId, isConnected]); // eslint-disable-line react-hooks/exhaustive-deps
+
     const filterCondition = React.useMemo(() => (msg) => msg.bot_id === botId, [botId]);
     const liveLogs = useWebSocketListener(filterCondition);
 
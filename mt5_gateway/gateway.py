@@ -1,8 +1,12 @@
 # mt5_gateway/gateway.py
 import asyncio
+import datetime
 import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from typing import Dict, Any, Optional
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
 
 import MetaTrader5 as mt5
 import uvicorn
@@ -35,12 +39,14 @@ class TradeRequest(BaseModel):
     volume: float
     sl_pips: int
     tp_pips: int
+    login: int  # Trades always name their account; only reads fall back to the last connected one
 
 class HistoricalDataRequest(BaseModel):
     symbol: str
     timeframe: str
     start_date: str # ISO format string
     end_date: str   # ISO format string
+    login: Optional[int] = None
 
 # --- Security Dependency ---
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=True)
@@ -51,115 +57,229 @@ async def verify_api_key(key: str = Security(api_key_header)):
         raise HTTPException(status_code=403, detail="Invalid or missing API Key")
 
 # --- The Core Gateway Service ---
+class MT5Job(NamedTuple):
+    login: int
+    fn: Callable[[], Any]
+    future: asyncio.Future
+
+
 class MT5GatewayService:
+    """
+    Runs all terminal work on one dedicated thread, scheduled from priority lanes: trades, then
+    account queries, then history. Requests for the account the terminal is logged into go
+    first within a lane, so account switches are paid once per group; MAX_STREAK_PER_LOGIN
+    keeps other accounts from starving. Identical history requests in flight share one fetch,
+    and terminal health is re-checked at most every HEALTH_CHECK_SECONDS.
+    """
+    TRADE, ACCOUNT, HISTORY = 0, 1, 2
+    HEALTH_CHECK_SECONDS = 15
+    MAX_STREAK_PER_LOGIN = 20
+
     def __init__(self):
-        self._is_connected = False
-        self._lock = asyncio.Lock()
-        self._connection_info: Dict[str, Any] = {}
+        self._accounts: Dict[int, MT5Credentials] = {}
+        self._default_login: Optional[int] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mt5")
+        self._lanes: List[deque] = [deque(), deque(), deque()]
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self._worker_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        # Touched only on the MT5 thread
+        self._initialized = False
+        self._current_login: Optional[int] = None
+        self._checked_at = 0.0
+        self._scheduled_login: Optional[int] = None
+        self._streak = 0
         logger.info("MT5 Gateway Service initialized.")
 
-    async def _run_in_thread(self, func, *args, **kwargs):
-        """Runs any blocking MT5 function in a separate thread."""
-        return await asyncio.to_thread(func, *args, **kwargs)
+    def _submit(self, lane: int, login: int, fn: Callable[[], Any], key: Optional[tuple] = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(MT5Job(login, fn, future))
+        if key is not None:
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        if self._worker_task is None or self._worker_task.done():
+            self._wakeup = asyncio.Event()
+            self._worker_task = asyncio.create_task(self._run_worker())
+        self._wakeup.set()
+        return future
+
+    def _next_job(self) -> Optional[MT5Job]:
+        for lane in self._lanes:
+            if not lane:
+                continue
+            job = None
+            if self._streak < self.MAX_STREAK_PER_LOGIN:
+                job = next((j for j in lane if j.login == self._scheduled_login), None)
+            if job is not None:
+                lane.remove(job)
+            else:
+                job = lane.popleft()
+            self._streak = self._streak + 1 if job.login == self._scheduled_login else 1
+            self._scheduled_login = job.login
+            return job
+        return None
+
+    async def _run_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if job.future.done():
+                continue
+            try:
+                result = await loop.run_in_executor(self._executor, self._run_job, job)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+
+    def _run_job(self, job: MT5Job):
+        self._ensure_session(job.login)
+        try:
+            return job.fn()
+        except Exception:
+            self._checked_at = 0.0
+            raise
+
+    def _ensure_session(self, login: int, force: bool = False):
+        """Runs on the MT5 thread. Logs into `login` unless the terminal is already there and healthy."""
+        now = time.monotonic()
+        if not force and self._current_login == login:
+            if now - self._checked_at < self.HEALTH_CHECK_SECONDS:
+                return
+            account = mt5.account_info() if mt5.terminal_info() else None
+            if account is not None and account.login == login:
+                self._checked_at = now
+                return
+            logger.warning(f"MT5 connection for account {login} lost or unresponsive. Reconnecting...")
+
+        creds = self._accounts.get(login)
+        if creds is None:
+            raise ConnectionError(f"MT5 Gateway has no credentials for account {login}.")
+        if not self._initialized or not mt5.terminal_info():
+            if not mt5.initialize():
+                self._current_login = None
+                raise ConnectionError(f"MT5 initialize() failed: {mt5.last_error()}")
+            self._initialized = True
+        if not mt5.login(login=creds.login, password=creds.password, server=creds.server):
+            self._current_login = None
+            raise ConnectionError(f"MT5 login failed for account {login}: {mt5.last_error()}")
+        self._current_login = login
+        self._checked_at = now
+
+    def _shutdown_terminal(self):
+        if self._initialized:
+            mt5.shutdown()
+        self._initialized = False
+        self._current_login = None
+
+    def _resolve_login(self, login: Optional[int]) -> int:
+        login = login or self._default_login
+        if login is None:
+            raise ConnectionError("MT5 Gateway has no credentials to use for reconnection.")
+        return login
 
     async def connect_and_login(self, creds: MT5Credentials) -> bool:
-        async with self._lock:
-            if self._is_connected:
-                await self._run_in_thread(mt5.shutdown)
-                self._is_connected = False
-            
-            def _connect():
-                if not mt5.initialize():
-                    logger.error(f"MT5 initialize() failed: {mt5.last_error()}")
-                    mt5.shutdown()
-                    return False
-                if not mt5.login(login=creds.login, password=creds.password, server=creds.server):
-                    logger.error(f"MT5 login failed for account {creds.login}: {mt5.last_error()}")
-                    mt5.shutdown()
-                    return False
-                return True
-
-            success = await self._run_in_thread(_connect)
-            if success:
-                self._is_connected = True
-                self._connection_info = creds.model_dump()
-                logger.info(f"MT5 Gateway successfully connected to account {creds.login}.")
+        previous = self._accounts.get(creds.login)
+        self._accounts[creds.login] = creds
+        try:
+            await self._submit(self.ACCOUNT, creds.login, lambda: self._ensure_session(creds.login, force=True))
+        except Exception as e:
+            logger.error(f"MT5 connection failed for account {creds.login}: {e}")
+            if previous:
+                self._accounts[creds.login] = previous
             else:
-                self._is_connected = False
-                self._connection_info = {}
-            return success
+                self._accounts.pop(creds.login, None)
+            return False
+        self._default_login = creds.login
+        logger.info(f"MT5 Gateway successfully connected to account {creds.login}.")
+        return True
+
+    async def disconnect(self, login: int):
+        self._accounts.pop(login, None)
+        if self._default_login == login:
+            self._default_login = next(iter(self._accounts), None)
+        if not self._accounts:
+            await self.shutdown()
 
     async def shutdown(self):
-        async with self._lock:
-            if self._is_connected:
-                await self._run_in_thread(mt5.shutdown)
-                self._is_connected = False
-                logger.info("MT5 Gateway connection has been shut down.")
-
-    async def _ensure_connection(self):
-        """Internal method to check and re-establish connection if lost."""
-        if not self._is_connected or not await self._run_in_thread(mt5.terminal_info):
-            logger.warning("MT5 connection lost or unresponsive. Attempting to reconnect...")
-            if not self._connection_info:
-                raise ConnectionError("MT5 Gateway has no credentials to use for reconnection.")
-            
-            creds = MT5Credentials(**self._connection_info)
-            if not await self.connect_and_login(creds):
-                raise ConnectionError("Failed to re-establish connection with the MT5 terminal.")
-
-    async def get_account_summary(self) -> Optional[Dict[str, Any]]:
-        if not self._is_connected: return None
-        async with self._lock:
-            if not self._is_connected: return None
-            def _fetch():
-                info = mt5.account_info()
-                return info._asdict() if info else None
-            return await self._run_in_thread(_fetch)
+        if self._worker_task is not None:
+            self._worker_task.cancel()
+            await asyncio.gather(self._worker_task, return_exceptions=True)
+            self._worker_task = None
+        for lane in self._lanes:
+            while lane:
+                job = lane.popleft()
+                if not job.future.done():
+                    job.future.set_exception(ConnectionError("MT5 Gateway was shut down."))
+        was_connected = self._current_login is not None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._shutdown_terminal)
+        if was_connected:
+            logger.info("MT5 Gateway connection has been shut down.")
+
+    async def get_account_summary(self, login: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        login = login or self._default_login
+        if login is None or login not in self._accounts:
+            return None
+        def _fetch():
+            info = mt5.account_info()
+            return info._asdict() if info else None
+        try:
+            return await self._submit(self.ACCOUNT, login, _fetch)
+        except ConnectionError:
+            return None
 
     async def fetch_historical_data(self, req: HistoricalDataRequest) -> Optional[list]:
-        async with self._lock:
-            await self._ensure_connection()
-            def _fetch():
-                timeframe_map = {
-                    '1m': mt5.TIMEFRAME_M1, '5m': mt5.TIMEFRAME_M5, '15m': mt5.TIMEFRAME_M15,
-                    '1h': mt5.TIMEFRAME_H1, '4h': mt5.TIMEFRAME_H4, '1d': mt5.TIMEFRAME_D1,
-                }
-                mt5_tf = timeframe_map.get(req.timeframe)
-                if mt5_tf is None: raise ValueError("Unsupported timeframe")
-                
-                start_dt = datetime.datetime.fromisoformat(req.start_date)
-                end_dt = datetime.datetime.fromisoformat(req.end_date)
-                
-                rates = mt5.copy_rates_range(req.symbol, mt5_tf, start_dt, end_dt)
-                return rates.tolist() if rates is not None else None
-            return await self._run_in_thread(_fetch)
+        login = self._resolve_login(req.login)
+        key = (login, req.symbol, req.timeframe, req.start_date, req.end_date)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+        def _fetch():
+            timeframe_map = {
+                '1m': mt5.TIMEFRAME_M1, '5m': mt5.TIMEFRAME_M5, '15m': mt5.TIMEFRAME_M15,
+                '1h': mt5.TIMEFRAME_H1, '4h': mt5.TIMEFRAME_H4, '1d': mt5.TIMEFRAME_D1,
+            }
+            mt5_tf = timeframe_map.get(req.timeframe)
+            if mt5_tf is None: raise ValueError("Unsupported timeframe")
+            
+            start_dt = datetime.datetime.fromisoformat(req.start_date)
+            end_dt = datetime.datetime.fromisoformat(req.end_date)
+            
+            rates = mt5.copy_rates_range(req.symbol, mt5_tf, start_dt, end_dt)
+            return rates.tolist() if rates is not None else None
+        return await asyncio.shield(self._submit(self.HISTORY, login, _fetch, key=key))
 
     async def execute_trade(self, req: TradeRequest) -> Dict:
-        async with self._lock:
-            await self._ensure_connection()
-            def _execute():
-                symbol_info = mt5.symbol_info(req.symbol)
-                if symbol_info is None: return {"status": "error", "message": "Symbol not found"}
-
-                point, ask, bid = symbol_info.point, symbol_info.ask, symbol_info.bid
-                trade_type = mt5.ORDER_TYPE_BUY if req.action.lower() == 'buy' else mt5.ORDER_TYPE_SELL
-                price = ask if trade_type == mt5.ORDER_TYPE_BUY else bid
-                
-                sl = price - (req.sl_pips * point) if trade_type == mt5.ORDER_TYPE_BUY else price + (req.sl_pips * point)
-                tp = price + (req.tp_pips * point) if trade_type == mt5.ORDER_TYPE_BUY else price - (req.tp_pips * point)
-
-                order_request = {
-                    "action": mt5.TRADE_ACTION_DEAL, "symbol": symbol_info.name, "volume": req.volume,
-                    "type": trade_type, "price": price, "sl": sl, "tp": tp, "deviation": 20,
-                    "magic": 234001, "comment": "QuantumLeap AI", "type_time": mt5.ORDER_TIME_GTC,
-                    "type_filling": mt5.ORDER_FILLING_FOK,
-                }
-                result = mt5.order_send(order_request)
-                if result and result.retcode == mt5.TRADE_RETCODE_DONE:
-                    return {"status": "success", "order_id": result.order, "deal_id": result.deal, "price": result.price, "volume": result.volume}
-                else:
-                    return {"status": "error", "message": result.comment if result else "order_send() failed", "retcode": result.retcode if result else None}
-            return await self._run_in_thread(_execute)
+        login = req.login
+        def _execute():
+            symbol_info = mt5.symbol_info(req.symbol)
+            if symbol_info is None: return {"status": "error", "message": "Symbol not found"}
+
+            point, ask, bid = symbol_info.point, symbol_info.ask, symbol_info.bid
+            trade_type = mt5.ORDER_TYPE_BUY if req.action.lower() == 'buy' else mt5.ORDER_TYPE_SELL
+            price = ask if trade_type == mt5.ORDER_TYPE_BUY else bid
+            
+            sl = price - (req.sl_pips * point) if trade_type == mt5.ORDER_TYPE_BUY else price + (req.sl_pips * point)
+            tp = price + (req.tp_pips * point) if trade_type == mt5.ORDER_TYPE_BUY else price - (req.tp_pips * point)
+
+            order_request = {
+                "action": mt5.TRADE_ACTION_DEAL, "symbol": symbol_info.name, "volume": req.volume,
+                "type": trade_type, "price": price, "sl": sl, "tp": tp, "deviation": 20,
+                "magic": 234001, "comment": "QuantumLeap AI", "type_time": mt5.ORDER_TIME_GTC,
+                "type_filling": mt5.ORDER_FILLING_FOK,
+            }
+            result = mt5.order_send(order_request)
+            if result and result.retcode == mt5.TRADE_RETCODE_DONE:
+                return {"status": "success", "order_id": result.order, "deal_id": result.deal, "price": result.price, "volume": result.volume}
+            else:
+                return {"status": "error", "message": result.comment if result else "order_send() failed", "retcode": result.retcode if result else None}
+        return await self._submit(self.TRADE, login, _execute)
 
 # --- FastAPI Application Setup ---
 mt5_gateway_service = MT5GatewayService()
@@ -184,13 +304,16 @@ async def connect(creds: MT5Credentials):
     return {"status": "success", "message": f"Connected to MT5 account {creds.login}."}
 
 @app.post("/disconnect")
-async def disconnect():
-    await mt5_gateway_service.shutdown()
+async def disconnect(login: Optional[int] = None):
+    if login is None:
+        await mt5_gateway_service.shutdown()
+    else:
+        await mt5_gateway_service.disconnect(login)
     return {"status": "success", "message": "Disconnected from MT5."}
 
 @app.get("/account-summary")
-async def get_account_summary():
-    summary = await mt5_gateway_service.get_account_summary()
+async def get_account_summary(login: Optional[int] = None):
+    summary = await mt5_gateway_service.get_account_summary(login)
     if summary is None:
         raise HTTPException(status_code=503, detail="MT5 Gateway not connected.")
     return summary